@@ -3,9 +3,12 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import annotations
-import json, random, re, threading, time, os, subprocess, tempfile, sys
+import json, random, re, threading, time, os, subprocess, tempfile, sys, functools, signal
 from pathlib import Path
 from typing import List, Tuple
+from collections import Counter, OrderedDict, deque
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, TimeoutError as FutureTimeout, wait as futures_wait
 
 # ---------- Selenium ----------
 from selenium import webdriver
@@ -44,19 +47,26 @@ def _regex_to_keywords_display(pattern: str) -> str:
 
     tokens = []
 
-    # 1) הטוקן התקני מהבונה: (?<!\S)(?:[והבכלמש]{1,4})?TERM(?!\S)
-    tok_re = re.compile(r'\(\?\<\!\\\\S\)(?:\(\?\:\[והבכלמש\]\{1,4\}\)\?)?(.+?)\(\?\!\\\\S\)')
+    # 1) הטוקן התקני מהבונה: (?<!\S)(?:[והבכלמש]{1,4}(?<!\S))?TERM(?!\S) — ה-(?<!\S) שאחרי התחיליות קיים רק
+    #    בלי מפרידי־פנים; TERM הוא מונח אחד או חלופות (?:A|B|C)
+    tok_re = re.compile(r'\(\?<!\\S\)(?:\(\?:\[והבכלמש\]\{1,4\}(?:\(\?<!\\S\))?\)\?)?(.+?)\(\?!\\S\)')
+    sep_re = re.compile(r'\(\?:\[[^()]*?\]\)\?')
     for m in tok_re.finditer(pat):
         term = m.group(1)
-        # נקה קבוצות לא-לוכדות של מפרידי־פנים, למשל (?:[\s_\-\u05BE])?
-        term = re.sub(r'\(\?\:[^\)]*\)', ' ', term)
-        # הסר backslashes מיותרים לפני תוים
-        term = re.sub(r'\\([^\w])', r'\1', term)
-        term = term.replace('\\ ', ' ')
-        # נרמל רווחים
-        term = re.sub(r'\s+', ' ', term).strip()
-        if term:
-            tokens.append(term)
+        # נקה קבוצות לא-לוכדות של מפרידי־פנים, למשל (?:[\s_\-\u05BE])? (גם מקוננות)
+        prev = None
+        while prev != term:
+            prev, term = term, sep_re.sub(' ', term)
+        if term.startswith('(?:') and term.endswith(')'):
+            term = term[3:-1]
+        for alt in term.split('|'):
+            # הסר backslashes מיותרים לפני תוים
+            alt = re.sub(r'\\([^\w])', r'\1', alt)
+            alt = alt.replace('\\ ', ' ')
+            # נרמל רווחים
+            alt = re.sub(r'\s+', ' ', alt).strip()
+            if alt:
+                tokens.append(alt)
 
     # 2) אם לא נמצאו, נסה אלטרנטיבות בתוך (?:A|B|C)
     if not tokens:
@@ -132,11 +142,26 @@ def _prep_term(term: str, allow_inside_sep: bool) -> str:
 def _split_terms(terms_raw: str):
     # פיצול לפי פסיקים, התעלמות מריקים
     return [t.strip() for t in terms_raw.split(",") if t.strip()]
-def _parse_terms_grammar(terms_raw: str):
-    # מפענח תחביר: פסיק = קבוצות, "/" בין מילים = OR בתוך קבוצה, "*" בסוף חלופה => הקבוצה חובה
-    # מחזיר (required_groups, optional_groups), כאשר כל קבוצה היא רשימת חלופות (מחרוזות).
+
+# "term:K" — המונח (או הקבוצה) חייב להופיע לפחות K פעמים. תומך גם ב-"term*:K" וב-"term:K*".
+_K_SUFFIX_RE = re.compile(r"^(.*?)\s*:\s*([1-9]\d*)\s*(\*?)\s*$")
+
+def _split_count(part: str):
+    """'חיים:2' -> ('חיים', 2); בלי :K -> (part, 1)."""
+    part = part.strip()
+    m = _K_SUFFIX_RE.match(part)
+    if m and m.group(1).strip():
+        return m.group(1).strip() + m.group(3), int(m.group(2))
+    return part, 1
+
+def _split_terms_k(terms_raw: str):
+    # כמו _split_terms, אבל מחזיר (מונח, K) ללא הסיומת :K
+    return [_split_count(t) for t in _split_terms(terms_raw)]
+
+def _parse_terms_grammar_k(terms_raw: str):
+    # כמו _parse_terms_grammar, אבל כל קבוצה היא (required, alts, K)
     groups = []
-    for raw in [t.strip() for t in terms_raw.split(",") if t.strip()]:
+    for raw, k in _split_terms_k(terms_raw):
         alts = [a.strip() for a in raw.split("/") if a.strip()]
         required = False
         cleaned = []
@@ -146,9 +171,15 @@ def _parse_terms_grammar(terms_raw: str):
                 a = a.strip("*").strip()
             cleaned.append(a)
         if cleaned:
-            groups.append((required, cleaned))
-    req = [alts for (req, alts) in groups if req]
-    opt = [alts for (req, alts) in groups if not req]
+            groups.append((required, cleaned, k))
+    return groups
+
+def _parse_terms_grammar(terms_raw: str):
+    # מפענח תחביר: פסיק = קבוצות, "/" בין מילים = OR בתוך קבוצה, "*" בסוף חלופה => הקבוצה חובה
+    # מחזיר (required_groups, optional_groups), כאשר כל קבוצה היא רשימת חלופות (מחרוזות).
+    groups = _parse_terms_grammar_k(terms_raw)
+    req = [alts for (req, alts, _k) in groups if req]
+    opt = [alts for (req, alts, _k) in groups if not req]
     return req, opt
 
 
@@ -173,12 +204,17 @@ def _build_keywords_grammar_regex(terms_raw: str, mode: str, case_ins: bool, all
     flags = "(?i)" if case_ins else ""
     pref_once = _prefix_pat(allow_inside_sep, enabled=allow_prefixes)
 
-    req_groups, opt_groups = _parse_terms_grammar(terms_raw)
+    groups = _parse_terms_grammar_k(terms_raw)
+    req_groups = [(alts, k) for (req, alts, k) in groups if req]
+    opt_groups = [(alts, k) for (req, alts, k) in groups if not req]
 
-    def group_lookahead(alts):
+    def group_lookahead(alts, k=1):
         core = _alts_to_core(alts, allow_inside_sep)
         if not core:
             return ""
+        if k > 1:
+            # term:K — לפחות K טוקנים תואמים באותה שורה
+            return fr"(?=(?:.*?(?<!\S){pref_once}{core}(?!\S)){{{k}}})"
         return fr"(?=.*(?<!\S){pref_once}{core}(?!\S))"
 
     if not req_groups and not opt_groups:
@@ -187,14 +223,18 @@ def _build_keywords_grammar_regex(terms_raw: str, mode: str, case_ins: bool, all
     if mode == "part":
         looks = []
         # לכל קבוצה חובה — חייבים אחד מהחלופות
-        for alts in req_groups:
-            la = group_lookahead(alts)
+        for alts, k in req_groups:
+            la = group_lookahead(alts, k)
             if la:
                 looks.append(la)
         # אם קיימות גם קבוצות לא-חובה — נדרשת לפחות אחת מהן
         if opt_groups:
-            all_opt_alts = [a for grp in opt_groups for a in grp]
-            la_opt = group_lookahead(all_opt_alts)
+            if all(k == 1 for _alts, k in opt_groups):
+                all_opt_alts = [a for grp, _k in opt_groups for a in grp]
+                la_opt = group_lookahead(all_opt_alts)
+            else:
+                opt_looks = [la for la in (group_lookahead(a, k) for a, k in opt_groups) if la]
+                la_opt = "(?:" + "|".join(opt_looks) + ")" if opt_looks else ""
             if req_groups:
                 looks.append(la_opt)
             else:
@@ -233,10 +273,12 @@ def _build_anyorder_lookaheads(terms_raw: str, allow_inside_sep: bool, allow_pre
     """
     lookaheads = []
     pref  = _prefix_pat(allow_inside_sep, enabled=allow_prefixes) if allow_prefixes else ""
-    for t in _split_terms(terms_raw):
+    for t, k in _split_terms_k(terms_raw):
         p = _prep_term(t, allow_inside_sep)
-        if p:
-            lookaheads.append(fr"(?=.*(?<!\\S){pref}{p}(?!\\S))")
+        if p and k > 1:
+            lookaheads.append(fr"(?=(?:.*?(?<!\S){pref}{p}(?!\S)){{{k}}})")
+        elif p:
+            lookaheads.append(fr"(?=.*(?<!\S){pref}{p}(?!\S))")
     return "".join(lookaheads)
 
 
@@ -245,7 +287,13 @@ def build_regex(terms_raw: str, mode: str, case_ins: bool, allow_inside_sep: boo
                 k_spec: dict | None = None) -> str:
     """
     mode: 'whole' / 'part' / 'anyorder'
+    k_spec: מונח -> K (כמו ש-_parse_k_spec מחזיר); גובר על ה-:K שבתוך terms_raw.
+    ספירות K נאכפות בזמן ההתאמה ע"י TokenSetMatcher; ה-Regex מקודד אותן רק כגיבוי.
     """
+    if k_spec:
+        terms_raw = ", ".join(
+            f"{t}:{k_spec.get(t, k)}" if int(k_spec.get(t, k)) > 1 else t
+            for t, k in _split_terms_k(terms_raw))
     # 1) Try the grammar-based builder (new syntax with groups and '*' etc.)
     try:
         _gram_pat = _build_keywords_grammar_regex(terms_raw, mode, case_ins, allow_inside_sep, allow_prefixes)
@@ -257,12 +305,22 @@ def build_regex(terms_raw: str, mode: str, case_ins: bool, allow_inside_sep: boo
     # 2) Fallback to legacy behavior so dialog always has a valid regex
     flags = "(?i)" if case_ins else ""
     pref  = _prefix_pat(allow_inside_sep, enabled=allow_prefixes)
-    core  = _build_core_group(terms_raw, allow_inside_sep)
+    terms_k = _split_terms_k(terms_raw)
+    core  = _build_core_group(", ".join(t for t, _k in terms_k), allow_inside_sep)
 
     if not core:
         return ""  # no terms, disable confirm button upstream
 
     if mode == "whole":
+        if any(k > 1 for _t, k in terms_k):
+            # term:K — ההודעה כולה היא המונח, חוזר לפחות K פעמים
+            alts = []
+            for t, k in terms_k:
+                p = _prep_term(t, allow_inside_sep)
+                if not p:
+                    continue
+                alts.append(fr"{pref}{p}(?:\s+{pref}{p}){{{k - 1},}}" if k > 1 else f"{pref}{p}")
+            return fr"{flags}^\s*(?:{'|'.join(alts)})\s*$"
         # Exact whole-message match (with optional whitespace around)
         return fr"{flags}^\s*(?:{pref}{core})\s*$"
 
@@ -521,9 +579,15 @@ class RegexBuilderDialog(tk.Toplevel):
             self.btn_ok.state(["disabled"])
 
     def _update_live_test(self, pat: str):
+        # אותו מנוע כמו בבוט: אותו _CompiledRule שה-Dataset בונה לכלל שיישמר (תמיד ללא תלות ברישיות)
         txt = self.var_test.get()
+        settings = getattr(self.master, "settings", None)
+        vals = settings.values if settings else {}
         try:
-            ok = re.search(pat, txt) is not None
+            rule = _CompiledRule(pat, self.var_terms.get().strip(),
+                                 backend=vals.get("regex_backend", DEFAULT_REGEX_BACKEND),
+                                 timeout_ms=float(vals.get("regex_backend_timeout_ms", REGEX_BACKEND_TIMEOUT_MS)))
+            ok = bool(rule.matcher(txt))
             self.var_test_res.set("✅ נמצא התאמה" if ok else "❌ אין התאמה")
         except re.error as e:
             self.var_test_res.set(f"שגיאת Regex {e}")
@@ -546,6 +610,9 @@ class RegexBuilderDialog(tk.Toplevel):
         except re.error as e:
             messagebox.showerror("Regex לא תקין", f"לא ניתן לאשר: {e}")
             return
+        settings = getattr(self.master, "settings", None)
+        if not confirm_regex_cost(self, pat, settings.values if settings else None, self.var_terms.get().strip()):
+            return
 
         if self.on_done:
             try:
@@ -661,8 +728,10 @@ DEFAULT_DATASET = "keywords.json"
 DEFAULT_GROUP   = ""
 FREE_CHOICE = "(בחירה חופשית)"
 SETTINGS_PATH   = Path("settings.json")
+RECORDED_CORPUS_PATH = Path("corpus.jsonl")   # הודעות נכנסות מוקלטות (כשההקלטה מופעלת)
 
 PROFILE_DIR = Path.home() / "selenium_profile"
+WHATSAPP_URL = "https://web.whatsapp.com"
 SEARCH_BOX = ("//div[@role='textbox' and @contenteditable='true' and "
               "(@aria-label='Search input textbox' or @data-tab='3')]")
 CHAT_ITEM   = "//span[@title=%s]"
@@ -673,6 +742,8 @@ MEDIA_PLACEHOLDER = "[תוכן מדיה]"
 
 # ברירת מחדל: פולינג כל 2 שניות
 DEFAULT_POLL_INTERVAL = 2
+# פולינג אדפטיבי: מיד אחרי פעילות — floor; בשקט — הכפלה עד poll_interval_sec (התקרה)
+DEFAULT_POLL_FLOOR = 0.25
 
 # ---------- RTL helpers ----------
 def _norm(s: str) -> str:
@@ -695,47 +766,2651 @@ def _rtl_text_widget(txt: tk.Text):
     except Exception:
         pass
 
-# ---------- Selenium helpers ----------
-def build_driver(start_maximized: bool=True) -> webdriver.Chrome:
-    PROFILE_DIR.mkdir(exist_ok=True)
-    opts = Options()
-    opts.add_argument(f"--user-data-dir={PROFILE_DIR.resolve()}")
-    if start_maximized:
-        opts.add_argument("--start-maximized")
-    opts.add_argument("--log-level=3")
-    opts.add_argument("--disable-logging")
-    opts.add_experimental_option("detach", True)
-    return webdriver.Chrome(options=opts)
+# ---------- Lean browser mode ----------
+# לסשנים ארוכים: בלי תמונות/וידאו/סטיקרים (חסימת בקשות ב-CDP), בלי אנימציות ו-GPU, ואופציונלית בלי חלון
+# (headless) אחרי שהפרופיל כבר מחובר. הבוט קורא רק טקסט, כך שהמדיה רק מנפחת את הזיכרון של Chrome.
+LEAN_CHROME_ARGS = (
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-component-extensions-with-background-pages",
+    "--disable-features=Translate,MediaRouter,OptimizationHints",
+    "--mute-audio",
+)
+LEAN_BLOCKED_URLS = (
+    "*.jpg*", "*.jpeg*", "*.png*", "*.gif*", "*.webp*",    # תמונות וסטיקרים
+    "*.mp4*", "*.webm*", "*.3gp*",                         # וידאו
+    "*://mmg.whatsapp.net/*", "*://media*.whatsapp.net/*",  # מדיה מוצפנת של הודעות (תמונות, וידאו, סטיקרים)
+    "*://pps.whatsapp.net/*",                              # תמונות פרופיל
+)
+HEADLESS_WINDOW_SIZE = "1366,900"
+
+# בלי אנימציות ומעברים (משך 0 — אירועי transitionend עדיין נורים), לפני כל טעינת דף
+_NO_ANIMATIONS_JS = r"""
+(() => {
+  const add = () => {
+    const s = document.createElement('style');
+    s.textContent = '*,*::before,*::after{animation-duration:0s!important;animation-delay:0s!important;'
+                  + 'transition-duration:0s!important;transition-delay:0s!important}';
+    (document.head || document.documentElement).appendChild(s);
+  };
+  if (document.readyState === 'loading') document.addEventListener('DOMContentLoaded', add); else add();
+})();
+"""
+
+def lean_options(values: dict) -> dict:
+    """הפרמטרים של SeleniumTransport לפי ההגדרות lean_browser / lean_headless."""
+    lean = bool(values.get("lean_browser", False))
+    return {"lean": lean, "headless_after_login": lean and bool(values.get("lean_headless", False))}
+
+def _apply_lean(drv):
+    """חסימת מדיה ואנימציות דרך CDP (לפני טעינת WhatsApp); ב-headless — User-Agent של Chrome רגיל."""
+    drv.execute_cdp_cmd("Network.enable", {})
+    drv.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(LEAN_BLOCKED_URLS)})
+    drv.execute_cdp_cmd("Emulation.setEmulatedMedia",
+                        {"features": [{"name": "prefers-reduced-motion", "value": "reduce"}]})
+    drv.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": _NO_ANIMATIONS_JS})
+
+def _hide_headless(drv):
+    # WhatsApp Web מסרב לדפדפן שמזדהה כ-HeadlessChrome
+    ua = drv.execute_cdp_cmd("Browser.getVersion", {}).get("userAgent", "")
+    if "HeadlessChrome" in ua:
+        drv.execute_cdp_cmd("Network.setUserAgentOverride", {"userAgent": ua.replace("HeadlessChrome", "Chrome")})
+
+# ---------- Selenium helpers ----------
+def build_driver(start_maximized: bool=True, profile_dir: Path = PROFILE_DIR, lean: bool = False,
+                 headless: bool = False, detach: bool = True) -> webdriver.Chrome:
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    opts = Options()
+    opts.add_argument(f"--user-data-dir={profile_dir.resolve()}")
+    if headless:
+        opts.add_argument("--headless=new")
+        opts.add_argument(f"--window-size={HEADLESS_WINDOW_SIZE}")
+    elif start_maximized:
+        opts.add_argument("--start-maximized")
+    opts.add_argument("--log-level=3")
+    opts.add_argument("--disable-logging")
+    if lean:
+        for arg in LEAN_CHROME_ARGS:
+            opts.add_argument(arg)
+    if detach and not headless:
+        # Chrome בלי חלון לא נשאר פתוח אחרי הבוט — אי אפשר לראות או לסגור אותו.
+        # גם לא בתהליך עובד: Chrome שנשאר אחריו מחזיק את הפרופיל, והעובד שמופעל מחדש לא יתחבר
+        opts.add_experimental_option("detach", True)
+    drv = webdriver.Chrome(options=opts)
+    if headless:
+        _hide_headless(drv)
+    if lean:
+        _apply_lean(drv)
+    return drv
+
+def wait_for_login(drv, sec=120):
+    try:
+        WebDriverWait(drv, sec).until(
+            EC.presence_of_element_located((By.XPATH, SEARCH_BOX))
+        )
+    except TimeoutException:
+        messagebox.showinfo("WhatsApp Web",
+                            "סרוק/י את קוד ה-QR בכרום שנפתח. לאחר הסריקה לחץ/י אישור.")
+        WebDriverWait(drv, sec).until(
+            EC.presence_of_element_located((By.XPATH, SEARCH_BOX))
+        )
+
+def xpath_literal(s: str) -> str:
+    """מחרוזת כ-literal של XPath 1.0 (אין escape: שם עם ' וגם " נבנה ב-concat)."""
+    if "'" not in s:
+        return f"'{s}'"
+    if '"' not in s:
+        return f'"{s}"'
+    return "concat(" + ", \"'\", ".join(f"'{part}'" for part in s.split("'")) + ")"
+
+def open_chat(drv, name):
+    search = drv.find_element(By.XPATH, SEARCH_BOX)
+    search.clear()
+    search.send_keys(name)
+    chat = WebDriverWait(drv, 10).until(
+        EC.element_to_be_clickable((By.XPATH, CHAT_ITEM % xpath_literal(name)))
+    )
+    chat.click()
+
+# ---------- Message ingestion (MutationObserver) ----------
+# Observer בצד הדף מוסיף כל הודעה נכנסת חדשה לתור (window.__mordiObs.queue), והבוט מרוקן את התור
+# בקריאת execute_script אחת לכל סבב — עלות קבועה, בלי לעבור על כל הבועות בצ'אט.
+OBSERVER_MAX_SEEN = 2000     # כמה data-id זוכרים בצד הדף
+OBSERVER_MAX_QUEUE = 500
+SEEN_IDS_MAX = 5000          # כמה data-id זוכר הבוט (בצד Python)
+RECENT_ROWS_LIMIT = 30       # כמה הודעות נכנסות אחרונות נקראות בכל סבב פולינג
+MAX_READ_ROWS = 480          # עד כמה החלון מורחב כשהמזהה האחרון שטופל לא נמצא בו
+PRIMED_EMPTY = ""            # ב-_last_ids: הצ'אט היה ריק כשסומנה ההיסטוריה — כל הודעה בו חדשה
+
+# פרטי שורת הודעה ([data-id]) — משותף לסקריפטים שלמטה
+_JS_ROW_INFO = r"""
+const rowInfo = row => {
+  const t = row.querySelector('span.selectable-text');
+  const meta = row.querySelector('[data-pre-plain-text]');
+  const dir = row.querySelector('.message-out') ? 'out' : (row.querySelector('.message-in') ? 'in' : '');
+  return {id: row.getAttribute('data-id'), dir: dir, text: t ? t.innerText : '',
+          meta: meta ? meta.getAttribute('data-pre-plain-text') : '', seen_at: Date.now()};
+};
+"""
+
+# תמונת מצב של N ההודעות האחרונות בצ'אט הפתוח (אופציונלית — רק כיוון אחד) בקריאה אחת
+_DOM_SNAPSHOT_JS = _JS_ROW_INFO + r"""
+const limit = arguments[0], want = arguments[1];
+const root = document.querySelector('#main') || document;
+const rows = root.querySelectorAll('[data-id]');
+const out = [];
+for (let i = rows.length - 1; i >= 0 && out.length < limit; i--) {
+  const info = rowInfo(rows[i]);
+  if (!want || info.dir === want) out.push(info);
+}
+return out.reverse();
+"""
+
+_OBSERVER_INSTALL_JS = _JS_ROW_INFO + r"""
+const maxSeen = arguments[0], maxQueue = arguments[1];
+const root = document.querySelector('#main');
+if (!root) return false;
+const old = window.__mordiObs;
+if (old && old.root === root && root.isConnected) return true;
+if (old && old.observer) old.observer.disconnect();
+const seen = new Set(), order = [];
+const remember = id => { seen.add(id); order.push(id); if (order.length > maxSeen) seen.delete(order.shift()); };
+root.querySelectorAll('[data-id]').forEach(r => remember(r.getAttribute('data-id')));
+const st = {root: root, queue: [], dropped: 0};
+// הודעה חדשה = אין אחריה אף שורה מוכרת (שורות היסטוריה שנטענות בגלילה מתווספות מעל)
+const isNewest = row => {
+  const rows = root.querySelectorAll('[data-id]');
+  for (let i = rows.length - 1; i >= 0; i--) {
+    if (rows[i] === row) return true;
+    if (seen.has(rows[i].getAttribute('data-id'))) return false;
+  }
+  return false;
+};
+const consider = row => {
+  const id = row.getAttribute('data-id');
+  if (!id || seen.has(id)) return;
+  const fresh = isNewest(row);
+  remember(id);
+  if (!fresh || !row.querySelector('.message-in')) return;
+  st.queue.push(rowInfo(row));
+  if (st.wake) st.wake();
+  if (st.queue.length > maxQueue) { st.queue.shift(); st.dropped++; }
+};
+st.observer = new MutationObserver(muts => {
+  for (const m of muts) for (const n of m.addedNodes) {
+    if (n.nodeType !== 1) continue;
+    let rows = n.matches('[data-id]') ? [n] : Array.from(n.querySelectorAll('[data-id]'));
+    if (!rows.length) { const r = n.closest('[data-id]'); if (r) rows = [r]; }
+    rows.forEach(consider);
+  }
+});
+st.observer.observe(root, {childList: true, subtree: true});
+window.__mordiObs = st;
+return true;
+"""
+
+_OBSERVER_DRAIN_JS = r"""
+const st = window.__mordiObs, root = document.querySelector('#main');
+if (!st || !root || st.root !== root || !root.isConnected) return null;
+const q = st.queue, dropped = st.dropped;
+st.queue = []; st.dropped = 0;
+return {items: q, dropped: dropped};
+"""
+
+# כמו DRAIN, אבל ממתין (execute_async_script) עד שמגיעה הודעה או שעובר הזמן — ה-Observer מעיר אותו מיד
+_OBSERVER_WAIT_JS = r"""
+const done = arguments[arguments.length - 1], ms = arguments[0];
+const st = window.__mordiObs, root = document.querySelector('#main');
+if (!st || !root || st.root !== root || !root.isConnected) { done(null); return; }
+var timer = null;
+const take = () => {
+  if (timer !== null) clearTimeout(timer);
+  st.wake = null;
+  const q = st.queue, dropped = st.dropped;
+  st.queue = []; st.dropped = 0;
+  done({items: q, dropped: dropped});
+};
+if (st.queue.length) { take(); return; }
+timer = setTimeout(take, ms);
+st.wake = take;
+"""
+
+# data-pre-plain-text: "[10:21, 3/15/2024] שם השולח: "
+_META_RE = re.compile(r"^\[(?P<time>[^\]]*)\]\s*(?P<sender>.*?):\s*$")
+
+def _parse_message_meta(meta: str) -> Tuple[str, str]:
+    """(sender, timestamp) מתוך data-pre-plain-text; מחרוזות ריקות אם הפורמט לא מוכר."""
+    m = _META_RE.match((meta or "").strip() + " ")
+    return (m.group("sender").strip(), m.group("time").strip()) if m else ("", "")
+
+def _message_from_row(it: dict) -> dict:
+    text = (it.get("text") or "").strip()
+    sender, ts = _parse_message_meta(it.get("meta") or "")
+    return {"id": it.get("id"), "direction": it.get("dir") or "", "text": text if text else MEDIA_PLACEHOLDER,
+            "sender": sender, "time": ts, "seen_at": it.get("seen_at")}
+
+def dom_snapshot(drv, limit: int = RECENT_ROWS_LIMIT, direction: str | None = None) -> List[dict]:
+    """
+    N ההודעות האחרונות בצ'אט (ישנה -> חדשה) ב-round-trip אחד:
+    {id, direction ("in"/"out"), text, sender, time, seen_at}. direction מסנן לכיוון אחד.
+    """
+    return [_message_from_row(it) for it in drv.execute_script(_DOM_SNAPSHOT_JS, limit, direction or "") or []]
+
+def recent_incoming(drv, limit: int = RECENT_ROWS_LIMIT) -> List[dict]:
+    """ההודעות הנכנסות האחרונות (ישנה -> חדשה)."""
+    return dom_snapshot(drv, limit, "in")
+
+def last_incoming_text(drv) -> str:
+    """טקסט ההודעה הנכנסת האחרונה (או האחרונה בכלל אם אין נכנסות) — קריאה אחת לדפדפן."""
+    rows = dom_snapshot(drv, RECENT_ROWS_LIMIT)
+    incoming = [r for r in rows if r["direction"] == "in"]
+    last = (incoming or rows or [None])[-1]
+    return last["text"] if last else MEDIA_PLACEHOLDER
+
+def last_outgoing_id(drv) -> str | None:
+    rows = dom_snapshot(drv, 1, "out")
+    return rows[-1]["id"] if rows else None
+
+def _norm_sent_text(text: str) -> str:
+    """טקסט יוצא להשוואה מול בועה: innerText של בועה רב-שורתית לא זהה תו-לתו לטקסט שנשלח."""
+    return " ".join((text or "").split())
+
+# ההודעות היוצאות האחרונות בצ'אט הפתוח עם סטטוס הווי: pending (שעון) / sent (וי) / delivered (וי כפול)
+_OUTGOING_STATUS_JS = r"""
+const limit = arguments[0];
+const rows = (document.querySelector('#main') || document).querySelectorAll('[data-id]');
+const out = [];
+for (let i = rows.length - 1; i >= 0 && out.length < limit; i--) {
+  const row = rows[i];
+  if (!row.querySelector('.message-out')) continue;
+  const t = row.querySelector('span.selectable-text');
+  const icon = row.querySelector('[data-icon="msg-time"], [data-icon="msg-check"], [data-icon^="msg-dblcheck"]');
+  const name = icon ? icon.getAttribute('data-icon') : '';
+  const status = name === 'msg-time' ? 'pending' : name === 'msg-check' ? 'sent'
+               : name.indexOf('msg-dblcheck') === 0 ? 'delivered' : '';
+  out.push({id: row.getAttribute('data-id'), text: t ? t.innerText : '', status: status});
+}
+return out.reverse();
+"""
+
+def outgoing_status(drv, limit: int = RECENT_ROWS_LIMIT) -> List[dict]:
+    """[{id, text, status}] של ההודעות היוצאות האחרונות (ישנה -> חדשה); סטטוס לא מוכר נחשב sent."""
+    return [{"id": it.get("id"), "text": it.get("text") or "", "status": it.get("status") or "sent"}
+            for it in drv.execute_script(_OUTGOING_STATUS_JS, limit) or []]
+
+# ---------- Readiness waits ----------
+# במקום השהיות קבועות (0.6 שנ' לפני הקלדה, 0.2 שנ' בין בדיקות אישור, שנייה לפני סגירה) — הדפדפן
+# ממתין לתנאי עצמו ועונה ברגע שהוא מתקיים: כל שינוי ב-#main בודק אותו מחדש (וגם טיימר גיבוי,
+# למקרה ש-#main הוחלף). סקריפט אסינכרוני: arguments[0] = זמן מקסימלי ב-ms, אחריו הארגומנטים של cond.
+WAIT_SLICE_SEC = 1.0         # המתנה ארוכה מחולקת לפרוסות — בין פרוסה לפרוסה הדרייבר פנוי לאחרים
+COMPOSER_READY_TIMEOUT = 2.0
+SEND_ENABLED_TIMEOUT = 2.0
+
+def _js_wait_until(cond: str) -> str:
+    return cond + r"""
+const done = arguments[arguments.length - 1], ms = arguments[0];
+const args = Array.prototype.slice.call(arguments, 1, arguments.length - 1);
+const test = () => { try { return !!cond.apply(null, args); } catch (e) { return false; } };
+if (test()) return done(true);
+let finished = false, obs = null, poll = null, timer = null;
+const finish = ok => {
+  if (finished) return;
+  finished = true;
+  if (obs) obs.disconnect();
+  clearInterval(poll); clearTimeout(timer);
+  done(ok);
+};
+obs = new MutationObserver(() => { if (test()) finish(true); });
+obs.observe(document.querySelector('#main') || document.body,
+            {childList: true, subtree: true, attributes: true, characterData: true});
+poll = setInterval(() => { if (test()) finish(true); }, 250);
+timer = setTimeout(() => finish(test()), ms);
+"""
+
+# תיבת ההקלדה מקבלת פוקוס
+_COMPOSER_READY_JS = _js_wait_until(r"""
+const cond = box => {
+  if (!box.isConnected) return false;
+  if (document.activeElement !== box && !box.contains(document.activeElement)) box.focus();
+  return document.activeElement === box || box.contains(document.activeElement);
+};
+""")
+
+# כפתור השליחה פעיל (אם לא נמצא כפתור — מספיק שבתיבה יש טקסט)
+_SEND_ENABLED_JS = _js_wait_until(r"""
+const cond = box => {
+  const footer = box.closest('footer') || document;
+  let btn = footer.querySelector('button[aria-label="Send"], button[aria-label="שליחה"], button[aria-label="שלח"]');
+  if (!btn) { const icon = footer.querySelector('span[data-icon="send"], span[data-icon="wds-ic-send-filled"]');
+              btn = icon ? (icon.closest('button') || icon.closest('[role="button"]')) : null; }
+  if (!btn) return (box.innerText || '').trim().length > 0;
+  return !btn.disabled && btn.getAttribute('aria-disabled') !== 'true';
+};
+""")
+
+# ההודעה היוצאת האחרונה היא want ואינה afterId
+_WAIT_OUTGOING_JS = _JS_ROW_INFO + _js_wait_until(r"""
+const cond = (want, afterId) => {
+  const rows = (document.querySelector('#main') || document).querySelectorAll('[data-id]');
+  for (let i = rows.length - 1; i >= 0; i--) {
+    const info = rowInfo(rows[i]);
+    if (info.dir !== 'out') continue;
+    return info.id !== afterId && info.text.replace(/\s+/g, ' ').trim() === want;
+  }
+  return false;
+};
+""")
+
+# להודעה היוצאת האחרונה כבר אין שעון ("ממתינה לשליחה") — בטוח לסגור את הדפדפן
+_OUTGOING_FLUSHED_JS = _js_wait_until(r"""
+const cond = () => {
+  const rows = (document.querySelector('#main') || document).querySelectorAll('[data-id]');
+  for (let i = rows.length - 1; i >= 0; i--) {
+    if (!rows[i].querySelector('.message-out')) continue;
+    return !rows[i].querySelector('[data-icon="msg-time"]');
+  }
+  return true;
+};
+""")
+
+DEFAULT_LATENCY_BUDGET_MS = {"open": 3000, "ready": 500, "insert": 1000, "send": 500, "confirm": 5000, "flush": 5000}
+
+class LatencyBudget:
+    """
+    תקציב זמן (ms) לכל שלב בשליחה: open (פתיחת צ'אט), ready (תיבת ההקלדה), insert (הטקסט + כפתור שליחה),
+    send (Enter), confirm (הבועה היוצאת), flush (ההודעה יצאה מהתור לפני סגירה). שלב שחורג — מדווח.
+    """
+    def __init__(self, budgets: dict | None = None, on_status=None):
+        self.budgets = dict(DEFAULT_LATENCY_BUDGET_MS)
+        self.budgets.update({k: float(v) for k, v in (budgets or {}).items()})
+        self.on_status = on_status
+        self.exceeded: Counter = Counter()
+        self.failed: Counter = Counter()     # שלבים שהתנאי שלהם לא התקיים עד תום ההמתנה
+        self.last: dict = {}
+
+    def record(self, stage: str, started: float) -> float:
+        """started = time.perf_counter() בתחילת השלב; מחזיר את משך השלב ב-ms."""
+        ms = (time.perf_counter() - started) * 1000.0
+        self.last[stage] = ms
+        limit = self.budgets.get(stage)
+        if limit and ms > limit:
+            self.exceeded[stage] += 1
+            if self.on_status:
+                self.on_status(f"חריגה מתקציב הזמן: {stage} {ms:.0f}ms (תקציב {limit:.0f}ms).")
+        return ms
+
+    def fail(self, stage: str, started: float) -> float:
+        """שלב שנכשל (ההמתנה הסתיימה בלי שהתנאי התקיים) — נספר בנפרד ולא נבדק מול התקציב."""
+        ms = (time.perf_counter() - started) * 1000.0
+        self.last[stage] = ms
+        self.failed[stage] += 1
+        if self.on_status:
+            self.on_status(f"שלב {stage} נכשל אחרי {ms:.0f}ms.")
+        return ms
+
+def wait_for_sent(drv, text: str, after_id: str | None = None, timeout: float = 20.0, lock=None,
+                  slice_sec: float = WAIT_SLICE_SEC) -> bool:
+    """
+    ממתין שההודעה היוצאת האחרונה תהיה text (רווחים ושורות מנורמלים) ושזו שורה חדשה (מזהה שונה מ-after_id, שנלקח לפני השליחה).
+    הדפדפן עונה ברגע שהבועה מופיעה (MutationObserver); ההמתנה מחולקת לפרוסות של slice_sec תחת lock,
+    כך שבין הפרוסות הדרייבר פנוי לאחרים.
+    """
+    return wait_in_page(drv, _WAIT_OUTGOING_JS, timeout, _norm_sent_text(text), after_id, lock=lock, slice_sec=slice_sec)
+
+def wait_in_page(drv, script: str, timeout: float, *args, lock=None, slice_sec: float = WAIT_SLICE_SEC) -> bool:
+    """מריץ סקריפט המתנה (_js_wait_until) עד שהתנאי מתקיים או שעובר timeout; True אם התקיים."""
+    deadline = time.monotonic() + timeout
+    while True:
+        ms = int(1000 * max(0.0, min(slice_sec, deadline - time.monotonic())))
+        try:
+            if lock is not None:
+                with lock:
+                    ok = drv.execute_async_script(script, ms, *args)
+            else:
+                ok = drv.execute_async_script(script, ms, *args)
+            if ok:
+                return True
+        except Exception:
+            time.sleep(min(0.2, max(0.0, deadline - time.monotonic())))   # הדף נטען מחדש וכד'
+        if time.monotonic() >= deadline:
+            return False
+
+class RoundTripCounter:
+    """סופר פקודות WebDriver (כל פקודה = בקשת HTTP אחת ל-ChromeDriver) — גם כאלה שיוצאות מ-WebElement."""
+    def __init__(self, drv):
+        self.drv = drv
+        self.count = 0
+        self._orig = drv.execute
+
+        def _execute(*args, **kwargs):
+            self.count += 1
+            return self._orig(*args, **kwargs)
+        drv.execute = _execute
+
+    def take(self) -> int:
+        """מספר הפקודות מאז הקריאה הקודמת."""
+        n, self.count = self.count, 0
+        return n
+
+    def uninstall(self):
+        try:
+            del self.drv.execute
+        except Exception:
+            pass
+
+class BoundedSeenSet:
+    """קבוצת מזהים עם גודל חסום — הישנים ביותר נשכחים ראשונים."""
+    def __init__(self, maxlen: int = SEEN_IDS_MAX):
+        self.maxlen = maxlen
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        return key in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, key):
+        self._ids[key] = None
+        self._ids.move_to_end(key)
+        while len(self._ids) > self.maxlen:
+            self._ids.popitem(last=False)
+
+class MessageObserver:
+    """
+    מתקין MutationObserver על חלון השיחה (#main) ומרוקן את תור ההודעות הנכנסות.
+    כשהשיחה מתחלפת או הדף נטען מחדש — מותקן מחדש בריקון הבא (הודעות ישנות מסומנות כנראו), והריקון
+    מחזיר None: הודעות שהגיעו מאז הריקון הקודם צריך לקרוא מהצ'אט.
+    """
+    def __init__(self, drv, max_seen: int = OBSERVER_MAX_SEEN, max_queue: int = OBSERVER_MAX_QUEUE):
+        self.drv = drv
+        self.max_seen = max_seen
+        self.max_queue = max_queue
+        self.installed = False
+        self.dropped = 0
+        self.reinstalls = 0
+
+    def install(self) -> bool:
+        self.installed = bool(self.drv.execute_script(_OBSERVER_INSTALL_JS, self.max_seen, self.max_queue))
+        return self.installed
+
+    def drain(self) -> List[dict] | None:
+        """הודעות נכנסות חדשות מאז הריקון הקודם, לפי הסדר: {id, text, sender, time, seen_at}."""
+        return self._collect(self.drv.execute_script(_OBSERVER_DRAIN_JS))
+
+    def wait(self, timeout: float) -> List[dict] | None:
+        """כמו drain, אבל חוזר רק כשיש הודעה חדשה או אחרי timeout שניות (קריאה אחת לדפדפן)."""
+        return self._collect(self.drv.execute_async_script(_OBSERVER_WAIT_JS, int(timeout * 1000)))
+
+    def _collect(self, res) -> List[dict] | None:
+        if res is None:
+            self.install()
+            self.reinstalls += 1
+            return None
+        self.dropped += int(res.get("dropped") or 0)
+        return [_message_from_row(it) for it in res.get("items") or []]
+
+# ---------- Fast text insertion ----------
+# send_keys מקליד תו-תו דרך ChromeDriver: תגובה ארוכה בעברית לוקחת שניות, ותווים מחוץ ל-BMP (אימוג'י)
+# נכשלים. במקום זה מכניסים את כל הטקסט בפקודה אחת: execCommand('insertText') לשורה אחת,
+# או אירוע paste מדומה (שורות מרובות — Enter היה שולח את ההודעה באמצע). אם תיבת ההקלדה לא
+# מכילה בדיוק את הטקסט — מרוקנים אותה וחוזרים ל-send_keys.
+INSERT_SETTLE_MS = 50        # כמה זמן העורך של WhatsApp מקבל לעדכן את ה-DOM לפני הבדיקה
+
+_INSERT_TEXT_JS = r"""
+const box = arguments[0], text = arguments[1], settle = arguments[2], done = arguments[arguments.length - 1];
+const norm = s => (s || '').replace(/\s+/g, ' ').trim();
+const clear = () => {
+  box.focus();
+  document.execCommand('selectAll', false, null);
+  document.execCommand('delete', false, null);
+};
+const check = (method, next) => setTimeout(() => {
+  if (norm(box.innerText) === norm(text)) return done(method);
+  clear();
+  next();
+}, settle);
+const paste = () => {
+  try {
+    const dt = new DataTransfer();
+    dt.setData('text/plain', text);
+    box.focus();
+    box.dispatchEvent(new ClipboardEvent('paste', {clipboardData: dt, bubbles: true, cancelable: true}));
+  } catch (e) { return done(null); }
+  check('paste', () => done(null));
+};
+box.focus();
+if (norm(box.innerText)) clear();
+if (text.indexOf('\n') >= 0) return paste();
+let ok = false;
+try { ok = document.execCommand('insertText', false, text); } catch (e) {}
+if (!ok) { clear(); return paste(); }
+check('insertText', paste);
+"""
+
+_CLEAR_TEXT_JS = r"""
+const box = arguments[0];
+box.focus();
+document.execCommand('selectAll', false, null);
+document.execCommand('delete', false, null);
+return (box.innerText || '').trim().length;
+"""
+
+def insert_text(drv, box, text: str, settle_ms: int = INSERT_SETTLE_MS) -> str | None:
+    """
+    מכניס את text לתיבת ההקלדה בלי להקליד תו-תו. מחזיר את השיטה שהצליחה ('insertText'/'paste'),
+    או None — ואז התיבה ריקה וצריך send_keys.
+    """
+    try:
+        return drv.execute_async_script(_INSERT_TEXT_JS, box, text, int(settle_ms)) or None
+    except Exception:
+        try:
+            drv.execute_script(_CLEAR_TEXT_JS, box)
+        except Exception:
+            pass
+        return None
+
+def clear_text(drv, box) -> bool:
+    """מרוקן את תיבת ההקלדה (בלי לשלוח); True אם נשארה ריקה."""
+    return not drv.execute_script(_CLEAR_TEXT_JS, box)
+
+# ---------- Chat list (unread badges) ----------
+# רשימת הצ'אטים (#pane-side) מציגה לכל צ'אט תג "לא נקרא" עם מספר ההודעות החדשות — סריקה אחת
+# של הרשימה אומרת לאילו קבוצות צריך להיכנס, בלי לפתוח כל קבוצה בכל סבב.
+CHAT_LIST_ITEM = "//div[@id='pane-side']" + CHAT_ITEM
+
+_UNREAD_CHATS_JS = r"""
+const pane = document.querySelector('#pane-side');
+if (!pane) return [];
+const out = [];
+pane.querySelectorAll('[role="listitem"], [role="row"]').forEach(row => {
+  const title = row.querySelector('span[title]');
+  if (!title) return;
+  const badge = Array.from(row.querySelectorAll('[aria-label]'))
+    .find(el => /unread|לא נקרא/i.test(el.getAttribute('aria-label') || ''));
+  if (!badge) return;
+  out.push({title: title.getAttribute('title'), unread: parseInt(badge.innerText, 10) || 1});
+});
+return out;
+"""
+
+def unread_chats(drv) -> dict:
+    """צ'אטים עם הודעות שלא נקראו ברשימת הצ'אטים: {שם: מספר} — קריאה אחת לדפדפן."""
+    out: dict = {}
+    for it in drv.execute_script(_UNREAD_CHATS_JS) or []:
+        title = it.get("title")
+        if title:
+            out[title] = max(out.get(title, 0), int(it.get("unread") or 1))
+    return out
+
+# ---------- Chat navigation ----------
+# מעבר צ'אט בלי חיפוש מיותר: אם כותרת השיחה הפתוחה כבר השם — לא עושים כלום; אחרת שורת הצ'אט
+# שנמצאה קודם ברשימה (מטמון לכל סשן), השורה ברשימה, ורק בסוף החיפוש.
+NAV_CACHE_MAX = 64
+NAV_TIMEOUT = 10.0
+NAV_LATENCY_WINDOW = 200
+
+_JS_HEADER_TITLE = r"""
+const headerTitle = () => {
+  const h = document.querySelector('#main header');
+  if (!h) return null;
+  const t = h.querySelector('span[title]');
+  if (t && t.getAttribute('title')) return t.getAttribute('title');
+  const d = h.querySelector('span[dir="auto"]');
+  return d ? d.innerText : null;
+};
+"""
+
+# שם השיחה הפתוחה לפי הכותרת (#main header), או null
+_CHAT_HEADER_JS = _JS_HEADER_TITLE + "return headerTitle();\n"
+
+# ממתין שכותרת השיחה הפתוחה תהיה השם
+_WAIT_HEADER_JS = _JS_HEADER_TITLE + _js_wait_until("const cond = name => headerTitle() === name;\n")
+
+# שורה שנשמרה במטמון עדיין בדף ועדיין של אותו צ'אט (הרשימה וירטואלית — אלמנטים ממוחזרים)
+_NAV_ROW_VALID_JS = "const el = arguments[0]; return el.isConnected && el.getAttribute('title') === arguments[1];"
+
+class ChatNavigator:
+    """
+    פתיחת צ'אטים בסשן אחד: open(name) מחזיר את הדרך שבה הצ'אט נפתח — already-open / cache / list / search —
+    ומודד כל מעבר. שורות רשימה שנמצאו נשמרות במטמון (עד NAV_CACHE_MAX) ונבדקות לפני שימוש.
+    """
+    def __init__(self, drv, max_cached: int = NAV_CACHE_MAX):
+        self.drv = drv
+        self.max_cached = max_cached
+        self._rows: "OrderedDict[str, object]" = OrderedDict()
+        self.counts: Counter = Counter()
+        self._ms: dict = {}
+
+    def current(self) -> str | None:
+        """שם השיחה הפתוחה (מהכותרת)."""
+        try:
+            return self.drv.execute_script(_CHAT_HEADER_JS)
+        except Exception:
+            return None
+
+    def open(self, name: str) -> str:
+        t0 = time.perf_counter()
+        path = self._open(name)
+        self.counts[path] += 1
+        self._ms.setdefault(path, deque(maxlen=NAV_LATENCY_WINDOW)).append((time.perf_counter() - t0) * 1000.0)
+        return path
+
+    def _open(self, name: str) -> str:
+        if self.current() == name:
+            return "already-open"
+        row = self._rows.pop(name, None)
+        if row is not None:
+            try:
+                if self.drv.execute_script(_NAV_ROW_VALID_JS, row, name):
+                    row.click()
+                    if self._wait_header(name):
+                        self._remember(name, row)
+                        return "cache"
+            except Exception:
+                pass       # השורה כבר לא בדף
+        rows = self.drv.find_elements(By.XPATH, CHAT_LIST_ITEM % xpath_literal(name))
+        if rows:
+            rows[0].click()
+            if self._wait_header(name):
+                self._remember(name, rows[0])
+                return "list"
+        open_chat(self.drv, name)
+        if not self._wait_header(name):
+            # כותרת בפורמט לא מוכר — מספיק שתיבת ההקלדה מוכנה (כמו קודם)
+            WebDriverWait(self.drv, NAV_TIMEOUT).until(EC.element_to_be_clickable((By.XPATH, MSG_AREA)))
+        return "search"
+
+    def _wait_header(self, name: str, timeout: float = NAV_TIMEOUT) -> bool:
+        return wait_in_page(self.drv, _WAIT_HEADER_JS, timeout, name)
+
+    def _remember(self, name: str, row):
+        self._rows[name] = row
+        while len(self._rows) > self.max_cached:
+            self._rows.popitem(last=False)
+
+    def forget(self):
+        """ניקוי המטמון (למשל אחרי טעינה מחדש של הדף)."""
+        self._rows.clear()
+
+    def stats(self) -> dict:
+        """דרך -> {n, avg_ms, max_ms}."""
+        out = {}
+        for path, ms in self._ms.items():
+            if ms:
+                out[path] = {"n": self.counts[path], "avg_ms": sum(ms) / len(ms), "max_ms": max(ms)}
+        return out
+
+# ---------- Chat transport ----------
+# הבוט והמתזמן מדברים עם WhatsApp דרך ChatTransport: SeleniumTransport עוטף את עזרי Selenium שלמעלה,
+# ו-FakeTransport מדמה קבוצות בזיכרון — כך שאפשר למדוד את לולאת הבוט כולה בלי Chrome ובלי טלפון.
+class ChatTransport(ABC):
+    """
+    ממשק הצ'אט: חיבור, מעבר בין צ'אטים, קריאת הודעות נכנסות, שליחה ואישור שליחה.
+    המתודות בטוחות לקריאה מכמה threads (הבוט קורא בזמן ש-SenderThread שולח); current_chat — הצ'אט הפתוח.
+    מתודות ה-abstractmethod חובה: transport שחסרה לו אחת מהן נכשל כבר ביצירה, לא באמצע ריצת בוט.
+    """
+    name = "base"
+    current_chat = None
+
+    @abstractmethod
+    def connect(self, on_status=None):
+        """פותח סשן ומחכה להתחברות."""
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def open_chat(self, name: str, from_list: bool = False):
+        """פותח צ'אט (from_list: רמז שהצ'אט מוצג ברשימת הצ'אטים; ב-Selenium הניווט בודק אותה ממילא)."""
+
+    @abstractmethod
+    def wait_chat_selected(self, timeout: float) -> bool:
+        """ממתין שהמשתמש/ת יבחר/תבחר צ'אט ידנית (מצב בחירה חופשית)."""
+
+    @abstractmethod
+    def read_incoming(self, limit: int = RECENT_ROWS_LIMIT) -> List[dict]:
+        """ההודעות הנכנסות האחרונות בצ'אט הפתוח (ישנה -> חדשה), בפורמט של dom_snapshot."""
+
+    @abstractmethod
+    def start_watch(self, max_wait: float) -> bool:
+        """מתחיל האזנה בדחיפה להודעות חדשות בצ'אט הפתוח; False אם לא נתמך (עובדים בפולינג)."""
+
+    @abstractmethod
+    def watch(self, timeout: float) -> List[dict] | None:
+        """
+        הודעות נכנסות חדשות מאז הקריאה הקודמת; חוזר מוקדם כשמגיעה הודעה.
+        None — ההאזנה הותקנה מחדש (#main הוחלף): מה שהגיע בינתיים צריך לקרוא ב-read_incoming.
+        """
+
+    @abstractmethod
+    def unread_chats(self) -> dict:
+        """{שם צ'אט: מספר הודעות שלא נקראו}."""
+
+    @abstractmethod
+    def last_outgoing_id(self) -> str | None:
+        """ה-data-id של ההודעה היוצאת האחרונה בצ'אט הפתוח, או None."""
+
+    @abstractmethod
+    def send(self, text: str):
+        """שולח הודעה לצ'אט הפתוח (בלי לחכות לאישור)."""
+
+    @abstractmethod
+    def confirm(self, text: str, after_id: str | None, timeout: float = 20.0) -> bool:
+        """True כשההודעה היוצאת האחרונה היא text ושונה מ-after_id."""
+
+    def wait_outgoing_flushed(self, timeout: float = 5.0) -> bool:
+        """ממתין שההודעות היוצאות יעזבו את תור השליחה של הצ'אט (לפני close)."""
+        return True
+
+    @abstractmethod
+    def outgoing_status(self, limit: int = RECENT_ROWS_LIMIT) -> List[dict]:
+        """ההודעות היוצאות האחרונות בצ'אט הפתוח: [{id, text, status}] (pending/sent/delivered)."""
+
+    def healthy(self) -> bool:
+        """החיבור חי ומחובר ל-WhatsApp (בדיקה זולה לפני שימוש חוזר)."""
+        return True
+
+    def probe(self) -> dict | None:
+        """מצב הדף: {pane, main, qr, offline}; None = הדפדפן לא עונה."""
+        return {"pane": True, "main": True, "qr": False, "offline": False}
+
+    def recover(self, kind: str, attempt: int = 0):
+        """מתקן את הסשן לפי סוג הכשל (classify_failure); זורק חריגה אם עדיין לא תקין."""
+        self.current_chat = None
+
+    def take_round_trips(self) -> int:
+        """מספר הפניות לצד השני מאז הקריאה הקודמת."""
+        return 0
+
+    def memory(self) -> dict | None:
+        """{rss_mb, processes} של הדפדפן, או None אם אין דפדפן למדוד."""
+        return None
+
+    def browser_pid(self) -> int | None:
+        """PID של שורש עץ התהליכים של הדפדפן (chromedriver), או None."""
+        return None
+
+class SeleniumTransport(ChatTransport):
+    """WhatsApp Web דרך Selenium/Chrome, עם פרופיל Chrome נתון."""
+    name = "selenium"
+
+    def __init__(self, start_maximized: bool = True, profile_dir: Path = PROFILE_DIR, login_timeout: int = 120,
+                 fast_insert: bool = True, latency_budget_ms: dict | None = None, lean: bool = False,
+                 headless_after_login: bool = False, detach: bool = True):
+        self.start_maximized = start_maximized
+        self.profile_dir = Path(profile_dir)
+        self.detach = detach
+        self.login_timeout = login_timeout
+        self.lean = lean
+        self.headless_after_login = headless_after_login
+        self.headless = False
+        self.fast_insert = fast_insert
+        self.budget = LatencyBudget(latency_budget_ms)
+        self.insert_stats: Counter = Counter()   # {'insertText'/'paste'/'send_keys': מספר שליחות}
+        self.driver = None
+        self.current_chat = None
+        self.nav: ChatNavigator | None = None
+        self._observer: MessageObserver | None = None
+        self._round_trips: RoundTripCounter | None = None
+        # WebDriver אינו בטוח ל-threads: כל פקודה רצה תחת המנעול
+        self.lock = threading.RLock()
+
+    @property
+    def browser_mode(self) -> str:
+        if not self.lean:
+            return "default"
+        return "lean-headless" if self.headless else "lean"
+
+    def _build(self, headless: bool = False):
+        self.headless = headless
+        return build_driver(start_maximized=self.start_maximized, profile_dir=self.profile_dir, lean=self.lean,
+                            headless=headless, detach=self.detach)
+
+    def connect(self, on_status=None):
+        if on_status:
+            self.budget.on_status = on_status
+        if not (self.headless_after_login and self._connect_headless(on_status)):
+            self.driver = self._build()
+            self.driver.get(WHATSAPP_URL)
+            if on_status:
+                on_status("ממתין/ה להתחברות…")
+            wait_for_login(self.driver, sec=self.login_timeout)
+        self._round_trips = RoundTripCounter(self.driver)
+        self.nav = ChatNavigator(self.driver)
+
+    def _connect_headless(self, on_status=None) -> bool:
+        """
+        פרופיל שכבר מחובר נפתח בלי חלון. אם WhatsApp מציג קוד QR (הפרופיל עוד לא נסרק או התנתק) —
+        Chrome הזה נסגר ו-False: החיבור ממשיך בחלון רגיל, והריצה הבאה כבר תהיה headless.
+        """
+        drv = self._build(headless=True)
+        try:
+            drv.get(WHATSAPP_URL)
+            state = WebDriverWait(drv, self.login_timeout).until(lambda d: d.execute_script(_LOGIN_STATE_JS))
+        except Exception:
+            state = None
+        if state == "ready":
+            self.driver = drv
+            if on_status:
+                on_status("WhatsApp Web מחובר — Chrome רץ ברקע בלי חלון.")
+            return True
+        try:
+            drv.quit()
+        except Exception:
+            pass
+        self.headless = False
+        if on_status:
+            on_status("נדרשת סריקת QR — פותח חלון Chrome רגיל.")
+        return False
+
+    def close(self):
+        with self.lock:
+            try:
+                if self.driver is not None:
+                    self.driver.quit()
+            except Exception:
+                pass
+            self.driver = None
+
+    def open_chat(self, name: str, from_list: bool = False):
+        with self.lock:
+            t0 = time.perf_counter()
+            self.nav.open(name)
+            self.current_chat = name
+            self.budget.record("open", t0)
+
+    def wait_chat_selected(self, timeout: float) -> bool:
+        try:
+            WebDriverWait(self.driver, timeout).until(EC.element_to_be_clickable((By.XPATH, MSG_AREA)))
+            return True
+        except Exception:
+            return False
+
+    def read_incoming(self, limit: int = RECENT_ROWS_LIMIT) -> List[dict]:
+        with self.lock:
+            return recent_incoming(self.driver, limit)
+
+    def start_watch(self, max_wait: float) -> bool:
+        with self.lock:
+            observer = MessageObserver(self.driver)
+            # ההמתנה בדפדפן נמשכת עד max_wait
+            self.driver.set_script_timeout(int(max_wait) + 10)
+            observer.install()   # אם #main עוד לא נטען — יותקן בריקון הבא
+            self._observer = observer
+        return True
+
+    def watch(self, timeout: float) -> List[dict] | None:
+        with self.lock:
+            return self._observer.wait(timeout)
+
+    def unread_chats(self) -> dict:
+        with self.lock:
+            return unread_chats(self.driver)
+
+    def last_outgoing_id(self) -> str | None:
+        with self.lock:
+            return last_outgoing_id(self.driver)
+
+    def send(self, text: str):
+        with self.lock:
+            t0 = time.perf_counter()
+            box = WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.XPATH, MSG_AREA)))
+            if not wait_in_page(self.driver, _COMPOSER_READY_JS, COMPOSER_READY_TIMEOUT, box):
+                self._abort_send(box, "ready", t0, "תיבת ההקלדה לא הייתה מוכנה")
+            self.budget.record("ready", t0)
+            t0 = time.perf_counter()
+            method = insert_text(self.driver, box, text) if self.fast_insert else None
+            if not method:
+                method = "send_keys"
+                box.send_keys(text)
+            if not wait_in_page(self.driver, _SEND_ENABLED_JS, SEND_ENABLED_TIMEOUT, box):
+                self._abort_send(box, "insert", t0, "כפתור השליחה לא הופעל")
+            self.budget.record("insert", t0)
+            t0 = time.perf_counter()
+            box.send_keys(Keys.ENTER)
+            self.budget.record("send", t0)
+            self.insert_stats[method] += 1
+
+    def _abort_send(self, box, stage: str, started: float, reason: str):
+        """ההמתנה לפני Enter נכשלה: לא שולחים, מרוקנים את התיבה (שהטקסט לא יישאר בה) וזורקים."""
+        self.budget.fail(stage, started)
+        try:
+            clear_text(self.driver, box)
+        except Exception:
+            pass
+        raise TimeoutException(f"{reason} — ההודעה לא נשלחה")
+
+    def confirm(self, text: str, after_id: str | None, timeout: float = 20.0) -> bool:
+        t0 = time.perf_counter()
+        ok = wait_for_sent(self.driver, text, after_id, timeout=timeout, lock=self.lock)
+        self.budget.record("confirm", t0)
+        return ok
+
+    def wait_outgoing_flushed(self, timeout: float = 5.0) -> bool:
+        t0 = time.perf_counter()
+        ok = wait_in_page(self.driver, _OUTGOING_FLUSHED_JS, timeout, lock=self.lock)
+        self.budget.record("flush", t0)
+        return ok
+
+    def outgoing_status(self, limit: int = RECENT_ROWS_LIMIT) -> List[dict]:
+        with self.lock:
+            return outgoing_status(self.driver, limit)
+
+    def healthy(self) -> bool:
+        if self.driver is None:
+            return False
+        try:
+            with self.lock:
+                # רשימת הצ'אטים מוצגת רק כשהדפדפן חי ו-WhatsApp מחובר (לא מסך QR)
+                return bool(self.driver.execute_script("return !!document.querySelector('#pane-side');"))
+        except Exception:
+            return False
+
+    def probe(self) -> dict | None:
+        if self.driver is None:
+            return None
+        with self.lock:
+            try:
+                return self.driver.execute_script(_SESSION_PROBE_JS) or {}
+            except Exception:
+                pass
+            try:
+                self.driver.current_url      # הדפדפן עונה — הדף באמצע טעינה
+                return {}
+            except Exception:
+                return None
+
+    def recover(self, kind: str, attempt: int = 0):
+        with self.lock:
+            self.current_chat = None
+            self._observer = None
+            if self.nav is not None:
+                self.nav.forget()
+            # התנתקות בלי חלון: פותחים Chrome רגיל כדי שאפשר יהיה לסרוק את ה-QR
+            if kind == "dead-session" or (kind == "logged-out" and self.headless):
+                try:
+                    if self.driver is not None:
+                        self.driver.quit()
+                except Exception:
+                    pass
+                self.driver = self._build(headless=self.headless and kind == "dead-session")
+                self.driver.get(WHATSAPP_URL)
+                self._round_trips = RoundTripCounter(self.driver)
+                self.nav = ChatNavigator(self.driver)
+            elif kind in ("stale-dom", "network") and attempt >= 1:
+                # ניסיון ראשון — רק פתיחה מחדש של הצ'אט; אם זה לא הספיק, טעינה מחדש של הדף
+                self.driver.get(WHATSAPP_URL)
+            # logged-out: מחכים לסריקת QR בחלון הפתוח (בלי חלון הודעה — הבוט רץ בלי השגחה)
+            wait = self.login_timeout if kind in ("dead-session", "logged-out") or attempt >= 1 else 10
+            WebDriverWait(self.driver, wait).until(EC.presence_of_element_located((By.XPATH, SEARCH_BOX)))
+
+    def take_round_trips(self) -> int:
+        with self.lock:
+            return self._round_trips.take() if self._round_trips is not None else 0
+
+    def memory(self) -> dict | None:
+        # בלי המנעול: רק טבלת התהליכים של מערכת ההפעלה, לא פקודת WebDriver
+        pid = self.browser_pid()
+        return process_tree_rss(pid) if pid is not None else None
+
+    def browser_pid(self) -> int | None:
+        proc = getattr(getattr(self.driver, "service", None), "process", None)
+        return proc.pid if proc is not None else None
+
+class FakeTransport(ChatTransport):
+    """
+    WhatsApp מדומה בזיכרון: קבוצות, הודעות נכנסות (push/burst), תגי "לא נקרא" והשהיית שליחה/ניווט.
+    sent מתעד כל שליחה: (צ'אט, טקסט, time.monotonic()); pushed_at — מתי כל הודעה נכנסת נוצרה.
+    """
+    name = "fake"
+
+    def __init__(self, groups=("test",), send_latency: float = 0.0, open_latency: float = 0.0,
+                 read_latency: float = 0.0):
+        self.chats = {g: [] for g in groups}
+        self.unread: Counter = Counter()
+        self.send_latency = send_latency
+        self.open_latency = open_latency
+        self.read_latency = read_latency
+        self.current_chat = None
+        self.sent: List[tuple] = []
+        self.ack_status = "delivered"   # הסטטוס שמדווח לכל הודעה יוצאת (outgoing_status)
+        self.pushed_at: dict = {}
+        self.round_trips = 0
+        self.reads = 0               # קריאות הודעות שהושלמו (read_incoming/watch/unread_chats)
+        self._seq = 0
+        self._watch_pos: int | None = None
+        self._main_swapped = False
+        self.main_swaps = 0
+        self._cond = threading.Condition()
+
+    def _row(self, direction: str, text: str, sender: str) -> dict:
+        self._seq += 1
+        return {"id": f"{'true' if direction == 'out' else 'false'}_{self._seq}", "direction": direction,
+                "text": text, "sender": sender, "time": "", "seen_at": time.time() * 1000.0}
+
+    def push(self, chat: str, text: str, sender: str = "לקוח") -> str:
+        """הודעה נכנסת חדשה ב-chat; מחזיר את המזהה שלה."""
+        with self._cond:
+            row = self._row("in", text, sender)
+            self.chats.setdefault(chat, []).append(row)
+            self.pushed_at[row["id"]] = time.monotonic()
+            if chat != self.current_chat:
+                self.unread[chat] += 1
+            self._cond.notify_all()
+            return row["id"]
+
+    def swap_main(self):
+        """כמו החלפת #main בדף: ההאזנה הבאה מותקנת מחדש, ומה שלא רוקן עד עכשיו לא ידווח ב-watch."""
+        with self._cond:
+            self._main_swapped = True
+            self.main_swaps += 1
+            self._cond.notify_all()
+
+    def burst(self, chat: str, texts, interval: float = 0.0) -> List[str]:
+        ids = []
+        for text in texts:
+            ids.append(self.push(chat, text))
+            if interval:
+                time.sleep(interval)
+        return ids
+
+    def connect(self, on_status=None):
+        pass
+
+    def open_chat(self, name: str, from_list: bool = False):
+        if self.open_latency:
+            time.sleep(self.open_latency)
+        with self._cond:
+            self.round_trips += 1
+            self.chats.setdefault(name, [])
+            self.current_chat = name
+            self.unread[name] = 0
+            self._watch_pos = None
+
+    def wait_chat_selected(self, timeout: float) -> bool:
+        if self.current_chat is None and self.chats:
+            self.open_chat(next(iter(self.chats)))
+        return self.current_chat is not None
+
+    def read_incoming(self, limit: int = RECENT_ROWS_LIMIT) -> List[dict]:
+        if self.read_latency:
+            time.sleep(self.read_latency)
+        with self._cond:
+            self.round_trips += 1
+            self.reads += 1
+            rows = [r for r in self.chats.get(self.current_chat, []) if r["direction"] == "in"]
+            return [dict(r) for r in rows[-limit:]]
+
+    def start_watch(self, max_wait: float) -> bool:
+        with self._cond:
+            # כמו התקנת Observer: מה שכבר בצ'אט נחשב כנראה
+            self._watch_pos = len(self.chats.get(self.current_chat, []))
+        return True
+
+    def watch(self, timeout: float) -> List[dict] | None:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.round_trips += 1
+            rows = self.chats.get(self.current_chat, [])
+            if self._main_swapped:
+                self._main_swapped = False
+                self._watch_pos = len(rows)
+                return None
+            if self._watch_pos is None:
+                # כמו Observer שהותקן עכשיו: ההיסטוריה כבר נראתה
+                self._watch_pos = len(rows)
+            self.reads += 1
+            while len(rows) <= self._watch_pos and not self._main_swapped:
+                left = deadline - time.monotonic()
+                if left <= 0 or not self._cond.wait(left):
+                    break
+                rows = self.chats.get(self.current_chat, [])
+            new = rows[self._watch_pos:]
+            self._watch_pos = len(rows)
+            return [dict(r) for r in new if r["direction"] == "in"]
+
+    def unread_chats(self) -> dict:
+        with self._cond:
+            self.round_trips += 1
+            self.reads += 1
+            return {c: n for c, n in self.unread.items() if n}
+
+    def last_outgoing_id(self) -> str | None:
+        with self._cond:
+            self.round_trips += 1
+            out = [r for r in self.chats.get(self.current_chat, []) if r["direction"] == "out"]
+            return out[-1]["id"] if out else None
+
+    def send(self, text: str):
+        if self.send_latency:
+            time.sleep(self.send_latency)
+        with self._cond:
+            self.round_trips += 1
+            self.chats.setdefault(self.current_chat, []).append(self._row("out", text, "בוט"))
+            self.sent.append((self.current_chat, text, time.monotonic()))
+            self._cond.notify_all()
+
+    def confirm(self, text: str, after_id: str | None, timeout: float = 20.0) -> bool:
+        with self._cond:
+            out = [r for r in self.chats.get(self.current_chat, []) if r["direction"] == "out"]
+            return bool(out) and out[-1]["id"] != after_id and _norm_sent_text(out[-1]["text"]) == _norm_sent_text(text)
+
+    def outgoing_status(self, limit: int = RECENT_ROWS_LIMIT) -> List[dict]:
+        with self._cond:
+            self.round_trips += 1
+            out = [r for r in self.chats.get(self.current_chat, []) if r["direction"] == "out"]
+            return [{"id": r["id"], "text": r["text"], "status": self.ack_status} for r in out[-limit:]]
+
+    def take_round_trips(self) -> int:
+        with self._cond:
+            n, self.round_trips = self.round_trips, 0
+            return n
+
+# ---------- Session pool (warm scheduler session) ----------
+# פתיחת Chrome, טעינת WhatsApp Web וחיבור לוקחים 10–30 שניות. המתזמן ו"שלח עכשיו" שואלים session
+# מהבריכה ומחזירים אותו: הוא נשאר פתוח ומחובר, נבדק לפני כל שימוש, ונסגר רק אחרי idle_timeout בלי שימוש.
+DEFAULT_SESSION_IDLE_SEC = 600     # 0 = סגירה אחרי כל שימוש
+SESSION_ACQUIRE_TIMEOUT = 120.0
+
+class SessionPool:
+    """
+    session אחד חם (ChatTransport מחובר) לשימוש חוזר. factory() בונה transport חדש (לא מחובר);
+    acquire() מחזיר את ה-session הקיים אם עבר בדיקת תקינות, אחרת סוגר ובונה חדש. בכל רגע משתמש אחד.
+    """
+    def __init__(self, factory, idle_timeout: float = DEFAULT_SESSION_IDLE_SEC):
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self._session: ChatTransport | None = None
+        self._leased = False
+        self._last_used = 0.0
+        self._reaper: threading.Thread | None = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self.created = 0
+        self.reused = 0
+        self.health_failures = 0
+
+    def acquire(self, on_status=None, timeout: float = SESSION_ACQUIRE_TIMEOUT) -> ChatTransport:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._leased:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError("ה-session של המתזמן תפוס")
+                self._cond.wait(left)
+            self._leased = True
+            session, self._session = self._session, None
+        try:
+            if session is not None and not session.healthy():
+                self.health_failures += 1
+                self._discard(session)
+                session = None
+            if session is None:
+                session = self.factory()
+                session.connect(on_status)
+                self.created += 1
+            else:
+                self.reused += 1
+        except Exception:
+            if session is not None:
+                self._discard(session)
+            with self._cond:
+                self._leased = False
+                self._cond.notify_all()
+            raise
+        return session
+
+    def release(self, session: ChatTransport):
+        """מחזיר את ה-session לבריכה (נסגר מיד אם idle_timeout <= 0)."""
+        with self._cond:
+            self._leased = False
+            self._last_used = time.monotonic()
+            keep = self.idle_timeout > 0 and not self._closed
+            if keep:
+                self._session = session
+                if self._reaper is None or not self._reaper.is_alive():
+                    self._reaper = threading.Thread(target=self._reap, daemon=True)
+                    self._reaper.start()
+            self._cond.notify_all()
+        if not keep:
+            self._discard(session)
+
+    def close(self):
+        """סוגר את ה-session הפנוי; session שמושאל כרגע ייסגר כשיוחזר."""
+        with self._cond:
+            self._closed = True
+            session, self._session = self._session, None
+            self._cond.notify_all()
+        if session is not None:
+            self._discard(session)
+
+    def _reap(self):
+        while True:
+            with self._cond:
+                if self._session is None:
+                    return
+                idle = time.monotonic() - self._last_used
+                if idle < self.idle_timeout:
+                    self._cond.wait(self.idle_timeout - idle)
+                    continue
+                session, self._session = self._session, None
+            self._discard(session)
+            return
+
+    @staticmethod
+    def _discard(session: ChatTransport):
+        try:
+            session.wait_outgoing_flushed()   # ההודעה האחרונה יצאה לפני סגירת הדפדפן
+        except Exception:
+            pass
+        session.close()
+
+# ---------- Session watchdog ----------
+# כשקריאה נכשלת מסווגים את מצב הדף ומתקנים בהתאם, עם backoff מעריכי עד שהסשן חוזר:
+#   dead-session — הדפדפן לא עונה (Chrome קרס/נסגר): דרייבר חדש באותו פרופיל;
+#   logged-out   — מסך QR: ממתינים לסריקה;
+#   network      — באנר "אין חיבור": ממתינים, ואחר כך טוענים את הדף מחדש;
+#   stale-dom    — הדף חי אבל השתנה (טעינה מחדש, שיחה הוחלפה): פותחים את הצ'אט מחדש, ואחר כך טוענים.
+WATCHDOG_BACKOFF_BASE = 1.0
+DEFAULT_WATCHDOG_BACKOFF_MAX = 120.0
+WATCHDOG_HISTORY = 100
+
+_SESSION_PROBE_JS = r"""
+const q = s => document.querySelector(s);
+return {
+  pane: !!q('#pane-side'),
+  main: !!q('#main'),
+  qr: !!q('div[data-ref], canvas[aria-label*="QR" i], canvas[aria-label*="scan" i]'),
+  offline: !navigator.onLine || !!q('[data-icon="alert-computer"], [data-icon="alert-phone"], [data-icon="alert-offline"]')
+};
+"""
+
+_LOGIN_STATE_JS = r"""
+if (document.querySelector('#pane-side')) return 'ready';
+if (document.querySelector('div[data-ref], canvas[aria-label*="QR" i], canvas[aria-label*="scan" i]')) return 'qr';
+return null;
+"""
+
+def classify_failure(probe: dict | None) -> str:
+    """סוג הכשל לפי probe() של ה-transport."""
+    if probe is None:
+        return "dead-session"
+    if probe.get("qr") and not probe.get("pane"):
+        return "logged-out"
+    if probe.get("offline"):
+        return "network"
+    return "stale-dom"
+
+class SessionWatchdog:
+    """
+    התאוששות של סשן: recover() מסווג את הכשל, מתקן דרך transport.recover וקורא ל-resume (פתיחת הצ'אט
+    והמשך מהמזהה האחרון) — שוב ושוב עם backoff מעריכי עד שהצליח או שהבוט נעצר. נרשמים מספר
+    ההתאוששויות מכל סוג, הניסיונות שנכשלו ומשך כל התאוששות.
+    """
+    def __init__(self, transport: ChatTransport, on_status, base: float = WATCHDOG_BACKOFF_BASE,
+                 max_delay: float = DEFAULT_WATCHDOG_BACKOFF_MAX):
+        self.transport = transport
+        self.on_status = on_status
+        self.base = base
+        self.max_delay = max(base, max_delay)
+        self.by_kind: Counter = Counter()
+        self.recoveries = 0
+        self.failed_attempts = 0
+        self._durations = deque(maxlen=WATCHDOG_HISTORY)
+
+    def classify(self) -> str:
+        try:
+            return classify_failure(self.transport.probe())
+        except Exception:
+            return "dead-session"
+
+    def recover(self, error, stop_event: threading.Event, resume) -> bool:
+        t0 = time.monotonic()
+        kind = self.classify()
+        self.on_status(f"תקלה בסשן ({kind}): {error}. מנסה להתאושש…")
+        if kind == "logged-out":
+            self.on_status("WhatsApp Web התנתק — סרוק/י את קוד ה-QR בכרום הפתוח.")
+        attempt, delay = 0, self.base
+        while not stop_event.is_set():
+            try:
+                self.transport.recover(kind, attempt)
+                resume()
+            except Exception as e:
+                self.failed_attempts += 1
+                attempt += 1
+                kind = self.classify()
+                self.on_status(f"ניסיון התאוששות {attempt} נכשל ({kind}): {e}. ניסיון נוסף בעוד {delay:.0f} שניות.")
+                if stop_event.wait(delay):
+                    break
+                delay = min(self.max_delay, delay * 2)
+                continue
+            took = time.monotonic() - t0
+            self.recoveries += 1
+            self.by_kind[kind] += 1
+            self._durations.append(took)
+            self.on_status(f"הסשן חזר לפעול ({kind}) אחרי {took:.1f} שניות.")
+            return True
+        return False
+
+    def stats(self) -> dict:
+        d = list(self._durations)
+        return {"recoveries": self.recoveries, "failed_attempts": self.failed_attempts, "by_kind": dict(self.by_kind),
+                "avg_sec": sum(d) / len(d) if d else 0.0, "max_sec": max(d, default=0.0)}
+
+# ---------- Chrome memory ----------
+# RSS של כל עץ התהליכים של Chrome (chromedriver, הדפדפן וכל ה-renderers), נדגם מדי פעם לקובץ JSONL —
+# כדי להשוות ריצה ארוכה במצב lean מול ברירת המחדל (--memory-report).
+MEMORY_LOG_PATH = Path("chrome_memory.jsonl")
+DEFAULT_MEMORY_SAMPLE_SEC = 300
+MEMORY_GROWTH_MIN_H = 0.25      # מתחת לזה אין מספיק דגימות כדי להעריך גדילה לשעה
+
+@functools.lru_cache(maxsize=None)
+def _psutil_module():
+    """psutil אם מותקן (תלות אופציונלית), אחרת None."""
+    try:
+        import psutil  # type: ignore
+        return psutil
+    except Exception:
+        return None
+
+def _process_table() -> dict:
+    """{pid: (ppid, rss בבתים)} לכל התהליכים: psutil, אחרת ‎/proc (Linux) או PowerShell (Windows)."""
+    psutil = _psutil_module()
+    table = {}
+    if psutil is not None:
+        for p in psutil.process_iter(["pid", "ppid", "memory_info"]):
+            mi = p.info.get("memory_info")
+            table[p.info["pid"]] = (p.info.get("ppid"), mi.rss if mi is not None else 0)
+        return table
+    if os.path.isdir("/proc"):
+        page = os.sysconf("SC_PAGE_SIZE")
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat", encoding="utf-8", errors="replace") as f:
+                    stat = f.read()
+            except OSError:
+                continue
+            fields = stat[stat.rfind(")") + 2:].split()   # אחרי שם התהליך: state, ppid, ..., rss (בדפים)
+            table[int(name)] = (int(fields[1]), int(fields[21]) * page)
+        return table
+    if os.name == "nt":
+        out = subprocess.run(["powershell", "-NoProfile", "-Command",
+                              "Get-CimInstance Win32_Process | Select-Object ProcessId,ParentProcessId,WorkingSetSize"
+                              " | ConvertTo-Json -Compress"],
+                             capture_output=True, text=True, timeout=60,
+                             creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)).stdout
+        rows = json.loads(out) if out.strip() else []
+        for r in rows if isinstance(rows, list) else [rows]:
+            table[int(r["ProcessId"])] = (r["ParentProcessId"], int(r["WorkingSetSize"] or 0))
+    return table
+
+def _process_tree(table: dict, roots) -> set:
+    """roots (שקיימים בטבלה) וכל צאצאיהם."""
+    children = {}
+    for pid, (ppid, _rss) in table.items():
+        children.setdefault(ppid, []).append(pid)
+    tree, stack = set(), [p for p in roots if p in table]
+    while stack:
+        pid = stack.pop()
+        if pid not in tree:
+            tree.add(pid)
+            stack.extend(children.get(pid, ()))
+    return tree
+
+def process_tree_rss(root_pid: int) -> dict | None:
+    """{rss_mb, processes} של root_pid וכל צאצאיו; None אם התהליך לא קיים או שאין דרך למדוד."""
+    try:
+        table = _process_table()
+    except Exception:
+        return None
+    if root_pid not in table:
+        return None
+    tree = _process_tree(table, [root_pid])
+    return {"rss_mb": sum(table[p][1] for p in tree) / 2**20, "processes": len(tree)}
+
+def kill_process_trees(pids) -> int:
+    """הורג את התהליכים שב-pids (אלה שעדיין קיימים) ואת כל צאצאיהם; מחזיר כמה נהרגו."""
+    try:
+        table = _process_table()
+    except Exception:
+        table = {p: (None, 0) for p in pids}
+    tree = _process_tree(table, pids)
+    psutil = _psutil_module()
+    killed = 0
+    for pid in tree:
+        try:
+            if psutil is not None:
+                psutil.Process(pid).kill()
+            else:
+                os.kill(pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+            killed += 1
+        except Exception:
+            pass
+    return killed
+
+class MemoryMonitor(threading.Thread):
+    """
+    דוגם כל interval שניות את transport.memory() ומוסיף שורה ל-path:
+    {run, mode, label, ts, uptime_h, rss_mb, processes}. mode = lean / lean-headless / default.
+    """
+    def __init__(self, transport: ChatTransport, label: str = "", interval: float = DEFAULT_MEMORY_SAMPLE_SEC,
+                 path: Path = MEMORY_LOG_PATH):
+        super().__init__(daemon=True)
+        self.transport = transport
+        self.label = label
+        self.interval = max(1.0, interval)
+        self.path = Path(path)
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.stop_event = threading.Event()
+        self._t0 = time.monotonic()
+        self._lock = threading.Lock()
+        self.first = self.last = None
+        self.peak_mb = 0.0
+        self.samples = 0
+
+    def sample(self) -> dict | None:
+        try:
+            m = self.transport.memory()
+        except Exception:
+            m = None
+        if not m:
+            return None
+        row = {"run": self.run_id, "mode": getattr(self.transport, "browser_mode", self.transport.name),
+               "label": self.label, "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "uptime_h": round((time.monotonic() - self._t0) / 3600, 4),
+               "rss_mb": round(m["rss_mb"], 1), "processes": m["processes"]}
+        with self._lock:
+            if self.first is None:
+                self.first = row
+            self.last = row
+            self.peak_mb = max(self.peak_mb, row["rss_mb"])
+            self.samples += 1
+            try:
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            except OSError:
+                pass
+        return row
+
+    def run(self):
+        self.sample()
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self.last is None:
+                return {}
+            return {"mode": self.last["mode"], "rss_mb": self.last["rss_mb"], "processes": self.last["processes"],
+                    "first_mb": self.first["rss_mb"], "peak_mb": self.peak_mb, "samples": self.samples,
+                    "growth_mb_per_h": _growth_per_hour(self.first, self.last)}
+
+def _growth_per_hour(first: dict, last: dict) -> float | None:
+    span = last["uptime_h"] - first["uptime_h"]
+    return (last["rss_mb"] - first["rss_mb"]) / span if span >= MEMORY_GROWTH_MIN_H else None
+
+def summarize_memory_log(path: Path = MEMORY_LOG_PATH) -> List[dict]:
+    """סיכום לכל ריצה בקובץ הדגימות: מצב, שעות, RSS בהתחלה/בסוף/בשיא/ממוצע וגדילה לשעה."""
+    runs = OrderedDict()
+    with Path(path).open(encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            runs.setdefault((row.get("run"), row.get("label", "")), []).append(row)
+    out = []
+    for (run, label), rows in runs.items():
+        rss = [r["rss_mb"] for r in rows]
+        out.append({"run": run, "label": label, "mode": rows[-1].get("mode", "?"), "samples": len(rows),
+                    "hours": rows[-1]["uptime_h"] - rows[0]["uptime_h"], "first_mb": rss[0], "last_mb": rss[-1],
+                    "peak_mb": max(rss), "avg_mb": sum(rss) / len(rss),
+                    "growth_mb_per_h": _growth_per_hour(rows[0], rows[-1])})
+    return out
+
+# ---------- Outgoing queue (sender thread) ----------
+# שליחה דרך תור ו-thread נפרד: הבוט ממשיך לקרוא הודעות בזמן שתגובה מוקלדת. לכל צ'אט דלי אסימונים
+# (קצב ופרץ), ותגובות חיות קודמות לשליחות מתוזמנות.
+PRIORITY_REPLY = 0
+PRIORITY_SCHEDULED = 1
+DEFAULT_SEND_RATE_PER_MIN = 20     # 0 = ללא הגבלה
+DEFAULT_SEND_BURST = 5
+SEND_LATENCY_WINDOW = 200
+SEND_YIELD_SEC = 0.05              # כשיש מה לשלוח, הבוט משחרר את הדרייבר בין הסבבים לפרק זמן כזה
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class TokenBucket:
+    """דלי אסימונים: rate אסימונים לשנייה, עד burst שמורים."""
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now: float | None = None) -> float:
+        """כמה שניות עד שיש אסימון (0 = אפשר לשלוח עכשיו)."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(time.monotonic() if now is None else now)
+        return 0.0 if self.tokens >= 1.0 else (1.0 - self.tokens) / self.rate
+
+    def take(self, now: float | None = None):
+        if self.rate > 0:
+            self._refill(time.monotonic() if now is None else now)
+            self.tokens -= 1.0
+
+class SenderThread(threading.Thread):
+    """
+    שולח את תור ההודעות היוצאות דרך ה-transport. הודעה נשלחת רק כשהצ'אט שלה פתוח (chat=None: הצ'אט הפתוח),
+    לפי עדיפות ואז לפי סדר הגעה, ובכפוף לדלי האסימונים של הצ'אט.
+    """
+    def __init__(self, transport: ChatTransport, on_status, rate_per_min: float = DEFAULT_SEND_RATE_PER_MIN,
+                 burst: int = DEFAULT_SEND_BURST):
+        super().__init__(daemon=True)
+        self.transport = transport
+        self.on_status = on_status
+        self.rate = max(0.0, float(rate_per_min)) / 60.0
+        self.burst = burst
+        self._buckets: dict = {}
+        self._pending: list = []          # [priority, seq, chat, text, enqueued_at, throttled]
+        self._in_flight = None
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._paused = False
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0                # כמה פעמים הודעה חיכתה לאסימון
+        self.max_depth = 0
+        self._latency = deque(maxlen=SEND_LATENCY_WINDOW)   # שניות מהכניסה לתור ועד סוף השליחה
+
+    def submit(self, chat, text: str, priority: int = PRIORITY_REPLY):
+        with self._cond:
+            self._seq += 1
+            self._pending.append([priority, self._seq, chat, text, time.monotonic(), False])
+            self.max_depth = max(self.max_depth, len(self._pending))
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def busy(self) -> bool:
+        with self._cond:
+            return bool(self._pending) or self._in_flight is not None
+
+    def pause(self):
+        """עוצר את השליחה עד resume (ממתין לסיום שליחה שכבר התחילה) — לפני מעבר זמני לצ'אט אחר."""
+        with self._cond:
+            self._paused = True
+            while self._in_flight is not None and not self._stopped:
+                self._cond.wait(0.2)
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+
+    def pending_chats(self) -> set:
+        """צ'אטים שיש להם הודעות בתור."""
+        with self._cond:
+            return {item[2] for item in self._pending}
+
+    def _bucket(self, chat) -> TokenBucket:
+        b = self._buckets.get(chat)
+        if b is None:
+            b = self._buckets[chat] = TokenBucket(self.rate, self.burst)
+        return b
+
+    def _eligible(self, item, current) -> bool:
+        return item[2] is None or item[2] == current
+
+    def flush(self, chat, timeout: float = 30.0) -> bool:
+        """
+        ממתין שכל מה שאפשר לשלוח עכשיו ל-chat יישלח (הודעות שמחכות לאסימון נשארות בתור).
+        נקרא לפני מעבר לצ'אט אחר; False אם פג הזמן.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                busy = (self._in_flight is not None and self._in_flight[2] in (chat, None)) or any(
+                    item[2] in (chat, None) and self._bucket(item[2]).wait_time(now) == 0 for item in self._pending)
+                if not busy or self._stopped or self._paused:
+                    return True
+                if now >= deadline:
+                    return False
+                self._cond.wait(min(0.2, deadline - now))
+
+    def _next(self):
+        """(הודעה לשליחה או None, כמה לחכות)."""
+        if self._paused:
+            return None, 1.0
+        now = time.monotonic()
+        current = self.transport.current_chat
+        wait = 1.0
+        for item in sorted(self._pending):
+            if not self._eligible(item, current):
+                wait = min(wait, 0.2)     # הצ'אט שלה ייפתח — בודקים שוב בקרוב
+                continue
+            w = self._bucket(item[2]).wait_time(now)
+            if w == 0:
+                return item, 0.0
+            if not item[5]:
+                item[5] = True
+                self.throttled += 1
+            wait = min(wait, w)
+        return None, wait
+
+    def run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    break
+                item, wait = self._next()
+                if item is None:
+                    self._cond.wait(wait)
+                    continue
+                self._pending.remove(item)
+                self._bucket(item[2]).take()
+                self._in_flight = item
+            try:
+                self.transport.send(item[3])
+                self.sent += 1
+                self.on_status(f"נשלחה תגובה: {item[3]}")
+            except Exception as e:
+                self.failed += 1
+                self.on_status(f"כשל בשליחה: {e}")
+            with self._cond:
+                self._latency.append(time.monotonic() - item[4])
+                self._in_flight = None
+                self._cond.notify_all()
+        with self._cond:
+            dropped = len(self._pending)
+            self._pending.clear()
+        if dropped:
+            self.on_status(f"{dropped} הודעות בתור השליחה לא נשלחו.")
+
+    def metrics(self) -> dict:
+        with self._cond:
+            lat = list(self._latency)
+            return {"queue_depth": len(self._pending) + (self._in_flight is not None),
+                    "max_depth": self.max_depth, "sent": self.sent, "failed": self.failed,
+                    "throttled": self.throttled,
+                    "send_latency_ms": {"p50": 1000 * _percentile(lat, 0.5), "p95": 1000 * _percentile(lat, 0.95)}}
+
+# ---------- Delivery acks ----------
+# אחרי שליחה לא ממתינים לבועה: ההודעה נרשמת בטבלת האישורים ומקבלת Future, וה-thread של הטבלה משייך
+# אותה לבועה שלה לפי data-id ועוקב אחרי הווי (pending -> sent -> delivered). השולח ממשיך מיד להודעה
+# הבאה; הודעה שלא נקלטה תוך timeout נכשלת.
+ACK_TIMEOUT_SEC = 20.0
+ACK_POLL_SEC = 0.25
+ACK_DELIVERY_WATCH_SEC = 30.0   # כמה זמן אחרי sent עוד עוקבים עד delivered
+ACK_TABLE_MAX = 500
+COMMAND_TIMEOUT_SEC = 120.0     # כמה זמן מחכים שהבוט יבצע פקודת שליחה (send_to)
+
+class AckTracker(threading.Thread):
+    """
+    טבלת אישורים לא חוסמת: track() מחזיר Future שמקבל True כשההודעה נקלטה בשרת (sent/delivered)
+    או False כשעבר timeout. הסטטוס נקרא מהצ'אט הפתוח בלבד — לפני מעבר צ'אט קוראים ל-wait_chat.
+    """
+    def __init__(self, transport: ChatTransport, timeout: float = ACK_TIMEOUT_SEC, poll: float = ACK_POLL_SEC):
+        super().__init__(daemon=True)
+        self.transport = transport
+        self.timeout = timeout
+        self.poll = poll
+        self.table: "OrderedDict[int, dict]" = OrderedDict()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self.acked = 0
+        self.timeouts = 0
+
+    def track(self, chat, text: str, after_id: str | None = None, timeout: float | None = None) -> Future:
+        """רושם הודעה שנשלחה ל-chat (after_id = ההודעה היוצאת האחרונה לפני השליחה)."""
+        fut: Future = Future()
+        now = time.monotonic()
+        with self._cond:
+            self._seq += 1
+            self.table[self._seq] = {"chat": chat, "text": text, "want": _norm_sent_text(text), "after_id": after_id,
+                                     "id": None, "status": "pending", "sent_at": now,
+                                     "deadline": now + (self.timeout if timeout is None else timeout), "future": fut}
+            for seq in [k for k, e in self.table.items() if e["future"].done()][:max(0, len(self.table) - ACK_TABLE_MAX)]:
+                del self.table[seq]
+            self._cond.notify_all()
+        return fut
+
+    def status(self, msg_id: str) -> str | None:
+        with self._cond:
+            for e in self.table.values():
+                if e["id"] == msg_id:
+                    return e["status"]
+        return None
+
+    def entries(self) -> List[dict]:
+        """עותק של הטבלה: {chat, text, id, status} (status: pending/sent/delivered/failed)."""
+        with self._cond:
+            return [{k: e[k] for k in ("chat", "text", "id", "status")} for e in self.table.values()]
+
+    def wait_chat(self, chat, timeout: float | None = None) -> bool:
+        """ממתין שכל ההודעות ל-chat יוכרעו (נקלטו או נכשלו)."""
+        with self._cond:
+            futs = [e["future"] for e in self.table.values() if e["chat"] == chat]
+        return not futures_wait(futs, timeout=timeout).not_done
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _watching(self, e: dict, now: float) -> bool:
+        if e["status"] == "failed" or e["status"] == "delivered":
+            return False
+        return not e["future"].done() or now - e["sent_at"] < ACK_DELIVERY_WATCH_SEC
+
+    def poll_once(self):
+        """קריאה אחת של הבועות היוצאות בצ'אט הפתוח; מעדכן סטטוסים ומכריע Futures."""
+        chat = self.transport.current_chat
+        with self._cond:
+            now = time.monotonic()
+            live = [e for e in self.table.values() if e["chat"] == chat and self._watching(e, now)]
+        try:
+            rows = self.transport.outgoing_status(RECENT_ROWS_LIMIT) if live else []
+        except Exception:
+            rows = []     # הדפדפן לא זמין — ההודעות ייכשלו בתום ה-timeout
+        resolved = []
+        with self._cond:
+            index = {r["id"]: i for i, r in enumerate(rows)}
+            claimed = {e["id"] for e in self.table.values() if e["id"]}
+            for e in live:
+                if e["id"] is None:
+                    # הבועה הראשונה שלא שויכה, אחרי after_id ועם אותו טקסט (הודעות זהות — לפי הסדר)
+                    for r in rows[index.get(e["after_id"], -1) + 1:]:
+                        if r["id"] not in claimed and _norm_sent_text(r["text"]) == e["want"]:
+                            e["id"] = r["id"]
+                            claimed.add(r["id"])
+                            break
+                if e["id"] in index:
+                    e["status"] = rows[index[e["id"]]]["status"]
+            now = time.monotonic()
+            for e in self.table.values():
+                if e["future"].done():
+                    continue
+                if e["id"] is not None and e["status"] in ("sent", "delivered"):
+                    self.acked += 1
+                    resolved.append((e["future"], True))
+                elif now >= e["deadline"]:
+                    e["status"] = "failed"
+                    self.timeouts += 1
+                    resolved.append((e["future"], False))
+        for fut, ok in resolved:
+            fut.set_result(ok)
+
+    def run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    break
+                now = time.monotonic()
+                if not any(self._watching(e, now) for e in self.table.values()):
+                    self._cond.wait(1.0)
+                    continue
+            try:
+                self.poll_once()
+            except Exception:
+                pass
+            with self._cond:
+                if not self._stopped:
+                    self._cond.wait(self.poll)
+        with self._cond:
+            left = [e for e in self.table.values() if not e["future"].done()]
+            for e in left:
+                e["status"] = "failed"
+        for e in left:
+            e["future"].set_result(False)
+
+# ---------- Match prefilter (required literal tokens) ----------
+# כל כלל מקבל קבוצת "מפתחות": מילים שלפחות אחת מהן חייבת להופיע כטוקן בהודעה כדי שהכלל יוכל להתאים.
+# ההודעה מפורקת לטוקנים פעם אחת, וה-Regex המלא רץ רק על הכללים שמפתח שלהם נמצא (או שאין להם מפתחות).
+_WORD_TOKEN_RE = re.compile(r"\w+")
+_PREFIX_LETTERS = frozenset(HEB_PREFIX_CLASS[1:-1])
+_MAX_PREFIX_LEN = 4          # כמו {1,4} בבונה
+_MAX_KEY_VARIANTS = 64       # מעבר לזה הכלל לא נכנס לאינדקס
+# re.IGNORECASE משווה i/ı ו-İ/i, בניגוד ל-casefold
+_FOLD_FIXES = str.maketrans({"İ": "i", "ı": "i"})
+
+def _fold(s: str) -> str:
+    return s.translate(_FOLD_FIXES).casefold()
+
+def _token_variants(tok: str) -> tuple:
+    out = [tok]
+    i = 0
+    while i < _MAX_PREFIX_LEN and i < len(tok) - 1 and tok[i] in _PREFIX_LETTERS:
+        i += 1
+        out.append(tok[i:])
+    return tuple(out)
+
+def _message_token_keys(msg: str, memo: dict | None = None) -> set:
+    """
+    טוקני המילים של ההודעה (אחרי fold), כולל גרסאות בלי 1-4 אותיות תחילית (ו/ה/ב/כ/ל/מ/ש).
+    memo (טוקן -> גרסאות) משותף בין הודעות של אותה אצווה.
+    """
+    keys = set()
+    for tok in _WORD_TOKEN_RE.findall(_fold(msg)):
+        if memo is None:
+            keys.update(_token_variants(tok))
+            continue
+        variants = memo.get(tok)
+        if variants is None:
+            variants = memo[tok] = _token_variants(tok)
+        keys.update(variants)
+    return keys
+
+def _as_index_keys(terms) -> frozenset | None:
+    """ממיר חלופות למפתחות אינדקס; None אם אחת מהן אינה מילה אחת (\\w בלבד)."""
+    keys = set()
+    for t in terms:
+        t = (t or "").strip()
+        if not t or not _WORD_TOKEN_RE.fullmatch(t):
+            return None
+        k = _fold(t)
+        if not _WORD_TOKEN_RE.fullmatch(k):
+            return None
+        keys.add(k)
+    return frozenset(keys) if keys else None
+
+def _smallest_keys(*candidates):
+    best = None
+    for keys in candidates:
+        if keys and (best is None or len(keys) < len(best)):
+            best = keys
+    return best
+
+try:
+    from re import _parser as _sre_parse, _constants as _sre_c
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parse, sre_constants as _sre_c
+
+_AT_LEFT  = {_sre_c.AT_BOUNDARY, _sre_c.AT_BEGINNING, _sre_c.AT_BEGINNING_LINE, _sre_c.AT_BEGINNING_STRING}
+_AT_RIGHT = {_sre_c.AT_BOUNDARY, _sre_c.AT_END, _sre_c.AT_END_LINE, _sre_c.AT_END_STRING}
+_REPEATS  = (_sre_c.MAX_REPEAT, _sre_c.MIN_REPEAT)
+
+def _is_not_space_class(items) -> bool:
+    # (?<!\S) / (?!\S)
+    items = list(items)
+    return (len(items) == 1 and items[0][0] is _sre_c.IN
+            and list(items[0][1]) == [(_sre_c.CATEGORY, _sre_c.CATEGORY_NOT_SPACE)])
+
+def _is_space_item(op, av) -> bool:
+    if op is _sre_c.LITERAL:
+        return chr(av).isspace()
+    if op is _sre_c.IN:
+        return bool(av) and all(
+            (o is _sre_c.CATEGORY and a is _sre_c.CATEGORY_SPACE) or (o is _sre_c.LITERAL and chr(a).isspace())
+            for o, a in av)
+    return False
+
+def _is_boundary(items, i: int, left: bool) -> bool:
+    """האם items[i] מבטיח שלפני (left) / אחרי (right) הטוקן יש רווח, גבול מילה או קצה ההודעה."""
+    op, av = items[i]
+    if op is _sre_c.AT:
+        return av in (_AT_LEFT if left else _AT_RIGHT)
+    if op is _sre_c.ASSERT_NOT:
+        return av[0] == (-1 if left else 1) and _is_not_space_class(av[1])
+    if op in _REPEATS:
+        lo, _hi, body = av
+        body = list(body)
+        if len(body) != 1 or not _is_space_item(*body[0]):
+            return False
+        if lo >= 1:
+            return True
+        j = i - 1 if left else i + 1
+        return 0 <= j < len(items) and _is_boundary(items, j, left)
+    return _is_space_item(op, av)
+
+def _is_prefix_item(op, av) -> bool:
+    # (?:[והבכלמש]{1,4})? — עם או בלי (?<!\S) בסופו
+    if op not in _REPEATS or av[0] != 0 or av[1] != 1:
+        return False
+    reps = []
+    for o, a in av[2]:
+        if o in (_sre_c.ASSERT, _sre_c.ASSERT_NOT, _sre_c.AT):
+            continue
+        if o not in _REPEATS or a[1] > _MAX_PREFIX_LEN:
+            return False
+        inner = list(a[2])
+        if len(inner) != 1:
+            return False
+        io, ia = inner[0]
+        if io is _sre_c.LITERAL:
+            letters = [ia]
+        elif io is _sre_c.IN and all(x is _sre_c.LITERAL for x, _ in ia):
+            letters = [c for _, c in ia]
+        else:
+            return False
+        if not all(chr(c) in _PREFIX_LETTERS for c in letters):
+            return False
+        reps.append(a)
+    return len(reps) == 1
+
+def _literal_strings(items) -> set | None:
+    """כל המחרוזות המדויקות שרצף מנותח יכול להתאים, או None אם הוא לא ליטרלי."""
+    out = {""}
+    for op, av in items:
+        if op is _sre_c.LITERAL:
+            options = {chr(av)}
+        elif op is _sre_c.IN and av and all(o is _sre_c.LITERAL for o, _ in av):
+            options = {chr(a) for _, a in av}
+        elif op is _sre_c.SUBPATTERN:
+            options = _literal_strings(av[-1])
+        elif op is _sre_c.BRANCH:
+            options = set()
+            for br in av[1]:
+                sub = _literal_strings(br)
+                if sub is None:
+                    return None
+                options |= sub
+        else:
+            return None
+        if options is None:
+            return None
+        out = {a + b for a in out for b in options}
+        if len(out) > _MAX_KEY_VARIANTS:
+            return None
+    return out
+
+def _token_run_keys(items):
+    items = list(items)
+    if items and _is_prefix_item(*items[0]):
+        items = items[1:]
+    if not items:
+        return None
+    strings = _literal_strings(items)
+    return _as_index_keys(strings) if strings else None
+
+def _seq_required_keys(items):
+    items = list(items)
+    found = []
+    # טוקן ליטרלי בין שני גבולות ברצף הזה
+    for i in range(len(items)):
+        if not _is_boundary(items, i, left=True):
+            continue
+        for j in range(i + 1, len(items)):
+            if _is_boundary(items, j, left=False):
+                if j > i + 1:
+                    found.append(_token_run_keys(items[i + 1:j]))
+                break
+    # תתי-מבנים שחייבים להתאים
+    for op, av in items:
+        if op is _sre_c.SUBPATTERN:
+            found.append(_seq_required_keys(av[-1]))
+        elif op is _sre_c.ASSERT:
+            found.append(_seq_required_keys(av[1]))
+        elif op in _REPEATS and av[0] >= 1:
+            found.append(_seq_required_keys(av[2]))
+        elif op is _sre_c.BRANCH:
+            union = set()
+            for br in av[1]:
+                sub = _seq_required_keys(br)
+                if not sub:
+                    union = None
+                    break
+                union |= sub
+            found.append(frozenset(union) if union else None)
+    return _smallest_keys(*found)
+
+def _pattern_required_tokens(pattern: str):
+    try:
+        parsed = _sre_parse.parse(pattern, re.IGNORECASE)
+    except Exception:
+        return None
+    try:
+        return _seq_required_keys(parsed)
+    except RecursionError:
+        return None
+
+@functools.lru_cache(maxsize=4096)
+def _builder_spec_for(pattern: str, source_terms: str):
+    """
+    משחזר את אפשרויות הבונה (mode/case/seps/prefixes) שעבורן build_regex(source_terms) מחזיר בדיוק את pattern.
+    None אם source_terms כבר לא תואם לתבנית (למשל אחרי עריכה ידנית של ה-Regex).
+    """
+    if not pattern or not source_terms:
+        return None
+    case_ins = pattern.startswith("(?i)")
+    allow_prefixes = (HEB_PREFIX_CLASS + "{1,4}") in pattern
+    for mode in ("part", "whole", "anyorder"):
+        for seps in (True, False):
+            try:
+                built = build_regex(source_terms, mode, case_ins, seps, allow_prefixes)
+            except Exception:
+                continue
+            if built and built == pattern:
+                return {"mode": mode, "case_ins": case_ins, "allow_inside_sep": seps,
+                        "allow_prefixes": allow_prefixes, "terms_raw": source_terms}
+    return None
+
+def _spec_required_tokens(spec: dict):
+    terms_raw = spec["terms_raw"]
+    if spec["mode"] == "part":
+        req, opt = _parse_terms_grammar(terms_raw)
+        cands = [_as_index_keys(alts) for alts in req]
+        if opt:
+            cands.append(_as_index_keys([a for grp in opt for a in grp]))
+        return _smallest_keys(*cands)
+    if spec["mode"] == "whole":
+        return _as_index_keys([t for t, _k in _split_terms_k(terms_raw)])
+    if spec["mode"] == "anyorder":
+        return _smallest_keys(*[_as_index_keys([t]) for t, _k in _split_terms_k(terms_raw)])
+    return None
+
+def _rule_required_tokens(rule) -> frozenset | None:
+    """מפתחות האינדקס של כלל: מ-source_terms (אם עדיין תואם לתבנית) ואחרת מניתוח ה-Regex עצמו."""
+    spec = _builder_spec_for(rule.pattern, getattr(rule, "source_terms", None) or "")
+    if spec:
+        keys = _spec_required_tokens(spec)
+        if keys:
+            return keys
+    return _pattern_required_tokens(rule.pattern)
+
+# ---------- Token-set matcher (builder rules without regex) ----------
+def _token_keys(tok: str, prefixes: bool):
+    """הטוקן עצמו ואם prefixes — גם הגרסאות בלי 1-4 אותיות תחילית."""
+    if not prefixes:
+        return (tok,)
+    keys = [tok]
+    i = 0
+    while i < _MAX_PREFIX_LEN and i < len(tok) - 1 and tok[i] in _PREFIX_LETTERS:
+        i += 1
+        keys.append(tok[i:])
+    return keys
+
+class TokenSetMatcher:
+    """
+    התאמה ללא Regex לכלל שנבנה בבונה ויש לו spec משוחזר (ראו _builder_spec_for).
+    ההודעה מפורקת פעם אחת לשורות ולטוקנים, וכל קבוצת חלופות נבדקת כחיפוש ב-set;
+    קבוצות עם term:K נספרות באותו מעבר (Counter) במקום lookahead-ים מקוננים.
+    הסמנטיקה זהה ל-Regex של הבונה:
+    - part/anyorder: כל הקבוצות באותה שורה ('.' של ה-lookahead לא חוצה \\n)
+    - whole: ההודעה כולה היא טוקן אחד (או המונח חוזר לפחות K פעמים)
+    תחיליות פעילות רק עם מפרידי־פנים — בלעדיהם (?<!\\S) שאחרי התחילית לא יכול להתקיים.
+    """
+    __slots__ = ("mode", "required", "optional", "prefixes", "ignore_case", "fallback", "_counting")
+
+    def __init__(self, mode: str, required, optional, prefixes: bool, ignore_case: bool, fallback=None):
+        self.mode = mode
+        self.required = required        # list[(frozenset, K)] — כל קבוצה חובה
+        self.optional = optional        # list[(frozenset, K)] | None — לפחות אחת מהקבוצות הלא-חובה
+        self.prefixes = prefixes
+        self.ignore_case = ignore_case
+        self.fallback = fallback        # callable(msg) — ל-Regex כשאין התאמה 1:1 של אותיות (ß וכו')
+        self._counting = any(k > 1 for _g, k in required + (optional or []))
+
+    @classmethod
+    def from_spec(cls, spec: dict, ignore_case: bool | None = None, fallback=None):
+        """בונה מנוע מה-spec, או None אם יש בו מונח שהמנוע לא יודע לייצג בדיוק (רווח, מקף עם מפרידים)."""
+        if ignore_case is None:
+            ignore_case = spec["case_ins"]
+        seps = spec["allow_inside_sep"]
+        terms_raw = spec["terms_raw"]
+
+        def group(alts):
+            out = set()
+            for a in alts:
+                a = (a or "").strip()
+                if not a:
+                    continue
+                if any(ch.isspace() for ch in a) or (seps and "-" in a):
+                    raise ValueError(a)
+                if ignore_case:
+                    folded = _fold(a)
+                    if len(folded) != len(a):
+                        raise ValueError(a)
+                    a = folded
+                out.add(a)
+            return frozenset(out)
+
+        mode = spec["mode"]
+        try:
+            if mode == "part":
+                groups = _parse_terms_grammar_k(terms_raw)
+                required = [(g, k) for g, k in ((group(a), k) for r, a, k in groups if r) if g]
+                opt = [(g, k) for g, k in ((group(a), k) for r, a, k in groups if not r) if g]
+                if opt and all(k == 1 for _g, k in opt):
+                    opt = [(frozenset().union(*(g for g, _k in opt)), 1)]
+                optional = opt or None
+            elif mode == "anyorder":
+                required = [(g, k) for g, k in ((group([t]), k) for t, k in _split_terms_k(terms_raw)) if g]
+                optional = None
+            elif mode == "whole":
+                terms_k = _split_terms_k(terms_raw)
+                if any(k > 1 for _t, k in terms_k):
+                    required = [(g, k) for g, k in ((group([t]), k) for t, k in terms_k) if g]
+                else:
+                    required = [(group([t for t, _k in terms_k]), 1)]
+                optional = None
+                if not required or not required[0][0]:
+                    return None
+            else:
+                return None
+        except ValueError:
+            return None
+        prefixes = bool(spec["allow_prefixes"] and seps)
+        return cls(mode, required, optional, prefixes, ignore_case, fallback)
+
+    def _hits(self, tok: str, alts) -> bool:
+        return not alts.isdisjoint(_token_keys(tok, self.prefixes))
+
+    def _group_ok(self, alts, k, keys, counts) -> bool:
+        if k == 1:
+            return not keys.isdisjoint(alts)
+        n = 0
+        for tok, c in counts.items():
+            if self._hits(tok, alts):
+                n += c
+                if n >= k:
+                    return True
+        return False
+
+    def _search_whole(self, text: str) -> bool:
+        toks = text.split()
+        if not toks:
+            return False
+        for alts, k in self.required:
+            if k == 1:
+                if len(toks) == 1 and self._hits(toks[0], alts):
+                    return True
+            elif len(toks) >= k and all(self._hits(t, alts) for t in toks):
+                return True
+        return False
+
+    def search(self, msg: str) -> bool:
+        text = msg
+        if self.ignore_case:
+            text = _fold(msg)
+            if len(text) != len(msg):
+                return bool(self.fallback(msg)) if self.fallback else False
+        if self.mode == "whole":
+            return self._search_whole(text)
+        for line in text.split("\n"):
+            toks = line.split()
+            counts = Counter(toks) if self._counting else None
+            keys = set()
+            for tok in (counts if counts is not None else toks):
+                keys.update(_token_keys(tok, self.prefixes))
+            if self.optional is not None and not any(self._group_ok(g, k, keys, counts) for g, k in self.optional):
+                continue
+            if all(self._group_ok(g, k, keys, counts) for g, k in self.required):
+                return True
+        return False
+
+def compare_match_engines(dataset, messages) -> list:
+    """
+    בדיקה דיפרנציאלית: כל כלל שרץ על TokenSetMatcher נבדק גם מול ה-Regex שלו.
+    מחזיר רשימת אי-התאמות (message, rule_index, regex_result, native_result) — ריקה אם שני המסלולים זהים.
+    """
+    mismatches = []
+    for pos, native in dataset._native.items():
+        pat, _replies = dataset.compiled[pos]
+        for msg in messages:
+            want = pat.search(msg) is not None
+            got = native.search(msg)
+            if want != got:
+                mismatches.append((msg, pos, want, got))
+    return mismatches
+
+# כללי בונה קבועים ל---verify-engines: (מונחים, mode, מפרידי־פנים, תחיליות). מכסים כל דקדוק — כל סדר, קבוצות
+# חובה (*) ולא־חובה, חלופות ב-/, תחיליות עבריות וספירות :K — כך ש-TokenSetMatcher נבדק מול ה-Regex תמיד,
+# גם כשאף כלל במאגר עצמו לא רץ עליו.
+ENGINE_CHECK_SPECS = (
+    ("מחיר, כמה", "anyorder", True, True),
+    ("מחיר:2, משלוח", "anyorder", True, True),
+    ("הזמנה*, היום/מחר", "part", True, True),
+    ("הזמנה*/order*, איפה:2/מתי", "part", True, True),
+    ("sale/מבצע, הנחה/discount", "part", True, True),
+    ("שלום/היי/hello", "part", False, False),
+    ("מחיר", "part", False, True),
+    ("כן:3", "part", True, True),
+    ("תודה, thanks", "whole", True, True),
+    ("ok:2", "whole", True, False),
+)
+
+# כללי בונה ל-check_keyword_display: התצוגה ברשימת הכללים חייבת להיות המונחים עצמם, בלי מחלקת התחיליות
+DISPLAY_CHECK_SPECS = (
+    ("מחיר, כמה", "anyorder", True, True),
+    ("שלום, עולם", "anyorder", False, True),
+    ("מחיר:2, משלוח", "anyorder", True, True),
+    ("יום הולדת, מזל טוב", "anyorder", True, True),
+    ("a.b, c+d", "anyorder", False, False),
+    ("sale/מבצע, הנחה/discount", "part", True, True),
+    ("הזמנה*, היום/מחר", "part", True, True),
+)
+
+def check_keyword_display() -> List[str]:
+    """שגיאה לכל כלל ב-DISPLAY_CHECK_SPECS ש-_regex_to_keywords_display לא מציג כרשימת המונחים שלו."""
+    errors = []
+    for terms, mode, seps, prefixes in DISPLAY_CHECK_SPECS:
+        want = ", ".join(alt.split(":")[0].strip(" *") for part in terms.split(",") for alt in part.split("/"))
+        got = _regex_to_keywords_display(build_regex(terms, mode, True, seps, prefixes))
+        if got != want:
+            errors.append(f"{terms!r} ({mode}): displayed {got!r}, expected {want!r}")
+    return errors
+
+def engine_check_corpus(dataset, per_rule: int = 300) -> List[str]:
+    """
+    לכל כלל בדיקה — הודעות מהמילים שלו בלבד (ועוד מילת רעש), כדי שגם כללי whole, :K ו-anyorder
+    יתאימו לחלק מההודעות; אחרת שני המנועים מסכימים רק על "לא".
+    """
+    out = []
+    for i, (terms, _mode, _seps, _prefixes) in enumerate(ENGINE_CHECK_SPECS):
+        words = {a for _req, alts, _k in _parse_terms_grammar_k(terms) for a in alts} | {"שלום"}
+        out.extend(synthetic_corpus(dataset, count=per_rule, seed=i, words=words))
+    return out
+
+def engine_check_dataset() -> "Dataset":
+    """מאגר בקריאה בלבד מכללי ENGINE_CHECK_SPECS, שנבנו ב-build_regex כמו בבונה."""
+    rules = tuple({"keyword": build_regex(terms, mode, True, seps, prefixes), "replies": ["ok"], "source_terms": terms}
+                  for terms, mode, seps, prefixes in ENGINE_CHECK_SPECS)
+    return Dataset.from_snapshot({"path": "engine-check.json", "rules": rules, "cache_size": 0,
+                                  "regex_backend": DEFAULT_REGEX_BACKEND, "regex_timeout_ms": REGEX_BACKEND_TIMEOUT_MS,
+                                  "match_order": "file"})
+
+def order_conflicts(dataset, messages) -> list:
+    """
+    האם מעבר לסדר "frequency" ישנה תוצאה כלשהי על הקורפוס? מחזיר (message, כלל לפי סדר הקובץ, כלל לפי הסדר החדש)
+    — אינדקסים ב-rules — לכל הודעה ששני כללים או יותר מתאימים לה והראשון שבהם שונה בין שני הסדרים.
+    """
+    rank = dataset._frequency_rank()
+    rule_of = {slot[3]: i for i, slot in enumerate(dataset._slots) if slot[3] is not None}
+    conflicts = []
+    for msg in dict.fromkeys(messages):
+        if msg == MEDIA_PLACEHOLDER:
+            continue
+        hits = [i for i in range(len(dataset.compiled)) if dataset._matchers[i](msg)]
+        if len(hits) > 1:
+            first = hits[0]
+            reordered = min(hits, key=rank.__getitem__)
+            if reordered != first:
+                conflicts.append((msg, rule_of[first], rule_of[reordered]))
+    return conflicts
+
+def synthetic_corpus(dataset, count: int = 2000, seed: int = 0, words=None) -> List[str]:
+    """
+    קורפוס הודעות מלאכותי מתוך מילות המאגר (או words): תחיליות, פיסוק, ריבוי שורות ואותיות גדולות.
+    """
+    rnd = random.Random(seed)
+    words = sorted(set(words) if words else {k for k in dataset._token_index} | {"שלום", "לקוח", "היום", "sale", "ok"})
+    seps = [" ", "  ", "\n", "\t", ", ", "-", "!", "", " \n "]
+    out = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rnd.randint(1, 5)):
+            w = rnd.choice(words)
+            r = rnd.random()
+            if r < 0.2:
+                w = rnd.choice(sorted(_PREFIX_LETTERS)) + w
+            elif r < 0.3:
+                w = w.upper()
+            elif r < 0.35:
+                w = w + rnd.choice("!?.")
+            parts.append(w + rnd.choice(seps))
+        msg = "".join(parts)
+        out.append(msg.strip() if rnd.random() < 0.5 else msg)
+    return out
+
+# ---------- Regex backends ----------
+REGEX_BACKENDS = ("re", "regex", "re2")
+DEFAULT_REGEX_BACKEND = "re"
+REGEX_BACKEND_TIMEOUT_MS = 250   # זמן קצוב לחיפוש בודד במודול regex
+
+@functools.lru_cache(maxsize=None)
+def _backend_module(name: str):
+    """המודול של המנוע, או None אם אינו מותקן (regex / google-re2 הם תלויות אופציונליות)."""
+    try:
+        if name == "regex":
+            import regex  # type: ignore
+            return regex
+        if name == "re2":
+            import re2  # type: ignore
+            return re2
+    except Exception:
+        return None
+    return re if name == "re" else None
+
+def available_regex_backends() -> List[str]:
+    return [b for b in REGEX_BACKENDS if _backend_module(b) is not None]
+
+class _TimeoutPattern:
+    """תבנית של מודול regex: חיפוש עם זמן קצוב; חריגה נספרת ונחשבת כאי-התאמה."""
+    __slots__ = ("_pat", "pattern", "flags", "timeout", "timeouts")
+
+    def __init__(self, pat, timeout_ms: float):
+        self._pat = pat
+        self.pattern = pat.pattern
+        self.flags = pat.flags
+        self.timeout = max(1.0, float(timeout_ms)) / 1000.0
+        self.timeouts = 0
+
+    def search(self, msg: str):
+        try:
+            return self._pat.search(msg, timeout=self.timeout)
+        except TimeoutError:
+            self.timeouts += 1
+            return None
+
+def _re2_unsupported(pattern: str) -> str | None:
+    """
+    מבנים ש-RE2 לא תומך בהם (lookaround, הפניות לאחור) או שמשמעותם בו שונה
+    (\\w, \\d, \\s, \\b הם ASCII בלבד ב-RE2, ולכן לא יתאימו לעברית כמו ב-re).
+    """
+    def walk(items):
+        for op, av in items:
+            if op in (_sre_c.ASSERT, _sre_c.ASSERT_NOT):
+                return "lookaround"
+            if op in (_sre_c.GROUPREF, _sre_c.GROUPREF_EXISTS):
+                return "backreference"
+            if op is _sre_c.AT and av in (_sre_c.AT_BOUNDARY, _sre_c.AT_NON_BOUNDARY):
+                return "\\b"
+            if op is _sre_c.CATEGORY or (op is _sre_c.IN and any(o is _sre_c.CATEGORY for o, _a in av)):
+                return "unicode class"
+            if op in _REPEATS:
+                r = walk(av[2])
+            elif op is _sre_c.SUBPATTERN:
+                r = walk(av[-1])
+            elif op is _sre_c.BRANCH:
+                r = next((x for x in map(walk, av[1]) if x), None)
+            else:
+                r = None
+            if r:
+                return r
+        return None
+    try:
+        return walk(_sre_parse.parse(pattern))
+    except Exception:
+        return "unparsable"
+
+def compile_with_backend(pattern: str, backend: str = DEFAULT_REGEX_BACKEND,
+                         timeout_ms: float = REGEX_BACKEND_TIMEOUT_MS):
+    """
+    מקמפל תבנית (תמיד ב-IGNORECASE) במנוע המבוקש, ונופל ל-re כשהמנוע חסר או לא תומך במבנה.
+    מחזיר (compiled, backend בפועל, סיבת הנפילה או None). re.error נזרקת עבור תבנית לא תקינה.
+    """
+    std = re.compile(pattern, re.IGNORECASE)
+    if backend == "re":
+        return std, "re", None
+    mod = _backend_module(backend)
+    if mod is None:
+        return std, "re", f"{backend} not installed"
+    try:
+        if backend == "regex":
+            pat = mod.compile(pattern, mod.IGNORECASE | mod.V0)
+            return _TimeoutPattern(pat, timeout_ms), "regex", None
+        if backend == "re2":
+            why = _re2_unsupported(pattern)
+            if why:
+                return std, "re", f"re2: {why}"
+            return mod.compile(pattern if pattern.startswith("(?i)") else "(?i)" + pattern), "re2", None
+    except Exception as e:
+        return std, "re", f"{backend}: {e}"
+    return std, "re", f"unknown backend {backend!r}"
+
+# ---------- Regex cost guard ----------
+REGEX_WARN_MS = 50          # מעל זה — אזהרה בעת שמירת תבנית
+REGEX_REJECT_MS = 1000      # מעל זה (או תקיעה) — התבנית נדחית
+REGEX_SANDBOX_TIMEOUT_MS = 250
+
+# תבניות שנמדדו כאיטיות בשמירה; נחשבות "חשודות" גם אם הניתוח הסטטי לא תפס אותן
+_slow_patterns: set = set()
+
+def adversarial_corpus() -> List[str]:
+    """הודעות שמעמיסות על מנוע Backtracking: טקסט עברי ארוך, מפרידים חוזרים וריצות של אות אחת."""
+    heb = "שלום לכולם, מה נשמע היום? "
+    return [
+        heb * 40,
+        "שלום" * 250,
+        " " * 1000 + "!",
+        "-" * 1000 + "!",
+        ", " * 500 + "!",
+        "\n" * 500 + "שלום",
+        "ו " * 500 + "!",
+        ("ש" * 30 + " ") * 32 + "!",
+        "ש" * 28 + "!",
+        "a" * 28 + "!",
+        "1" * 28 + "x",
+        "ש-" * 500 + "!",
+    ]
+
+def _max_is_unbounded(hi) -> bool:
+    return hi is _sre_c.MAXREPEAT or hi > 1000
+
+def _has_unbounded_repeat(items) -> bool:
+    for op, av in items:
+        if op in _REPEATS:
+            if _max_is_unbounded(av[1]) or _has_unbounded_repeat(av[2]):
+                return True
+        elif op is _sre_c.SUBPATTERN:
+            if _has_unbounded_repeat(av[-1]):
+                return True
+        elif op is _sre_c.BRANCH:
+            if any(_has_unbounded_repeat(b) for b in av[1]):
+                return True
+        elif op in (_sre_c.ASSERT, _sre_c.ASSERT_NOT):
+            if _has_unbounded_repeat(av[1]):
+                return True
+    return False
+
+def _suspicious_items(items) -> bool:
+    for op, av in items:
+        if op in _REPEATS:
+            lo, hi, body = av
+            body = list(body)
+            # (x+)+ / (a|ab)* — חזרה לא חסומה על גוף שיש בו חזרה לא חסומה או חלופות
+            if _max_is_unbounded(hi) and (_has_unbounded_repeat(body)
+                                          or any(o is _sre_c.BRANCH for o, _a in _flatten_groups(body))):
+                return True
+            if _suspicious_items(body):
+                return True
+        elif op is _sre_c.SUBPATTERN:
+            if _suspicious_items(av[-1]):
+                return True
+        elif op is _sre_c.BRANCH:
+            if any(_suspicious_items(b) for b in av[1]):
+                return True
+        elif op in (_sre_c.ASSERT, _sre_c.ASSERT_NOT):
+            if _suspicious_items(av[1]):
+                return True
+    return False
+
+def _flatten_groups(items):
+    for op, av in items:
+        if op is _sre_c.SUBPATTERN:
+            yield from _flatten_groups(av[-1])
+        else:
+            yield op, av
+
+@functools.lru_cache(maxsize=4096)
+def regex_is_suspicious(pattern: str) -> bool:
+    """ניתוח סטטי זהיר: חזרה מקוננת לא חסומה או חזרה על חלופות — או שנמדדה כאיטית."""
+    if pattern in _slow_patterns:
+        return True
+    try:
+        return _suspicious_items(_sre_parse.parse(pattern))
+    except Exception:
+        return False
 
-def wait_for_login(drv, sec=120):
+def _regex_bench_worker(conn, pattern: str, flags: int, corpus):
     try:
-        WebDriverWait(drv, sec).until(
-            EC.presence_of_element_located((By.XPATH, SEARCH_BOX))
-        )
-    except TimeoutException:
-        messagebox.showinfo("WhatsApp Web",
-                            "סרוק/י את קוד ה-QR בכרום שנפתח. לאחר הסריקה לחץ/י אישור.")
-        WebDriverWait(drv, sec).until(
-            EC.presence_of_element_located((By.XPATH, SEARCH_BOX))
-        )
+        pat = re.compile(pattern, flags)
+    except re.error as e:
+        conn.send(("error", str(e)))
+        return
+    conn.send(("ready", None))
+    for msg in corpus:
+        t0 = time.perf_counter()
+        pat.search(msg)
+        conn.send(("sample", (time.perf_counter() - t0) * 1000.0))
+
+def benchmark_pattern(pattern: str, flags: int = re.IGNORECASE, reject_ms: float = REGEX_REJECT_MS,
+                      corpus: List[str] | None = None) -> dict:
+    """
+    מריץ את התבנית על הקורפוס העוין בתהליך נפרד. דגימה שעוברת את reject_ms נקטעת (התהליך מופסק).
+    מחזיר {"worst_ms", "total_ms", "timed_out", "sample", "error"}.
+    """
+    import multiprocessing as mp
+    corpus = adversarial_corpus() if corpus is None else corpus
+    res = {"worst_ms": 0.0, "total_ms": 0.0, "timed_out": False, "sample": None, "error": None}
+    ctx = mp.get_context("spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_regex_bench_worker, args=(child, pattern, flags, corpus), daemon=True)
+    proc.start()
+    child.close()
+    try:
+        # עליית התהליך אינה נספרת בתקציב
+        if not parent.poll(60):
+            res["error"] = "worker did not start"
+            return res
+        kind, val = parent.recv()
+        if kind == "error":
+            res["error"] = val
+            return res
+        for i, msg in enumerate(corpus):
+            if not parent.poll(reject_ms / 1000.0):
+                res.update(timed_out=True, sample=i, worst_ms=float(reject_ms))
+                res["total_ms"] += reject_ms
+                break
+            _kind, ms = parent.recv()
+            res["total_ms"] += ms
+            if ms > res["worst_ms"]:
+                res["worst_ms"], res["sample"] = ms, i
+    except (EOFError, OSError) as e:
+        res["error"] = str(e)
+    finally:
+        if proc.is_alive():
+            proc.terminate()
+        proc.join(1)
+        parent.close()
+    return res
+
+def confirm_regex_cost(parent, pattern: str, settings_values: dict | None = None, source_terms: str | None = None) -> bool:
+    """בדיקת עלות לפני שמירה: דוחה מעל תקציב הדחייה, ומבקש אישור מעל תקציב האזהרה."""
+    if _builder_spec_for(pattern, source_terms or ""):
+        # תבנית בונה מוכרת רצה על TokenSetMatcher ולא על מנוע ה-Regex
+        return True
+    values = settings_values or {}
+    warn_ms = float(values.get("regex_warn_ms", REGEX_WARN_MS))
+    reject_ms = float(values.get("regex_reject_ms", REGEX_REJECT_MS))
+    res = benchmark_pattern(pattern, reject_ms=reject_ms)
+    if res["error"]:
+        # כשל בהרצת הבדיקה עצמה אינו חוסם שמירה (re.compile כבר עבר)
+        return True
+    if res["timed_out"] or res["worst_ms"] > reject_ms:
+        _slow_patterns.add(pattern)
+        regex_is_suspicious.cache_clear()
+        messagebox.showerror("Regex איטי מדי",
+                             f"התבנית חרגה מתקציב של {reject_ms:.0f}ms על הודעת בדיקה #{res['sample']} "
+                             "ועלולה לתקוע את הבוט. התבנית לא נשמרה.", parent=parent)
+        return False
+    if res["worst_ms"] > warn_ms:
+        _slow_patterns.add(pattern)
+        regex_is_suspicious.cache_clear()
+        return messagebox.askyesno("Regex איטי",
+                                   f"הבדיקה הארוכה ביותר לקחה {res['worst_ms']:.0f}ms (תקציב: {warn_ms:.0f}ms).\n"
+                                   "לשמור בכל זאת?", parent=parent)
+    return True
+
+def _regex_sandbox_worker(conn):
+    compiled = {}
+    conn.send("ready")
+    while True:
+        try:
+            pattern, flags, msg = conn.recv()
+        except (EOFError, OSError):
+            return
+        pat = compiled.get((pattern, flags))
+        if pat is None:
+            pat = compiled[(pattern, flags)] = re.compile(pattern, flags)
+        conn.send(pat.search(msg) is not None)
 
-def open_chat(drv, name):
-    search = drv.find_element(By.XPATH, SEARCH_BOX)
-    search.clear()
-    search.send_keys(name)
-    chat = WebDriverWait(drv, 10).until(
-        EC.element_to_be_clickable((By.XPATH, CHAT_ITEM % repr(name)))
-    )
-    chat.click()
+class RegexSandbox:
+    """
+    תהליך עזר שמריץ כללים חשודים עם זמן קצוב קשיח. חריגה => התהליך נהרג ומופעל מחדש
+    בקריאה הבאה, והכלל נחשב כלא-מתאים להודעה הזו.
+    """
+    def __init__(self, timeout_ms: float = REGEX_SANDBOX_TIMEOUT_MS):
+        self.timeout = max(1.0, float(timeout_ms)) / 1000.0
+        self._proc = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.timeouts: Counter = Counter()   # pattern -> מספר חריגות
+
+    def _start(self):
+        import multiprocessing as mp
+        ctx = mp.get_context("spawn")
+        self._conn, child = ctx.Pipe()
+        self._proc = ctx.Process(target=_regex_sandbox_worker, args=(child,), daemon=True)
+        self._proc.start()
+        child.close()
+        if not self._conn.poll(60):
+            self._kill()
+            raise RuntimeError("regex sandbox did not start")
+        self._conn.recv()
+
+    def _kill(self):
+        try:
+            if self._proc is not None and self._proc.is_alive():
+                self._proc.kill()
+        except Exception:
+            pass
+        try:
+            if self._conn is not None:
+                self._conn.close()
+        except Exception:
+            pass
+        self._proc = self._conn = None
+
+    def search(self, pat: re.Pattern, msg: str) -> bool:
+        with self._lock:
+            self.calls += 1
+            if self._proc is None or not self._proc.is_alive():
+                try:
+                    self._start()
+                except Exception:
+                    # אין תהליך עזר — חוזרים להרצה רגילה
+                    return pat.search(msg) is not None
+            try:
+                self._conn.send((pat.pattern, pat.flags, msg))
+                if self._conn.poll(self.timeout):
+                    return self._conn.recv()
+            except (EOFError, OSError):
+                self._kill()
+                return False
+            self.timeouts[pat.pattern] += 1
+            self._kill()
+            return False
 
-def last_incoming_text(drv):
-    bubbles = drv.find_elements(By.CSS_SELECTOR, BUBBLES_IN_CSS)
-    if not bubbles:
-        bubbles = drv.find_elements(By.CSS_SELECTOR, BUBBLES_ANY_CSS)
-    if not bubbles:
-        return MEDIA_PLACEHOLDER
-    text = bubbles[-1].text.strip()
-    return text if text else MEDIA_PLACEHOLDER
+    def close(self):
+        with self._lock:
+            self._kill()
 
 # ---------- Dataset model ----------
 
@@ -848,15 +3523,139 @@ class KeywordRule:
             d["source_terms"] = self.source_terms
         return d
 
+class _CompiledRule:
+    """תוצר הקומפילציה של תבנית אחת; משותף לכל הכללים עם אותה תבנית ואותו source_terms."""
+    __slots__ = ("pattern", "backend", "backend_note", "native", "matcher", "keys", "suspicious")
+
+    def __init__(self, pattern: str, source_terms: str = "", backend: str = DEFAULT_REGEX_BACKEND,
+                 timeout_ms: float = REGEX_BACKEND_TIMEOUT_MS):
+        self.pattern, self.backend, self.backend_note = compile_with_backend(pattern, backend, timeout_ms)
+        spec = _builder_spec_for(pattern, source_terms)
+        self.native = TokenSetMatcher.from_spec(spec, ignore_case=True, fallback=self.pattern.search) if spec else None
+        self.matcher = self.native.search if self.native is not None else self.pattern.search
+        self.keys = _rule_required_tokens(KeywordRule(pattern, [], source_terms or None))
+        # כללי בונה רצים על TokenSetMatcher, ו-regex/re2 מגבילים זמן בעצמם — רק Regex חופשי על re יכול להיות חשוד
+        self.suspicious = self.native is None and self.backend == "re" and regex_is_suspicious(pattern)
+
+    @property
+    def engine(self) -> str:
+        return "tokens" if self.native is not None else self.backend
+
+DEFAULT_MATCH_CACHE_SIZE = 2048
+_NOT_COMPUTED = object()
+
 class Dataset:
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, cache_size: int = DEFAULT_MATCH_CACHE_SIZE,
+                 regex_backend: str = DEFAULT_REGEX_BACKEND, regex_timeout_ms: float = REGEX_BACKEND_TIMEOUT_MS):
         self.path = Path(path)
+        self.regex_backend = regex_backend
+        self.regex_timeout_ms = float(regex_timeout_ms)
         self.rules: List[KeywordRule] = []
         self.compiled: List[Tuple[re.Pattern, List[str]]] = []
-        self.reply_norm_set = set()
+        # ספירת הפניות לכל תגובה מנורמלת, כך שמחיקת כלל לא מחייבת בנייה מחדש
+        self._reply_refs: Counter = Counter()
+        # קומפילציה לכל תבנית (pattern, source_terms) ומונה השימושים בה
+        self._entries: dict = {}
+        self._entry_refs: Counter = Counter()
+        # לכל כלל ב-rules: [מפתח תבנית, _CompiledRule או None, תגובות מנורמלות, מיקום ב-compiled או None]
+        self._slots: list = []
+        # אינדקס הפרה-פילטר: מפתח -> מיקומים ב-compiled; כללים ללא מפתחות נבדקים תמיד
+        self._token_index: dict = {}
+        self._unindexed: List[int] = []
+        # פונקציית התאמה לכל מיקום ב-compiled: TokenSetMatcher.search לכללי בונה, אחרת pattern.search
+        self._matchers: list = []
+        self._native: dict = {}
+        # המבנה שלמעלה (compiled/_matchers/_pos_stats/_native/האינדקס/הסדר) משתנה מה-GUI בזמן שהבוט מתאים:
+        # כל שינוי וכל התאמה (כולל בחירת התגובה לפי המיקום) רצים תחת המנעול, כך שאין תמונה חלקית
+        self._layout_lock = threading.RLock()
+        # מטמון LRU: טקסט ההודעה -> [generation, is_bot_reply, מיקום הכלל שהתאים / None].
+        # כל שינוי בכללים מעלה את generation, ורשומות מדור קודם נחשבות החטאה.
+        self._generation = 0
+        # RegexSandbox אופציונלי: כללים חשודים רצים בו עם זמן קצוב קשיח
+        self.sandbox = None
+        self._cache: "OrderedDict[str, list]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_size = max(0, int(cache_size))
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # סטטיסטיקה לכל תבנית: [הערכות, הפעלות, זמן מצטבר בשניות]; _pos_stats מקביל ל-compiled
+        self._stats: dict = {}
+        self._pos_stats: list = []
+        # "file" = סדר הקובץ; "frequency" = הנפוצים/הספציפיים קודם (דירוג נקבע בעת השינוי האחרון)
+        self.match_order = "file"
+        self._rank: List[int] | None = None
+        self._order: List[int] | None = None
+        # עותק לקריאה בלבד (from_snapshot): save/save_stats לא כותבים לקבצים של המקור
+        self.read_only = False
+
+    @property
+    def stats_path(self) -> Path:
+        return self.path.with_name(self.path.stem + ".stats.json")
+
+    def load_stats(self):
+        self._stats = {}
+        try:
+            with open(self.stats_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for pattern, st in data.items():
+                self._stats[pattern] = [int(st.get("evaluations", 0)), int(st.get("hits", 0)),
+                                        float(st.get("time_ms", 0.0)) / 1000.0]
+        except Exception:
+            pass
+
+    def save_stats(self):
+        if self.read_only:
+            return
+        data = {}
+        for rule in self.rules:
+            st = self._stats.get(rule.pattern)
+            if st and rule.pattern not in data:
+                data[rule.pattern] = {"evaluations": st[0], "hits": st[1], "time_ms": round(st[2] * 1000.0, 3)}
+        try:
+            with open(self.stats_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+        except Exception as e:
+            print("Cannot save stats:", e)
+
+    def rule_stats(self, idx: int) -> Tuple[int, int, float]:
+        """(הערכות, הפעלות, זמן מצטבר ב-ms) לכלל idx."""
+        st = self._stats.get(self.rules[idx].pattern)
+        return (st[0], st[1], st[2] * 1000.0) if st else (0, 0, 0.0)
+
+    def reset_stats(self):
+        for st in self._stats.values():
+            st[:] = [0, 0, 0.0]
+
+    def merge_stats(self, stats: dict):
+        """מוסיף סטטיסטיקה שנאספה במקום אחר (למשל בתהליך עובד): pattern -> [הערכות, הפעלות, שניות]."""
+        for pattern, (evals, hits, secs) in stats.items():
+            st = self._stats.setdefault(pattern, [0, 0, 0.0])
+            st[0] += int(evals)
+            st[1] += int(hits)
+            st[2] += float(secs)
+
+    def snapshot(self) -> dict:
+        """תמונת מצב של הכללים והגדרות ההתאמה, להעברה לתהליך אחר (ללא מטמון וסטטיסטיקה)."""
+        return {"path": str(self.path),
+                "rules": tuple(rule.to_dict() for rule in self.rules),
+                "cache_size": self.cache_size,
+                "regex_backend": self.regex_backend,
+                "regex_timeout_ms": self.regex_timeout_ms,
+                "match_order": self.match_order}
+
+    @classmethod
+    def from_snapshot(cls, snap: dict) -> "Dataset":
+        """מאגר לקריאה בלבד מתוך snapshot(); הסטטיסטיקה שלו מתחילה מאפס."""
+        ds = cls(Path(snap["path"]), cache_size=snap["cache_size"],
+                 regex_backend=snap["regex_backend"], regex_timeout_ms=snap["regex_timeout_ms"])
+        ds.rules = [KeywordRule(item["keyword"], list(item["replies"]), item.get("source_terms")) for item in snap["rules"]]
+        ds.match_order = snap["match_order"]
+        ds.read_only = True
+        ds._recompile()
+        return ds
 
     def load(self):
-        self.rules.clear()
+        rules = []
         if self.path.exists():
             with open(self.path, "r", encoding="utf-8") as f:
                 data = json.load(f)
@@ -867,58 +3666,335 @@ class Dataset:
             # מיגרציה: אם נשמרה תגובה אחת עם תווי "\\n" — נפרק לשורות
             if isinstance(replies, list) and len(replies) == 1 and "\\n" in replies[0]:
                 replies = [part.strip() for part in replies[0].split("\\n") if part.strip()]
-            self.rules.append(KeywordRule(item["keyword"], replies, item.get("source_terms")))
-        self._recompile()
+            rules.append(KeywordRule(item["keyword"], replies, item.get("source_terms")))
+        with self._layout_lock:
+            self.rules[:] = rules
+            self.load_stats()
+            self._recompile()
 
     def save(self, path: Path | None = None):
+        if self.read_only:
+            raise RuntimeError("dataset snapshot is read-only")
         if path is not None:
             self.path = Path(path)
         data = [rule.to_dict() for rule in self.rules]
         with open(self.path, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=4)
+        self.save_stats()
+
+    def _bump_generation(self):
+        self._generation += 1
+
+    def _rules_changed(self):
+        self._apply_order()
+        self._bump_generation()
+
+    def _frequency_rank(self) -> List[int]:
+        """דירוג לכל מיקום: הרבה הפעלות קודם, ובתיקו — התבנית הארוכה (הספציפית) יותר."""
+        n = len(self.compiled)
+        order = sorted(range(n), key=lambda p: (-self._pos_stats[p][1], -len(self.compiled[p][0].pattern), p))
+        rank = [0] * n
+        for r, p in enumerate(order):
+            rank[p] = r
+        return rank
+
+    def _apply_order(self):
+        if self.match_order != "frequency":
+            self._rank = self._order = None
+            return
+        self._rank = self._frequency_rank()
+        self._order = sorted(range(len(self.compiled)), key=self._rank.__getitem__)
+
+    def set_match_order(self, order: str):
+        """"file" (ברירת מחדל) או "frequency" — רק למאגרים שבהם הכללים לא חופפים (ראו order_conflicts)."""
+        with self._layout_lock:
+            self.match_order = "frequency" if order == "frequency" else "file"
+            self._rules_changed()
+
+    @property
+    def reply_norm_set(self):
+        return self._reply_refs.keys()
+
+    def _acquire(self, rule: KeywordRule) -> list:
+        """יוצר את רשומת הכלל: מקמפל את התבנית רק אם לא קיימת כבר, ומוסיף את התגובות לספירה."""
+        key = (rule.pattern, getattr(rule, "source_terms", None) or "")
+        if key in self._entries:
+            entry = self._entries[key]
+        else:
+            try:
+                entry = _CompiledRule(*key, backend=self.regex_backend, timeout_ms=self.regex_timeout_ms)
+            except re.error:
+                entry = None
+            self._entries[key] = entry
+        self._entry_refs[key] += 1
+        norms = tuple(_norm(r) for r in rule.replies)
+        self._reply_refs.update(norms)
+        return [key, entry, norms, None]
+
+    def _release(self, slot: list):
+        key, _entry, norms, _pos = slot
+        self._entry_refs[key] -= 1
+        if self._entry_refs[key] <= 0:
+            del self._entry_refs[key]
+            self._entries.pop(key, None)
+        self._reply_refs.subtract(norms)
+        for n in norms:
+            if self._reply_refs[n] <= 0:
+                del self._reply_refs[n]
+
+    def _index_add(self, pos: int, entry: "_CompiledRule"):
+        if entry.keys:
+            for k in entry.keys:
+                self._token_index.setdefault(k, []).append(pos)
+        else:
+            self._unindexed.append(pos)
+
+    def _index_remove(self, pos: int, entry: "_CompiledRule"):
+        if entry.keys:
+            for k in entry.keys:
+                idxs = self._token_index.get(k)
+                if idxs:
+                    idxs.remove(pos)
+                    if not idxs:
+                        del self._token_index[k]
+        else:
+            self._unindexed.remove(pos)
+
+    def set_regex_backend(self, backend: str, timeout_ms: float | None = None):
+        """מחליף מנוע Regex; כל התבניות מקומפלות מחדש (וכל כלל נופל ל-re לפי הצורך)."""
+        timeout_ms = self.regex_timeout_ms if timeout_ms is None else float(timeout_ms)
+        if backend == self.regex_backend and timeout_ms == self.regex_timeout_ms:
+            return
+        with self._layout_lock:
+            self.regex_backend, self.regex_timeout_ms = backend, timeout_ms
+            self._entries = {}
+            self._recompile()
+
+    def rule_engine(self, idx: int) -> Tuple[str, str | None]:
+        """המנוע שעליו רץ כלל idx ("tokens" / "re" / "regex" / "re2", או "invalid") וסיבת נפילה אם הייתה."""
+        entry = self._slots[idx][1]
+        if entry is None:
+            return "invalid", None
+        return entry.engine, entry.backend_note
+
+    def _matcher_for(self, entry: "_CompiledRule"):
+        if self.sandbox is not None and entry.suspicious:
+            return functools.partial(self.sandbox.search, entry.pattern)
+        return entry.matcher
+
+    def set_sandbox(self, sandbox):
+        """מפעיל/מכבה הרצה מבודדת של כללים חשודים (None = כבוי)."""
+        with self._layout_lock:
+            self.sandbox = sandbox
+            for pos, slot in ((s[3], s) for s in self._slots if s[3] is not None):
+                self._matchers[pos] = self._matcher_for(slot[1])
+            self._bump_generation()
+
+    def _place(self, rule: KeywordRule, slot: list):
+        """מוסיף כלל תקין לסוף compiled ולאינדקס."""
+        entry = slot[1]
+        pos = len(self.compiled)
+        slot[3] = pos
+        self.compiled.append((entry.pattern, rule.replies))
+        self._matchers.append(self._matcher_for(entry))
+        self._pos_stats.append(self._stats.setdefault(rule.pattern, [0, 0, 0.0]))
+        if entry.native is not None:
+            self._native[pos] = entry.native
+        self._index_add(pos, entry)
+
+    def _layout(self):
+        """בונה מחדש את המיקומים והאינדקס מהרשומות הקיימות — בלי לקמפל דבר. נקרא תחת _layout_lock."""
+        self.compiled = []
+        self._matchers = []
+        self._pos_stats = []
+        self._native = {}
+        self._token_index = {}
+        self._unindexed = []
+        for rule, slot in zip(self.rules, self._slots):
+            slot[3] = None
+            if slot[1] is not None:
+                self._place(rule, slot)
 
     def _recompile(self):
-        self.compiled.clear()
-        self.reply_norm_set = set()
+        with self._layout_lock:
+            self._recompile_locked()
+
+    def _recompile_locked(self):
+        # קומפילציות של תבניות שלא השתנו נשמרות (למשל בטעינה חוזרת של אותו קובץ)
+        previous = self._entries
+        self._entries = {}
+        self._entry_refs = Counter()
+        self._reply_refs = Counter()
+        self._slots = []
         for rule in self.rules:
-            try:
-                pat = re.compile(rule.pattern, re.IGNORECASE)
-            except re.error:
-                continue
-            self.compiled.append((pat, rule.replies))
-            for r in rule.replies:
-                self.reply_norm_set.add(_norm(r))
+            key = (rule.pattern, getattr(rule, "source_terms", None) or "")
+            if key in previous and key not in self._entries:
+                self._entries[key] = previous[key]
+            self._slots.append(self._acquire(rule))
+        self._layout()
+        self._rules_changed()
+
+    def _candidates(self, msg: str, memo: dict | None = None):
+        """מיקומי הכללים (לפי הסדר) שעשויים להתאים להודעה."""
+        if len(self._unindexed) == len(self.compiled):
+            return self._order if self._order is not None else range(len(self.compiled))
+        hits = set(self._unindexed)
+        for key in _message_token_keys(msg, memo):
+            idxs = self._token_index.get(key)
+            if idxs:
+                hits.update(idxs)
+        return sorted(hits, key=self._rank.__getitem__) if self._rank is not None else sorted(hits)
+
+    def _match_index(self, msg: str, memo: dict | None = None) -> int | None:
+        clock = time.perf_counter
+        for i in self._candidates(msg, memo):
+            st = self._pos_stats[i]
+            t0 = clock()
+            ok = self._matchers[i](msg)
+            st[0] += 1
+            st[2] += clock() - t0
+            if ok:
+                return i
+        return None
+
+    def _reply_for(self, i: int | None) -> str | None:
+        if i is None:
+            return None
+        self._pos_stats[i][1] += 1
+        replies = self.compiled[i][1]
+        # בחירת התגובה נשארת אקראית גם בפגיעה במטמון
+        return random.choice(replies) if replies else None
+
+    def _cache_entry(self, msg: str) -> list:
+        """רשומת המטמון של ההודעה (יוצר/מרענן לפי הצורך). השדות מחושבים בעצלות."""
+        gen = self._generation
+        with self._cache_lock:
+            entry = self._cache.get(msg)
+            if entry is not None and entry[0] == gen:
+                self._cache.move_to_end(msg)
+                self.cache_hits += 1
+                return entry
+            self.cache_misses += 1
+            entry = [gen, _NOT_COMPUTED, _NOT_COMPUTED]
+            if self.cache_size:
+                self._cache[msg] = entry
+                self._cache.move_to_end(msg)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return entry
+
+    def cache_info(self) -> dict:
+        with self._cache_lock:
+            return {"hits": self.cache_hits, "misses": self.cache_misses,
+                    "size": len(self._cache), "maxsize": self.cache_size, "generation": self._generation}
+
+    def set_cache_size(self, size: int):
+        with self._cache_lock:
+            self.cache_size = max(0, int(size))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
 
     def is_bot_reply(self, msg: str) -> bool:
         if msg == MEDIA_PLACEHOLDER:
             return False
-        return _norm(msg) in self.reply_norm_set
+        entry = self._cache_entry(msg)
+        if entry[1] is _NOT_COMPUTED:
+            entry[1] = _norm(msg) in self._reply_refs
+        return entry[1]
 
     def match(self, msg: str) -> str | None:
         if msg == MEDIA_PLACEHOLDER:
             return None
-        for pat, replies in self.compiled:
-            if pat.search(msg):
-                return random.choice(replies) if replies else None
-        return None
+        with self._layout_lock:
+            entry = self._cache_entry(msg)
+            if entry[2] is _NOT_COMPUTED:
+                entry[2] = self._match_index(msg)
+            return self._reply_for(entry[2])
+
+    def scan_many(self, messages) -> List[Tuple[bool, str | None]]:
+        """
+        (is_bot_reply, תגובה או None) לכל הודעה, בסדר הקלט. הודעות זהות באצווה מחושבות פעם אחת,
+        בדיקת "תגובה של הבוט" נעשית במעבר אחד, והטוקניזציה משותפת. להודעה של הבוט לא מחושבת התאמה.
+        """
+        entries = {}
+        memo = {}
+        out = []
+        # רשומות המטמון נלקחות תחת המנעול: מיקום שחושב לפני שינוי בכללים לא ישמש אחריו
+        with self._layout_lock:
+            for msg in messages:
+                if msg != MEDIA_PLACEHOLDER and msg not in entries:
+                    entries[msg] = self._cache_entry(msg)
+            for msg, entry in entries.items():
+                if entry[1] is _NOT_COMPUTED:
+                    entry[1] = _norm(msg) in self._reply_refs
+            for msg, entry in entries.items():
+                if not entry[1] and entry[2] is _NOT_COMPUTED:
+                    entry[2] = self._match_index(msg, memo)
+            for msg in messages:
+                entry = entries.get(msg)
+                if entry is None:
+                    out.append((False, None))
+                elif entry[1]:
+                    out.append((True, None))
+                else:
+                    # כל מופע מקבל בחירה אקראית משלו, כמו ב-match
+                    out.append((False, self._reply_for(entry[2])))
+        return out
+
+    def match_many(self, messages) -> List[str | None]:
+        """תגובה (או None) לכל הודעה; הודעות שהן תגובה של הבוט עצמו מקבלות None."""
+        return [reply for _is_bot, reply in self.scan_many(messages)]
 
     def add_rule(self, pattern: str, replies: List[str], source_terms: str | None = None):
-        self.rules.append(KeywordRule(pattern, replies, source_terms))
-        self._recompile()
+        rule = KeywordRule(pattern, replies, source_terms)
+        with self._layout_lock:
+            self.rules.append(rule)
+            slot = self._acquire(rule)
+            self._slots.append(slot)
+            if slot[1] is not None:
+                self._place(rule, slot)
+            self._rules_changed()
 
     def delete_rule(self, idx: int):
-        del self.rules[idx]
-        self._recompile()
+        with self._layout_lock:
+            slot = self._slots.pop(idx)
+            del self.rules[idx]
+            self._release(slot)
+            # המיקומים שאחרי הכלל זזים — סידור מחדש בלבד, ללא קומפילציה
+            if slot[1] is not None:
+                self._layout()
+            self._rules_changed()
 
     def update_rule(self, idx: int, pattern: str, replies: List[str], source_terms: str | None = None):
-        self.rules[idx].pattern = pattern
-        self.rules[idx].replies = replies
-        if source_terms is not None:
-            try:
-                self.rules[idx].source_terms = source_terms
-            except Exception:
-                pass
-        self._recompile()
+        with self._layout_lock:
+            rule = self.rules[idx]
+            old = self._slots[idx]
+            rule.pattern = pattern
+            rule.replies = replies
+            if source_terms is not None:
+                try:
+                    rule.source_terms = source_terms
+                except Exception:
+                    pass
+            slot = self._acquire(rule)
+            self._release(old)
+            self._slots[idx] = slot
+            pos = old[3]
+            if old[1] is not None and slot[1] is not None:
+                # החלפה במקום: אותו מיקום, רק המפתחות והמתאם מתעדכנים
+                entry = slot[1]
+                slot[3] = pos
+                self._index_remove(pos, old[1])
+                self.compiled[pos] = (entry.pattern, rule.replies)
+                self._matchers[pos] = self._matcher_for(entry)
+                self._pos_stats[pos] = self._stats.setdefault(rule.pattern, [0, 0, 0.0])
+                self._native.pop(pos, None)
+                if entry.native is not None:
+                    self._native[pos] = entry.native
+                self._index_add(pos, entry)
+            elif old[1] is not None or slot[1] is not None:
+                self._layout()
+            self._rules_changed()
 
 # ---------- Settings model ----------
 DEFAULT_SETTINGS = {
@@ -927,7 +4003,30 @@ DEFAULT_SETTINGS = {
     "autosave_interval_sec": 15,      # כמה שניות בין שמירות
     "confirm_deletions": True,
     "start_maximized": False,
-    "poll_interval_sec": DEFAULT_POLL_INTERVAL,
+    "poll_interval_sec": DEFAULT_POLL_INTERVAL,      # תקרת המרווח כשהצ'אט שקט
+    "poll_floor_sec": DEFAULT_POLL_FLOOR,            # המרווח מיד אחרי פעילות
+    "match_cache_size": DEFAULT_MATCH_CACHE_SIZE,   # 0 = ללא מטמון התאמות
+    "regex_warn_ms": REGEX_WARN_MS,                 # תקציב זמן לתבנית על הקורפוס העוין (אזהרה)
+    "regex_reject_ms": REGEX_REJECT_MS,             # מעל זה התבנית נדחית
+    "regex_sandbox": False,                         # הרצת כללים חשודים בתהליך נפרד
+    "regex_sandbox_timeout_ms": REGEX_SANDBOX_TIMEOUT_MS,
+    "regex_backend": DEFAULT_REGEX_BACKEND,          # "re" / "regex" (עם זמן קצוב) / "re2" (זמן לינארי)
+    "regex_backend_timeout_ms": REGEX_BACKEND_TIMEOUT_MS,
+    "match_order": "file",                          # "file" / "frequency" (הנפוצים קודם)
+    "record_corpus": False,                         # הקלטת הודעות נכנסות ל-corpus.jsonl
+    "ingestion": "observer",                        # "observer" (MutationObserver) / "poll" (הבועה האחרונה)
+    "idle_chat": "",                                # ניטור כמה קבוצות: הצ'אט שחוזרים אליו בין ביקורים
+    "group_datasets": {},                           # ניטור כמה קבוצות: {קבוצה: קובץ מאגר ייעודי}
+    "bot_workers": 1,                               # ניטור כמה קבוצות: מספר תהליכי בוט (לכל אחד Chrome משלו)
+    "send_rate_per_min": DEFAULT_SEND_RATE_PER_MIN,  # תגובות לדקה לכל צ'אט (0 = ללא הגבלה)
+    "send_burst": DEFAULT_SEND_BURST,               # כמה תגובות רצופות מותרות לפני שהקצב נאכף
+    "fast_text_insert": True,                       # הכנסת טקסט ב-JS (insertText/paste) במקום הקלדה תו-תו
+    "latency_budget_ms": dict(DEFAULT_LATENCY_BUDGET_MS),  # תקציב זמן לכל שלב בשליחה; חריגה נרשמת ביומן
+    "scheduler_session_idle_sec": DEFAULT_SESSION_IDLE_SEC,  # כמה זמן ה-Chrome של המתזמן נשאר פתוח בלי שימוש
+    "watchdog_backoff_max_sec": DEFAULT_WATCHDOG_BACKOFF_MAX,  # תקרת ההמתנה בין ניסיונות התאוששות של הבוט
+    "lean_browser": False,                          # Chrome חסכוני: בלי מדיה, אנימציות ו-GPU
+    "lean_headless": False,                         # במצב חסכוני: בלי חלון כשהפרופיל כבר מחובר
+    "memory_sample_sec": DEFAULT_MEMORY_SAMPLE_SEC,  # דגימת זיכרון Chrome ל-chrome_memory.jsonl (0 = כבוי)
         "recent_groups": [],
     "group_history": [],
 }
@@ -954,76 +4053,778 @@ class Settings:
             print("Cannot save settings:", e)
 
 # ---------- Bot engine ----------
+class AdaptivePoller:
+    """מרווח בין סבבי קריאה: floor מיד אחרי פעילות, ובשקט הכפלה עד ceiling."""
+    def __init__(self, floor: float = DEFAULT_POLL_FLOOR, ceiling: float = DEFAULT_POLL_INTERVAL, factor: float = 2.0):
+        self.floor = max(0.05, float(floor))
+        self.ceiling = max(self.floor, float(ceiling))
+        self.factor = max(1.0, float(factor))
+        self.delay = self.floor
+        self._ticks: List[float] = []
+
+    def next_delay(self, active: bool) -> float:
+        self.delay = self.floor if active else min(self.ceiling, self.delay * self.factor)
+        self._ticks.append(time.monotonic())
+        del self._ticks[:-32]
+        return self.delay
+
+    @property
+    def rate(self) -> float:
+        """סבבים לשנייה בפועל (על 32 הסבבים האחרונים)."""
+        if len(self._ticks) < 2:
+            return 0.0
+        span = self._ticks[-1] - self._ticks[0]
+        return (len(self._ticks) - 1) / span if span > 0 else 0.0
+
 class BotThread(threading.Thread):
-    def __init__(self, dataset: Dataset, group_name: str, on_status, settings: Settings):
+    def __init__(self, dataset: Dataset, group_name: str, on_status, settings: Settings,
+                 transport: ChatTransport | None = None):
         super().__init__(daemon=True)
         self.dataset = dataset
         self.group_name = group_name
         self.stop_event = threading.Event()
         self.on_status = on_status
-        self.driver = None
+        # None = SeleniumTransport שנבנה ב-_start_session (עם profile_dir)
+        self.transport = transport
         self.settings = settings
+        # זהות הודעה = data-id של WhatsApp; שתי הודעות זהות בטקסט הן עדיין שתי הודעות
+        self._seen = BoundedSeenSet(SEEN_IDS_MAX)
+        self._last_ids: dict = {}     # צ'אט -> המזהה האחרון שטופל
+        self.poller: AdaptivePoller | None = None
+        self.ingestion = None
+        self.read_round_trips = 0     # פניות ל-transport בקריאת ההודעות של הסבב האחרון
+        self.sender: SenderThread | None = None
+        self.acks: AckTracker | None = None
+        self.watchdog: SessionWatchdog | None = None
+        self.memory: MemoryMonitor | None = None
+        self.profile_dir = PROFILE_DIR
+        self.detach_browser = True    # False בתהליך עובד: Chrome נסגר עם chromedriver
+        # פקודות שליחה מבחוץ (מתזמן / "שלח עכשיו"): (צ'אט, טקסט, Future)
+        self._commands: deque = deque()
+        self._cmd_lock = threading.Lock()
+        self._accepting = False
 
     def stop(self):
         self.stop_event.set()
 
-    def run(self):
+    def accepts_commands(self) -> bool:
+        """True כשהבוט רץ ויודע לחזור לצ'אט המנוטר אחרי שליחה לצ'אט אחר."""
+        return self._accepting and self.is_alive() and not self.stop_event.is_set()
+
+    def send_to(self, chat: str, text: str) -> Future:
+        """
+        פקודה לבוט שרץ: לשלוח text ל-chat ולחזור לצ'אט המנוטר (בין סבבי הקריאה, באותו Chrome).
+        ה-Future מקבל True/False לפי אישור המסירה, או RuntimeError אם הבוט לא ניסה לשלוח
+        (לא פעיל / נעצר) — ואז אפשר לשלוח בדרך אחרת בלי חשש לכפילות.
+        """
+        fut: Future = Future()
+        with self._cmd_lock:
+            if self.accepts_commands():
+                self._commands.append((chat, text, fut))
+            else:
+                fut.set_exception(RuntimeError("הבוט אינו פעיל"))
+        return fut
+
+    def _reject_commands(self):
+        with self._cmd_lock:
+            self._accepting = False
+            cmds = list(self._commands)
+            self._commands.clear()
+        for _chat, _text, fut in cmds:
+            fut.set_exception(RuntimeError("הבוט נעצר"))
+
+    def _run_commands(self) -> bool:
+        """מבצע את פקודות השליחה שבתור (לפי צ'אט) וחוזר לצ'אט המנוטר; True אם היו פקודות."""
+        with self._cmd_lock:
+            cmds = list(self._commands)
+            self._commands.clear()
+        if not cmds:
+            return False
+        by_chat: "OrderedDict[str, list]" = OrderedDict()
+        for chat, text, fut in cmds:
+            by_chat.setdefault(chat, []).append((text, fut))
+        attempted = set()
         try:
-            self.on_status("פותח את WhatsApp Web…")
-            self.driver = build_driver(start_maximized=self.settings.values.get("start_maximized", True))
-            self.driver.get("https://web.whatsapp.com")
-            self.on_status("ממתין/ה להתחברות…")
-            wait_for_login(self.driver)
-            if self.group_name == FREE_CHOICE:
-                self.on_status("החיבור בוצע. מצב בחירה חופשית: בחר/י ידנית צ\'אט ב-WhatsApp…")
-                try:
-                    WebDriverWait(self.driver, 600).until(EC.element_to_be_clickable((By.XPATH, MSG_AREA)))
-                except Exception:
-                    self.on_status("פג הזמן לבחירת צ\'אט. עצירה.")
-                    return
-                self.on_status("נבחר צ\'אט. הבוט פועל ומאזין להודעות…")
+            self._leave_home()
+            for chat, sends in by_chat.items():
+                self._command_sends(chat, sends, attempted)
+        finally:
+            try:
+                self._return_home()
+            finally:
+                if self.sender is not None:
+                    self.sender.resume()
+                for _chat, _text, fut in cmds:
+                    if id(fut) not in attempted and not fut.done():
+                        fut.set_exception(RuntimeError("הפקודה לא בוצעה"))
+        return True
+
+    def _command_sends(self, chat: str, sends: list, attempted: set):
+        try:
+            self._switch(chat)
+        except Exception as e:
+            self.on_status(f"כשל בפתיחת {chat}: {e}")
+            for _text, fut in sends:
+                attempted.add(id(fut))
+                fut.set_result(False)
+            return
+        for text, fut in sends:
+            attempted.add(id(fut))
+            try:
+                before = self.transport.last_outgoing_id()
+                self.transport.send(text)
+                self.acks.track(chat, text, before).add_done_callback(lambda f, fut=fut: fut.set_result(f.result()))
+                self.on_status(f"נשלחה הודעה ל-{chat}: {text}")
+            except Exception as e:
+                self.on_status(f"כשל בשליחה ל-{chat}: {e}")
+                fut.set_result(False)
+        # את הווי אפשר לקרוא רק בצ'אט הפתוח — מחכים להכרעה לפני שעוזבים
+        self.acks.wait_chat(chat)
+
+    def _switch(self, chat: str):
+        self.transport.open_chat(chat, from_list=True)
+
+    def _leave_home(self):
+        """
+        לפני מעבר לצ'אט אחר: ההודעות החדשות בצ'אט המנוטר מטופלות והתגובות שלהן נשלחות, ותור השליחה
+        נעצר עד החזרה (תגובה בלי צ'אט מפורש נשלחת לצ'אט הפתוח).
+        """
+        self._catch_up()
+        if self.sender is not None:
+            self.sender.flush(None)
+            self.sender.pause()
+
+    def _return_home(self):
+        """חזרה לצ'אט המנוטר: קודם ה-Observer מותקן מחדש, ואז נקראות ההודעות שהגיעו בינתיים."""
+        self._switch(self.group_name)
+        self._rewatch()
+        self._catch_up()
+
+    def _rewatch(self):
+        if self.ingestion == "observer":
+            self.transport.start_watch(max(1, int(self.settings.values.get("poll_interval_sec", DEFAULT_POLL_INTERVAL))))
+
+    def _resume(self):
+        """אחרי התאוששות הסשן: פותח שוב את הצ'אט המנוטר וממשיך מההודעה האחרונה שטופלה."""
+        if self.group_name != FREE_CHOICE:
+            return self._return_home()
+        self.on_status("בחר/י שוב את הצ'אט ב-WhatsApp…")
+        if not self.transport.wait_chat_selected(600):
+            raise RuntimeError("לא נבחר צ'אט")
+        self._rewatch()
+        self._catch_up()
+
+    def _recover(self, error) -> bool:
+        """תקלה בקריאה: ה-watchdog מתקן את הסשן וממשיך (True), או שהבוט נעצר בינתיים (False)."""
+        if self.watchdog is None:
+            self.on_status(f"שגיאה בקריאת הודעות: {error}")
+            self.stop_event.wait(2)
+            return False
+        # בזמן ההתאוששות אין צ'אט פתוח — תגובות שבתור מחכות במקום להישלח לשום מקום
+        if self.sender is not None:
+            self.sender.pause()
+        try:
+            return self.watchdog.recover(error, self.stop_event, self._resume)
+        finally:
+            if self.sender is not None:
+                self.sender.resume()
+
+    def _catch_up(self):
+        fresh = self._fresh(self._read_new())
+        if fresh:
+            self._handle_batch([it["text"] for it in fresh])
+
+    def _fresh(self, items: List[dict], chat=None) -> List[dict]:
+        """ההודעות שטרם טופלו, לפי הסדר: אחרי המזהה האחרון שטופל בצ'אט (אם הוא בחלון) ושלא נראו כבר."""
+        ids = [it["id"] for it in items]
+        last_id = self._last_ids.get(chat)
+        if last_id in ids:
+            items = items[ids.index(last_id) + 1:]
+        fresh = [it for it in items if it["id"] not in self._seen]
+        for it in fresh:
+            self._seen.add(it["id"])
+        if fresh:
+            self._last_ids[chat] = fresh[-1]["id"]
+        return fresh
+
+    def _read_new(self, chat=None, limit: int = RECENT_ROWS_LIMIT) -> List[dict]:
+        """
+        ההודעות הנכנסות האחרונות בצ'אט הפתוח. כל עוד החלון מלא ואין בו את המזהה האחרון שטופל, וגם הבועה
+        הישנה שבו עוד לא נראתה (למשל בצ'אט שהיה ריק — PRIMED_EMPTY), החלון מורחב עד MAX_READ_ROWS,
+        כדי שהודעות בתחילת פרץ לא ילכו לאיבוד.
+        """
+        items = self.transport.read_incoming(limit)
+        last_id = self._last_ids.get(chat)
+        while len(items) >= limit and limit < MAX_READ_ROWS and items[0]["id"] not in self._seen \
+                and all(it["id"] != last_id for it in items):
+            limit = min(MAX_READ_ROWS, limit * 4)
+            items = self.transport.read_incoming(limit)
+        if len(items) >= MAX_READ_ROWS and last_id is not None and items[0]["id"] not in self._seen \
+                and all(it["id"] != last_id for it in items):
+            self.on_status(f"יותר מ-{MAX_READ_ROWS} הודעות חדשות בבת אחת — הישנות שבהן לא נקראו.")
+        return items
+
+    def _handle_batch(self, batch: List[str], dataset: Dataset | None = None, chat=None):
+        """מטפל בהודעות חדשות (לפי הסדר) בקריאת התאמה אחת למאגר; התגובות נכנסות לתור השליחה של chat."""
+        results = (dataset or self.dataset).scan_many(batch)
+        if self.settings.values.get("record_corpus", False):
+            record_messages([m for m, (is_bot, _r) in zip(batch, results) if not is_bot and m != MEDIA_PLACEHOLDER])
+        for msg, (is_bot, reply) in zip(batch, results):
+            if is_bot:
+                self.on_status("דילוג: ההודעה האחרונה היא תגובה של הבוט.")
+                continue
+            self.on_status(f"התקבלה הודעה: {msg}")
+            if reply:
+                self._send_reply(reply, chat)
             else:
-                self.on_status("החיבור בוצע. פותח את הצ\'אט…")
-                open_chat(self.driver, self.group_name)
-                self.on_status("הבוט פועל ומאזין להודעות…")
-            last_processed = None
-            poll = max(1, int(self.settings.values.get("poll_interval_sec", DEFAULT_POLL_INTERVAL)))
-            while not self.stop_event.is_set():
+                self.on_status("אין התאמת מילת מפתח. ממתין/ה…")
+
+    def _start_observer(self) -> bool:
+        """האזנה בדחיפה (MutationObserver) אם ההגדרה פעילה וה-transport תומך; אחרת פולינג."""
+        if self.settings.values.get("ingestion", "observer") != "observer":
+            return False
+        try:
+            # ההמתנה נמשכת עד תקרת המרווח
+            if not self.transport.start_watch(max(1, int(self.settings.values.get("poll_interval_sec", DEFAULT_POLL_INTERVAL)))):
+                return False
+        except Exception as e:
+            self.on_status(f"MutationObserver לא זמין ({e}); עובר לפולינג.")
+            return False
+        self.on_status("האזנה להודעות חדשות דרך MutationObserver.")
+        return True
+
+    def metrics(self) -> dict:
+        """מדדים לתצוגה: אופן הקריאה, קצב הסבבים בפועל, המרווח הנוכחי ותור השליחה."""
+        p = self.poller
+        return {"ingestion": self.ingestion,
+                "poll_rate_hz": p.rate if p else 0.0,
+                "poll_delay_sec": p.delay if p else 0.0,
+                "round_trips_per_tick": self.read_round_trips,
+                "sender": self.sender.metrics() if self.sender is not None else {},
+                "watchdog": self.watchdog.stats() if self.watchdog is not None else {},
+                "memory": self.memory.stats() if self.memory is not None else {}}
+
+    def _send_reply(self, reply: str, chat=None):
+        """מכניס תגובה לתור השליחה (chat=None: הצ'אט הפתוח)."""
+        if self.sender is not None:
+            self.sender.submit(chat, reply, PRIORITY_REPLY)
+            return
+        try:
+            self.transport.send(reply)
+            self.on_status(f"נשלחה תגובה: {reply}")
+        except Exception as e:
+            self.on_status(f"כשל בשליחה: {e}")
+
+    def _start_sender(self):
+        vals = self.settings.values
+        self.sender = SenderThread(self.transport, self.on_status,
+                                   rate_per_min=float(vals.get("send_rate_per_min", DEFAULT_SEND_RATE_PER_MIN)),
+                                   burst=int(vals.get("send_burst", DEFAULT_SEND_BURST)))
+        self.sender.start()
+
+    def _start_session(self):
+        self.on_status("פותח את WhatsApp Web…")
+        if self.transport is None:
+            self.transport = SeleniumTransport(start_maximized=self.settings.values.get("start_maximized", True),
+                                               profile_dir=self.profile_dir,
+                                               fast_insert=bool(self.settings.values.get("fast_text_insert", True)),
+                                               latency_budget_ms=self.settings.values.get("latency_budget_ms"),
+                                               detach=self.detach_browser,
+                                               **lean_options(self.settings.values))
+        self.transport.connect(self.on_status)
+
+    def _start_memory_monitor(self):
+        interval = float(self.settings.values.get("memory_sample_sec", DEFAULT_MEMORY_SAMPLE_SEC))
+        if interval <= 0 or self.transport.memory() is None:
+            return
+        self.memory = MemoryMonitor(self.transport, label=", ".join(getattr(self, "groups", [self.group_name])),
+                                    interval=interval)
+        self.memory.start()
+
+    def _make_poller(self) -> AdaptivePoller:
+        vals = self.settings.values
+        self.poller = AdaptivePoller(
+            floor=float(vals.get("poll_floor_sec", DEFAULT_POLL_FLOOR)),
+            ceiling=max(1, int(vals.get("poll_interval_sec", DEFAULT_POLL_INTERVAL))))
+        return self.poller
+
+    def _open_target(self) -> bool:
+        if self.group_name == FREE_CHOICE:
+            self.on_status("החיבור בוצע. מצב בחירה חופשית: בחר/י ידנית צ\'אט ב-WhatsApp…")
+            if not self.transport.wait_chat_selected(600):
+                self.on_status("פג הזמן לבחירת צ\'אט. עצירה.")
+                return False
+            self.on_status("נבחר צ\'אט. הבוט פועל ומאזין להודעות…")
+        else:
+            self.on_status("החיבור בוצע. פותח את הצ\'אט…")
+            self.transport.open_chat(self.group_name)
+            self.on_status("הבוט פועל ומאזין להודעות…")
+        return True
+
+    def _loop(self):
+        poller = self._make_poller()
+        watching = self._start_observer()
+        self.ingestion = "observer" if watching else "poll"
+        rows = self.transport.read_incoming()
+        if watching:
+            # נקודת ההמשך להתאוששות/חזרה: ההודעה האחרונה שכבר בצ'אט (בלי לסמן אותה כנראתה —
+            # אם היא הגיעה אחרי התקנת ה-Observer, הוא ידווח עליה)
+            if rows:
+                self._last_ids.setdefault(None, rows[-1]["id"])
+        else:
+            # בפולינג, הקריאה הראשונה רק מסמנת את ההיסטוריה כנראתה (ה-Observer עושה זאת בעצמו)
+            self._fresh(rows)
+        self._last_ids.setdefault(None, PRIMED_EMPTY)
+        delay = poller.floor
+        transport = self.transport
+        # בבחירה חופשית אין שם לחזור אליו — פקודות שליחה לא מתקבלות
+        self._accepting = self.group_name != FREE_CHOICE
+        while not self.stop_event.is_set():
+            if self._commands:
                 try:
-                    msg = last_incoming_text(self.driver)
+                    self._run_commands()
                 except Exception as e:
-                    self.on_status(f"שגיאה בקריאת הודעות: {e}")
-                    time.sleep(2)
-                    continue
-                if msg != last_processed:
-                    if self.dataset.is_bot_reply(msg):
-                        self.on_status("דילוג: ההודעה האחרונה היא תגובה של הבוט.")
-                    else:
-                        self.on_status(f"התקבלה הודעה: {msg}")
-                        reply = self.dataset.match(msg)
-                        if reply:
-                            try:
-                                box = WebDriverWait(self.driver, 10).until(
-                                    EC.element_to_be_clickable((By.XPATH, MSG_AREA))
-                                )
-                                time.sleep(0.6)
-                                box.send_keys(reply, Keys.ENTER)
-                                self.on_status(f"נשלחה תגובה: {reply}")
-                            except Exception as e:
-                                self.on_status(f"כשל בשליחה: {e}")
-                        else:
-                            self.on_status("אין התאמת מילת מפתח. ממתין/ה…")
-                    last_processed = msg
-                time.sleep(poll)
+                    self.on_status(f"שגיאה בשליחה לצ'אט אחר: {e}")
+            busy = self.sender is not None and self.sender.busy()
+            try:
+                transport.take_round_trips()
+                # Observer: ממתין בדפדפן עד הודעה חדשה או עד תום המרווח; פולינג: קורא ואז ישן.
+                # כשיש תגובות בתור — המתנה קצרה, כדי שה-SenderThread יקבל את הדרייבר בין הסבבים
+                items = (transport.watch(min(delay, SEND_YIELD_SEC) if busy else delay) if watching
+                         else self._read_new())
+                if items is None:
+                    # #main הוחלף וה-Observer הותקן מחדש — מה שהגיע מאז הריקון הקודם נקרא מהצ'אט
+                    self._catch_up()
+                    items = []
+                self.read_round_trips = transport.take_round_trips()
+            except Exception as e:
+                self._recover(e)
+                continue
+            fresh = self._fresh(items)
+            if fresh:
+                self._handle_batch([it["text"] for it in fresh])
+            delay = poller.next_delay(bool(fresh))
+            if not watching:
+                self.stop_event.wait(delay)
+            elif not fresh and self.sender is not None and self.sender.busy():
+                self.stop_event.wait(SEND_YIELD_SEC)
+
+    def _datasets(self) -> List[Dataset]:
+        return [self.dataset]
+
+    def _report(self):
+        for ds in self._datasets():
+            ds.save_stats()
+        ci = self.dataset.cache_info()
+        self.on_status(f"מטמון התאמות: {ci['hits']} פגיעות, {ci['misses']} החטאות ({ci['size']}/{ci['maxsize']}).")
+        sb = self.dataset.sandbox
+        if sb is not None and sb.timeouts:
+            self.on_status(f"Regex מבודד: {sum(sb.timeouts.values())} חריגות זמן ב-{len(sb.timeouts)} כללים.")
+        inserts = getattr(self.transport, "insert_stats", None)
+        if inserts:
+            self.on_status("הכנסת טקסט: " + ", ".join(f"{k} {v}" for k, v in inserts.most_common()) + ".")
+        nav = getattr(self.transport, "nav", None)
+        if nav is not None and nav.counts:
+            self.on_status("ניווט בין צ'אטים: " + ", ".join(
+                f"{k} {v['n']} (ממוצע {v['avg_ms']:.0f}ms)" for k, v in nav.stats().items()) + ".")
+        mem = self.memory.stats() if self.memory is not None else {}
+        if mem:
+            growth = mem["growth_mb_per_h"]
+            self.on_status(f"זיכרון Chrome ({mem['mode']}): {mem['first_mb']:.0f}MB בהתחלה, שיא {mem['peak_mb']:.0f}MB,"
+                           f" {mem['rss_mb']:.0f}MB בסוף, {mem['processes']} תהליכים"
+                           + (f", {growth:+.0f}MB לשעה." if growth is not None else "."))
+        wd = self.watchdog
+        if wd is not None and (wd.recoveries or wd.failed_attempts):
+            st = wd.stats()
+            self.on_status(f"התאוששויות סשן: {st['recoveries']} (" + ", ".join(f"{k} {v}" for k, v in st["by_kind"].items())
+                           + f"), {st['failed_attempts']} ניסיונות כושלים, ממוצע {st['avg_sec']:.1f} שניות.")
+        budget = getattr(self.transport, "budget", None)
+        if budget is not None and budget.exceeded:
+            self.on_status("חריגות מתקציב הזמן: " + ", ".join(f"{k} {v}" for k, v in budget.exceeded.most_common()) + ".")
+        if budget is not None and budget.failed:
+            self.on_status("שליחות שבוטלו לפני Enter: " + ", ".join(f"{k} {v}" for k, v in budget.failed.most_common()) + ".")
+
+    def run(self):
+        try:
+            self._start_session()
+            self.watchdog = SessionWatchdog(self.transport, self.on_status, max_delay=float(
+                self.settings.values.get("watchdog_backoff_max_sec", DEFAULT_WATCHDOG_BACKOFF_MAX)))
+            self._start_memory_monitor()
+            self._start_sender()
+            self.acks = AckTracker(self.transport)
+            self.acks.start()
+            if not self._open_target():
+                return
+            self._loop()
         except Exception as e:
             self.on_status(f"שגיאה קריטית: {e}")
         finally:
+            self._reject_commands()
+            if self.acks is not None:
+                self.acks.stop()
+            if self.sender is not None:
+                self.sender.stop()
+                self.sender.join(5)
+            if self.memory is not None:
+                self.memory.stop()
+                self.memory.sample()     # נקודת סיום לפני סגירת Chrome
+            if self.transport is not None:
+                self.transport.close()
+            self._report()
+            self.on_status("הבוט נעצר.")
+
+GROUP_LATENCY_WINDOW = 200    # כמה מדידות השהיה אחרונות נשמרות לכל קבוצה
+
+class MultiChatBotThread(BotThread):
+    """
+    כמה קבוצות בסשן WhatsApp Web אחד: בכל סבב סורק את תגי "לא נקרא" ברשימת הצ'אטים,
+    נכנס רק לקבוצות שיש בהן הודעות חדשות, מתאים מול המאגר של הקבוצה (או הכללי) וחוזר לצ'אט המנוחה.
+    """
+    def __init__(self, dataset: Dataset, groups: List[str], on_status, settings: Settings,
+                 datasets: dict | None = None, transport: ChatTransport | None = None):
+        super().__init__(dataset, ", ".join(groups), on_status, settings, transport=transport)
+        self.groups = list(groups)
+        self.datasets = dict(datasets or {})     # קבוצה -> Dataset ייעודי
+        self.idle_chat = (settings.values.get("idle_chat") or "").strip()
+        self._open_chat = None
+        self._detected = 0.0          # תחילת הסבב הנוכחי (זיהוי התגים)
+        # קבוצה -> השהיות (שניות) מזיהוי התג ועד סוף הטיפול בהודעות
+        self.latency = {g: deque(maxlen=GROUP_LATENCY_WINDOW) for g in self.groups}
+
+    def _open(self, name: str) -> bool:
+        """עובר לצ'אט name; True אם טופלו בדרך הודעות בקבוצה שעוזבים."""
+        if self._open_chat == name:
+            return False
+        # הודעות שמגיעות כשהקבוצה פתוחה לא מקבלות תג "לא נקרא" — קוראים אותן לפני שעוזבים,
+        # ומחכים שהתגובות שאפשר לשלוח עכשיו יישלחו (שליחה תמיד לצ'אט הפתוח). מה שהגיע בזמן ההמתנה
+        # נקרא שוב; התגובות שלו נשארות בתור והקבוצה תבוקר שוב בסבב הבא.
+        handled = self._take_open()
+        if self.sender is not None and self._open_chat is not None:
+            self.sender.flush(self._open_chat)
+            handled |= self._take_open()
+        self.transport.open_chat(name, from_list=True)
+        self._open_chat = name
+        return handled
+
+    def _take_open(self) -> bool:
+        """
+        מטפל בהודעות החדשות בצ'אט הפתוח אם הוא קבוצה במעקב; True אם טופלו הודעות.
+        גודל הקריאה לא נקבע לפי התג (שנדגם בתחילת הסבב ועלול להיות ישן) — _read_new מרחיב עד המזהה האחרון.
+        """
+        group = self._open_chat
+        if group not in self.latency:
+            return False
+        fresh = self._fresh(self._read_new(group), chat=group)
+        if not fresh:
+            return False
+        self._handle_batch([it["text"] for it in fresh], self.datasets.get(group), chat=group)
+        self.latency[group].append(time.monotonic() - self._detected)
+        return True
+
+    def _open_target(self) -> bool:
+        self.on_status(f"החיבור בוצע. מנטר {len(self.groups)} קבוצות: {self.group_name}")
+        # ביקור ראשון בכל קבוצה רק מסמן את ההיסטוריה כנראתה (כמו הקריאה הראשונה בבוט של קבוצה אחת);
+        # גם קבוצה ריקה מסומנת (PRIMED_EMPTY), כדי שפרץ ראשון גדול ייקרא בה במלואו
+        for g in self.groups:
+            self._open(g)
+            if g not in self._last_ids:
+                self._fresh(self.transport.read_incoming(), chat=g)
+                self._last_ids.setdefault(g, PRIMED_EMPTY)
+        if self.idle_chat:
+            self._open(self.idle_chat)
+        return True
+
+    def _switch(self, chat: str):
+        self._open(chat)
+
+    def _leave_home(self):
+        pass     # _open מטפל בקבוצה שעוזבים ומחכה לתגובות שלה
+
+    def _return_home(self):
+        # קבוצות שקיבלו הודעות בינתיים מסומנות בתג "לא נקרא" — הסבב הבא יבקר בהן
+        if self.idle_chat:
+            self._open(self.idle_chat)
+
+    def _resume(self):
+        # הקבוצה שהייתה פתוחה לא קיבלה תגים — נכנסים אליה שוב; שאר הקבוצות לפי התגים בסבב הבא
+        prev, self._open_chat = self._open_chat, None
+        if prev in self.latency:
+            self._open(prev)
+            self._take_open()
+        if self.idle_chat:
+            self._open(self.idle_chat)
+
+    def _visit(self, group: str) -> bool:
+        """נכנס לקבוצה ומטפל בהודעות החדשות שבה; True אם טופלו הודעות."""
+        handled = self._open(group)
+        return self._take_open() or handled
+
+    def _loop(self):
+        poller = self._make_poller()
+        self.ingestion = "unread-badges"
+        self._accepting = True
+        delay = poller.floor
+        while not self.stop_event.is_set():
+            active = False
             try:
-                if self.driver:
-                    self.driver.quit()
+                if self._commands:
+                    active |= self._run_commands()
+                self.transport.take_round_trips()
+                self._detected = time.monotonic()
+                unread = self.transport.unread_chats()
+                self.read_round_trips = self.transport.take_round_trips()
+                # גם קבוצה עם תגובות שחיכו לאסימון בתור — השליחה קורית רק כשהיא פתוחה
+                queued = self.sender.pending_chats() if self.sender is not None else set()
+                for g in self.groups:
+                    if unread.get(g) or g in queued:
+                        active |= self._visit(g)
+                # בצ'אט הפתוח WhatsApp לא מציג תג — בלי צ'אט מנוחה בודקים אותו ישירות
+                if not unread.get(self._open_chat):
+                    active |= self._take_open()
+                if active and self.idle_chat:
+                    active |= self._open(self.idle_chat)
+            except Exception as e:
+                self._recover(e)
+                continue
+            delay = poller.next_delay(active)
+            self.stop_event.wait(delay)
+
+    def group_latency(self) -> dict:
+        """קבוצה -> {n, avg_ms, max_ms} מזיהוי תג "לא נקרא" ועד שליחת התגובות."""
+        out = {}
+        for g, lat in self.latency.items():
+            if lat:
+                out[g] = {"n": len(lat), "avg_ms": 1000 * sum(lat) / len(lat), "max_ms": 1000 * max(lat)}
+        return out
+
+    def metrics(self) -> dict:
+        m = super().metrics()
+        m["groups"] = self.group_latency()
+        return m
+
+    def _datasets(self) -> List[Dataset]:
+        return [self.dataset] + [ds for ds in self.datasets.values() if ds is not self.dataset]
+
+    def _report(self):
+        super()._report()
+        for g, st in self.group_latency().items():
+            self.on_status(f"{g}: {st['n']} טיפולים, השהיה ממוצעת {st['avg_ms']:.0f}ms (מקס' {st['max_ms']:.0f}ms).")
+
+# ---------- Bot workers (supervisor + process pool) ----------
+# כל עובד הוא תהליך עם Chrome ופרופיל משלו (PROFILE_DIR/worker_N — סריקת QR חד-פעמית לכל פרופיל),
+# מריץ BotThread/MultiChatBotThread על חלק מהקבוצות מול עותק לקריאה בלבד של המאגר,
+# ומדווח סטטוס ומדדים ב-Pipe. ה-Supervisor מפעיל מחדש עובד שנפל.
+WORKER_METRICS_INTERVAL = 1.0     # כל כמה שניות עובד שולח מדדים
+WORKER_RESTART_BACKOFF_MAX = 60.0
+WORKER_STABLE_SEC = 60.0          # עובד שרץ יותר מזה לפני שנפל מתחיל את ההשהיה מחדש
+WORKER_STOP_TIMEOUT = 15.0
+
+def worker_profile_dir(worker_id: int) -> Path:
+    return PROFILE_DIR / f"worker_{worker_id}"
+
+def assign_groups(groups: List[str], workers: int) -> List[List[str]]:
+    """חלוקת הקבוצות לעובדים בסבב (round-robin); לא יותר עובדים מקבוצות."""
+    n = max(1, min(int(workers), len(groups)))
+    return [groups[i::n] for i in range(n)]
+
+def _bot_worker_main(conn, worker_id: int, groups: List[str], snapshot: dict, group_snapshots: dict,
+                     settings_values: dict):
+    """תהליך עובד: בוט אחד עם פרופיל Chrome משלו. הודעות ל-Supervisor: (kind, payload)."""
+    def send(kind, payload=None):
+        try:
+            conn.send((kind, payload))
+        except Exception:
+            pass
+
+    settings = Settings(SETTINGS_PATH)
+    settings.values.update(settings_values)
+    dataset = Dataset.from_snapshot(snapshot)
+    datasets = {g: Dataset.from_snapshot(snap) for g, snap in group_snapshots.items()}
+    status = lambda msg: send("status", msg)
+    if settings.values.get("regex_sandbox", False):
+        status("Regex מבודד אינו זמין בתהליך עובד — הכללים רצים ישירות.")
+    if len(groups) > 1:
+        bot = MultiChatBotThread(dataset, groups, status, settings, datasets=datasets)
+    else:
+        bot = BotThread(datasets.get(groups[0], dataset), groups[0], status, settings)
+    bot.profile_dir = worker_profile_dir(worker_id)
+    bot.detach_browser = False
+    send("started", os.getpid())
+    bot.start()
+    stopping = False
+    browser = None
+    while bot.is_alive():
+        # ה-Supervisor צריך את תהליכי Chrome כדי לסגור אותם אם העובד נופל/נהרג (הם לא נסגרים איתו)
+        pid = bot.transport.browser_pid() if bot.transport is not None else None
+        if pid != browser:
+            browser = pid
+            try:
+                table = _process_table()
+            except Exception:
+                table = {}
+            send("browser", sorted(_process_tree(table, [pid])) if pid in table else ([pid] if pid else []))
+        if stopping:
+            bot.join(WORKER_METRICS_INTERVAL)
+            continue
+        try:
+            cmd = conn.recv() if conn.poll(WORKER_METRICS_INTERVAL) else None
+        except (EOFError, OSError):
+            cmd = "stop"          # ה-Supervisor נעלם
+        if cmd == "stop":
+            stopping = True
+            bot.stop()
+        elif bot.poller is not None:
+            send("metrics", bot.metrics())
+    send("stats", {"": dataset._stats, **{g: ds._stats for g, ds in datasets.items()}})
+    send("exit", stopping)
+    sys.exit(0 if stopping else 1)
+
+class BotSupervisor(threading.Thread):
+    """
+    מריץ N תהליכי בוט ומחלק ביניהם את הקבוצות. עובד שיצא בלי שהתבקש — מופעל מחדש
+    אחרי השהיה שמכפילה את עצמה. בעצירה, הסטטיסטיקה של העובדים מתווספת למאגרים ונשמרת.
+    """
+    def __init__(self, dataset: Dataset, groups: List[str], on_status, settings: Settings,
+                 workers: int, datasets: dict | None = None):
+        super().__init__(daemon=True)
+        self.dataset = dataset
+        self.datasets = dict(datasets or {})
+        self.on_status = on_status
+        self.settings = settings
+        self.stop_event = threading.Event()
+        self.poller = None
+        self.workers = [{"id": i, "groups": part, "proc": None, "conn": None, "pid": None,
+                         "state": "ממתין", "status": "", "metrics": {}, "restarts": 0,
+                         "started_at": 0.0, "next_start": 0.0, "backoff": 1.0, "browser": []}
+                        for i, part in enumerate(assign_groups(groups, workers))]
+        self._lock = threading.Lock()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def worker_states(self) -> List[dict]:
+        """מצב כל העובדים לתצוגה: id, groups, pid, state, restarts, status, metrics."""
+        keys = ("id", "groups", "pid", "state", "restarts", "status", "metrics")
+        with self._lock:
+            return [{k: w[k] for k in keys} for w in self.workers]
+
+    def _spawn(self, w: dict):
+        import multiprocessing as mp
+        ctx = mp.get_context("spawn")
+        conn, child = ctx.Pipe()
+        group_snaps = {g: self.datasets[g].snapshot() for g in w["groups"] if g in self.datasets}
+        proc = ctx.Process(target=_bot_worker_main, daemon=True,
+                           args=(child, w["id"], w["groups"], self.dataset.snapshot(), group_snaps,
+                                 dict(self.settings.values)))
+        proc.start()
+        child.close()
+        with self._lock:
+            w.update(proc=proc, conn=conn, pid=proc.pid, state="מתחיל", started_at=time.monotonic())
+
+    def _on_message(self, w: dict, kind: str, payload):
+        if kind == "status":
+            w["status"] = payload
+            self.on_status(f"[עובד {w['id']}] {payload}")
+        elif kind == "metrics":
+            w["metrics"] = payload
+        elif kind == "started":
+            w["state"] = "פועל"
+        elif kind == "browser":
+            w["browser"] = list(payload)
+        elif kind == "stats":
+            for name, stats in payload.items():
+                ds = self.datasets.get(name, self.dataset) if name else self.dataset
+                ds.merge_stats(stats)
+
+    def _pump(self, timeout: float):
+        """מעביר הודעות מכל העובדים (עד timeout שניות המתנה) ומזהה עובדים שיצאו."""
+        from multiprocessing.connection import wait as mp_wait
+        conns = {w["conn"]: w for w in self.workers if w["conn"] is not None}
+        for conn in (mp_wait(list(conns), timeout) if conns else []):
+            w = conns[conn]
+            try:
+                while conn.poll():
+                    kind, payload = conn.recv()
+                    with self._lock:
+                        self._on_message(w, kind, payload)
+            except (EOFError, OSError):
+                self._reap(w)
+        if not conns:
+            self.stop_event.wait(timeout)
+        for w in self.workers:
+            if w["proc"] is not None and not w["proc"].is_alive():
+                self._reap(w)
+
+    def _reap(self, w: dict):
+        proc = w["proc"]
+        if proc is None:
+            return
+        proc.join(1)
+        try:
+            # מה שהעובד שלח לפני שיצא (בעיקר הסטטיסטיקה) עדיין בצינור
+            while w["conn"].poll():
+                kind, payload = w["conn"].recv()
+                with self._lock:
+                    self._on_message(w, kind, payload)
+        except Exception:
+            pass
+        try:
+            w["conn"].close()
+        except Exception:
+            pass
+        # עובד שנפל או נהרג לא סגר את Chrome שלו, וזה מחזיק את הפרופיל (worker_N) — סוגרים לפני הפעלה מחדש
+        if proc.exitcode != 0 and w["browser"]:
+            killed = kill_process_trees(w["browser"])
+            if killed:
+                self.on_status(f"[עובד {w['id']}] נסגרו {killed} תהליכי Chrome שנשארו אחריו.")
+        now = time.monotonic()
+        with self._lock:
+            w.update(proc=None, conn=None, pid=None, browser=[])
+            if self.stop_event.is_set():
+                w["state"] = "נעצר"
+                return
+            if now - w["started_at"] > WORKER_STABLE_SEC:
+                w["backoff"] = 1.0
+            w["next_start"] = now + w["backoff"]
+            w["state"] = f"נפל (קוד {proc.exitcode}), מופעל מחדש בעוד {w['backoff']:.0f} שנ׳"
+            w["backoff"] = min(WORKER_RESTART_BACKOFF_MAX, w["backoff"] * 2)
+        self.on_status(f"[עובד {w['id']}] {w['state']}")
+
+    def run(self):
+        self.on_status(f"מפעיל {len(self.workers)} עובדים: "
+                       + "; ".join(f"{w['id']}: {', '.join(w['groups'])}" for w in self.workers))
+        try:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                for w in self.workers:
+                    if w["proc"] is None and now >= w["next_start"]:
+                        if w["started_at"]:
+                            w["restarts"] += 1
+                        self._spawn(w)
+                self._pump(0.5)
+        except Exception as e:
+            self.on_status(f"שגיאה ב-Supervisor: {e}")
+        finally:
+            self.stop_event.set()
+            self._shutdown()
+
+    def _shutdown(self):
+        for w in self.workers:
+            try:
+                if w["conn"] is not None:
+                    w["conn"].send("stop")
             except Exception:
                 pass
-            self.on_status("הבוט נעצר.")
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        while any(w["proc"] is not None for w in self.workers) and time.monotonic() < deadline:
+            self._pump(0.5)
+        for w in self.workers:
+            if w["proc"] is not None:
+                w["proc"].kill()
+                self._reap(w)
+        for ds in [self.dataset] + [d for d in self.datasets.values() if d is not self.dataset]:
+            ds.save_stats()
+        self.on_status("כל העובדים נעצרו.")
 
 # ---------- App GUI (Right Sidebar, without Bulk page) ----------
 class App(tk.Tk):
@@ -1055,7 +4856,7 @@ class App(tk.Tk):
 
         self.apply_theme(self.settings.values.get("theme", "dark"))
 
-        self.dataset = Dataset(Path(DEFAULT_DATASET))
+        self.dataset = self._make_dataset(DEFAULT_DATASET)
         try:
             self.dataset.load()
         except Exception as e:
@@ -1243,6 +5044,33 @@ class App(tk.Tk):
     def show_page(self, page: ttk.Frame):
         page.tkraise()
 
+    def _make_dataset(self, path) -> Dataset:
+        vals = self.settings.values
+        ds = Dataset(Path(path),
+                     cache_size=int(vals.get("match_cache_size", DEFAULT_MATCH_CACHE_SIZE)),
+                     regex_backend=vals.get("regex_backend", DEFAULT_REGEX_BACKEND),
+                     regex_timeout_ms=float(vals.get("regex_backend_timeout_ms", REGEX_BACKEND_TIMEOUT_MS)))
+        ds.match_order = vals.get("match_order", "file")
+        self._apply_regex_sandbox(ds)
+        return ds
+
+    def _apply_regex_sandbox(self, ds: Dataset):
+        vals = self.settings.values
+        if vals.get("regex_sandbox", False):
+            sb = getattr(self, "_regex_sandbox", None)
+            timeout = float(vals.get("regex_sandbox_timeout_ms", REGEX_SANDBOX_TIMEOUT_MS))
+            if sb is None or abs(sb.timeout * 1000.0 - timeout) > 1e-6:
+                if sb is not None:
+                    sb.close()
+                sb = self._regex_sandbox = RegexSandbox(timeout)
+        else:
+            sb = getattr(self, "_regex_sandbox", None)
+            if sb is not None:
+                sb.close()
+            sb = self._regex_sandbox = None
+        if ds.sandbox is not sb:
+            ds.set_sandbox(sb)
+
     # --------- תוכן: דף הבוט ---------
     def _build_bot_page(self):
         ICO_FILE = "mordi_icon.ico"
@@ -1256,7 +5084,7 @@ class App(tk.Tk):
         frm = self.page_bot
         for i in range(2):
             frm.columnconfigure(i, weight=1)
-        frm.rowconfigure(3, weight=1)
+        frm.rowconfigure(4, weight=1)
 
         ds_frame = ttk.LabelFrame(frm, text="Bank")
         ds_frame.grid(row=0, column=0, columnspan=2, sticky="ew", padx=10, pady=10)
@@ -1298,8 +5126,20 @@ class App(tk.Tk):
         ttk.Button(ctrl, text="עצור", command=self.on_stop).grid(row=0, column=3, padx=6, sticky="e")
 
         ttk.Label(frm, text="סטטוס").grid(row=2, column=1, padx=10, sticky="e")
+        self.bot_metrics_var = tk.StringVar(value="")
+        ttk.Label(frm, textvariable=self.bot_metrics_var).grid(row=2, column=0, padx=10, sticky="w")
+        # מצב הבוטים: שורה לכל תהליך עובד (או שורה אחת לבוט בתהליך הזה)
+        self.workers_tree = ttk.Treeview(frm, columns=("status", "rate", "restarts", "pid", "state", "groups", "id"),
+                                         show="headings", height=3)
+        for col, title, width in (("status", "הודעה אחרונה", 260), ("rate", "סבבים/שנ׳", 70),
+                                  ("restarts", "הפעלות מחדש", 80), ("pid", "PID", 60),
+                                  ("state", "מצב", 140), ("groups", "קבוצות", 160), ("id", "#", 30)):
+            self.workers_tree.heading(col, text=title)
+            self.workers_tree.column(col, width=width, anchor="e", stretch=(col == "status"))
+        self.workers_tree.grid(row=3, column=0, columnspan=2, sticky="ew", padx=10, pady=(0,6))
+        self.after(1000, self._refresh_bot_metrics)
         self.status = tk.Text(frm, height=10)
-        self.status.grid(row=3, column=0, columnspan=2, sticky="nsew", padx=10, pady=(0,10))
+        self.status.grid(row=4, column=0, columnspan=2, sticky="nsew", padx=10, pady=(0,10))
         _rtl_text_widget(self.status)
         self._patch_text_colors(self.status)
         self._log("מוכן")
@@ -1317,10 +5157,18 @@ class App(tk.Tk):
         rules_frame.columnconfigure(0, weight=1)
         rules_frame.rowconfigure(1, weight=1)
 
-        self.rules = ttk.Treeview(rules_frame, columns=("count","keywords","idx"), show="headings", selectmode="browse")
+        self.rules = ttk.Treeview(rules_frame, columns=("time","hits","evals","engine","count","keywords","idx"), show="headings", selectmode="browse")
+        self.rules.heading("time", text="זמן (ms)")
+        self.rules.heading("hits", text="הפעלות")
+        self.rules.heading("evals", text="הערכות")
+        self.rules.heading("engine", text="מנוע")
         self.rules.heading("count", text="מס׳ תגובות")
         self.rules.heading("keywords", text="מילות מפתח (תצוגה)")
         self.rules.heading("idx", text="#")
+        self.rules.column("time", anchor="center", width=80)
+        self.rules.column("hits", anchor="center", width=70)
+        self.rules.column("evals", anchor="center", width=70)
+        self.rules.column("engine", anchor="center", width=70)
         self.rules.column("count", anchor="center", width=120)
         self.rules.column("keywords", anchor="center", width=520)
         self.rules.column("idx", anchor="center", width=50)
@@ -1427,9 +5275,53 @@ class App(tk.Tk):
         self.start_maximized = tk.BooleanVar(value=self.settings.values.get("start_maximized", True))
         ttk.Checkbutton(behavior, text="פתח חלון ממוקסם", variable=self.start_maximized, command=self.on_update_settings).grid(row=0, column=1, sticky="w", padx=6, pady=6)
 
-        ttk.Label(behavior, text="מרווח פולינג לבוט (שניות):").grid(row=1, column=1, sticky="e", padx=6)
+        ttk.Label(behavior, text="מרווח פולינג מרבי בשקט (שניות):").grid(row=1, column=1, sticky="e", padx=6)
         self.poll_interval = tk.IntVar(value=int(self.settings.values.get("poll_interval_sec", DEFAULT_POLL_INTERVAL)))
-        ttk.Spinbox(behavior, from_=1, to=60, textvariable=self.poll_interval, width=6, command=self.on_update_settings).grid(row=1, column=0, sticky="w", padx=6)
+        poll_row = ttk.Frame(behavior)
+        poll_row.grid(row=1, column=0, sticky="w", padx=6)
+        ttk.Spinbox(poll_row, from_=1, to=60, textvariable=self.poll_interval, width=6, command=self.on_update_settings).pack(side="left")
+        ttk.Label(poll_row, text="מינימום אחרי פעילות:").pack(side="left", padx=(12, 4))
+        self.poll_floor = tk.DoubleVar(value=float(self.settings.values.get("poll_floor_sec", DEFAULT_POLL_FLOOR)))
+        ttk.Spinbox(poll_row, from_=0.05, to=5, increment=0.05, textvariable=self.poll_floor, width=6, command=self.on_update_settings).pack(side="left")
+
+        ttk.Label(behavior, text="גודל מטמון התאמות (הודעות, 0 = כבוי):").grid(row=2, column=1, sticky="e", padx=6)
+        self.match_cache_size = tk.IntVar(value=int(self.settings.values.get("match_cache_size", DEFAULT_MATCH_CACHE_SIZE)))
+        ttk.Spinbox(behavior, from_=0, to=100000, increment=256, textvariable=self.match_cache_size, width=8, command=self.on_update_settings).grid(row=2, column=0, sticky="w", padx=6)
+
+        self.regex_sandbox = tk.BooleanVar(value=self.settings.values.get("regex_sandbox", False))
+        ttk.Checkbutton(behavior, text="הרץ Regex חשוד בתהליך נפרד עם זמן קצוב", variable=self.regex_sandbox, command=self.on_update_settings).grid(row=3, column=0, columnspan=2, sticky="w", padx=6, pady=6)
+
+        ttk.Label(behavior, text="מנוע Regex:").grid(row=4, column=1, sticky="e", padx=6)
+        self.regex_backend = tk.StringVar(value=self.settings.values.get("regex_backend", DEFAULT_REGEX_BACKEND))
+        cb_backend = ttk.Combobox(behavior, textvariable=self.regex_backend, values=available_regex_backends(), state="readonly", width=8)
+        cb_backend.grid(row=4, column=0, sticky="w", padx=6, pady=6)
+        cb_backend.bind("<<ComboboxSelected>>", lambda e: self.on_update_settings())
+
+        self.freq_order = tk.BooleanVar(value=self.settings.values.get("match_order", "file") == "frequency")
+        ttk.Checkbutton(behavior, text="בדוק כללים נפוצים/ספציפיים קודם (לכללים שאינם חופפים)", variable=self.freq_order, command=self.on_toggle_match_order).grid(row=5, column=0, columnspan=2, sticky="w", padx=6, pady=6)
+        self.record_corpus = tk.BooleanVar(value=self.settings.values.get("record_corpus", False))
+        ttk.Checkbutton(behavior, text=f"הקלט הודעות נכנסות ({RECORDED_CORPUS_PATH})", variable=self.record_corpus, command=self.on_update_settings).grid(row=6, column=0, columnspan=2, sticky="w", padx=6, pady=6)
+        self.use_observer = tk.BooleanVar(value=self.settings.values.get("ingestion", "observer") == "observer")
+        ttk.Checkbutton(behavior, text="האזנה להודעות ב-MutationObserver (במקום פולינג)", variable=self.use_observer, command=self.on_update_settings).grid(row=7, column=0, columnspan=2, sticky="w", padx=6, pady=6)
+        ttk.Label(behavior, text="תהליכי בוט לכמה קבוצות:").grid(row=8, column=1, sticky="e", padx=6)
+        self.bot_workers = tk.IntVar(value=int(self.settings.values.get("bot_workers", 1)))
+        ttk.Spinbox(behavior, from_=1, to=16, textvariable=self.bot_workers, width=6, command=self.on_update_settings).grid(row=8, column=0, sticky="w", padx=6, pady=6)
+        ttk.Label(behavior, text="קצב תגובות לצ'אט (לדקה, 0 = ללא הגבלה):").grid(row=9, column=1, sticky="e", padx=6)
+        send_row = ttk.Frame(behavior)
+        send_row.grid(row=9, column=0, sticky="w", padx=6, pady=6)
+        self.send_rate = tk.DoubleVar(value=float(self.settings.values.get("send_rate_per_min", DEFAULT_SEND_RATE_PER_MIN)))
+        ttk.Spinbox(send_row, from_=0, to=600, textvariable=self.send_rate, width=6, command=self.on_update_settings).pack(side="left")
+        ttk.Label(send_row, text="פרץ:").pack(side="left", padx=(12, 4))
+        self.send_burst = tk.IntVar(value=int(self.settings.values.get("send_burst", DEFAULT_SEND_BURST)))
+        ttk.Spinbox(send_row, from_=1, to=100, textvariable=self.send_burst, width=6, command=self.on_update_settings).pack(side="left")
+        self.fast_text_insert = tk.BooleanVar(value=self.settings.values.get("fast_text_insert", True))
+        ttk.Checkbutton(behavior, text="הכנסת טקסט מהירה (JS) במקום הקלדה תו-תו", variable=self.fast_text_insert, command=self.on_update_settings).grid(row=10, column=0, columnspan=2, sticky="w", padx=6, pady=6)
+        lean_row = ttk.Frame(behavior)
+        lean_row.grid(row=11, column=0, columnspan=2, sticky="w", padx=6, pady=6)
+        self.lean_browser = tk.BooleanVar(value=self.settings.values.get("lean_browser", False))
+        ttk.Checkbutton(lean_row, text="Chrome חסכוני לריצה ארוכה (בלי תמונות, וידאו, אנימציות ו-GPU)", variable=self.lean_browser, command=self.on_update_settings).pack(side="left")
+        self.lean_headless = tk.BooleanVar(value=self.settings.values.get("lean_headless", False))
+        ttk.Checkbutton(lean_row, text="בלי חלון אחרי סריקת QR", variable=self.lean_headless, command=self.on_update_settings).pack(side="left", padx=(12, 0))
 
         # כפתור שמירה
         savebar = ttk.Frame(frm)
@@ -1487,7 +5379,7 @@ class App(tk.Tk):
                 return
         try:
             new_path.write_text("[]", encoding="utf-8")
-            self.dataset = Dataset(new_path)
+            self.dataset = self._make_dataset(new_path)
             self.dataset.load()
             self.ds_path_var.set(str(new_path))
             self.refresh_rules_tree()
@@ -1508,7 +5400,7 @@ class App(tk.Tk):
         if not path:
             return
         try:
-            self.dataset = Dataset(Path(path))
+            self.dataset = self._make_dataset(path)
             self.dataset.load()
             self.ds_path_var.set(str(Path(path).resolve()))
             self.refresh_rules_tree()
@@ -1657,9 +5549,74 @@ class App(tk.Tk):
             return
         self._remember_group_name(group)
         self.settings.values["poll_interval_sec"] = int(self.poll_interval.get())
-        self.bot = BotThread(self.dataset, group, self._log, self.settings)
+        groups = [g.strip() for g in group.split(",") if g.strip()]
+        workers = int(self.settings.values.get("bot_workers", 1))
+        if len(groups) > 1 and workers > 1:
+            self.bot = BotSupervisor(self.dataset, groups, self._log, self.settings, workers,
+                                     datasets=self._group_datasets(groups))
+        elif len(groups) > 1:
+            self.bot = MultiChatBotThread(self.dataset, groups, self._log, self.settings,
+                                          datasets=self._group_datasets(groups))
+        else:
+            self.bot = BotThread(self.dataset, group, self._log, self.settings)
         self.bot.start()
 
+    def _group_datasets(self, groups) -> dict:
+        """מאגרים ייעודיים לקבוצות לפי group_datasets בהגדרות (קבוצה בלי מאגר משתמשת במאגר הכללי)."""
+        out = {}
+        paths = self.settings.values.get("group_datasets") or {}
+        for g in groups:
+            path = paths.get(g)
+            if not path:
+                continue
+            try:
+                ds = self._make_dataset(path)
+                ds.load()
+                out[g] = ds
+            except Exception as e:
+                self._log(f"טעינת המאגר של {g} ({path}) נכשלה, משתמש במאגר הכללי: {e}")
+        return out
+
+    def _bot_workers(self) -> List[dict]:
+        """שורות טבלת הבוטים: העובדים של ה-Supervisor, או הבוט שרץ בתהליך הזה."""
+        bot = self.bot
+        if bot is None or not bot.is_alive():
+            return []
+        if isinstance(bot, BotSupervisor):
+            return bot.worker_states()
+        return [{"id": 0, "groups": getattr(bot, "groups", [bot.group_name]), "pid": os.getpid(),
+                 "state": "פועל", "restarts": 0, "status": "",
+                 "metrics": bot.metrics() if bot.poller is not None else {}}]
+
+    def _refresh_workers_tree(self):
+        rows = self._bot_workers()
+        self.workers_tree.delete(*self.workers_tree.get_children())
+        for w in rows:
+            rate = w["metrics"].get("poll_rate_hz")
+            self.workers_tree.insert("", "end", values=(w["status"], f"{rate:.2f}" if rate is not None else "",
+                                                        w["restarts"], w["pid"] or "", w["state"],
+                                                        ", ".join(w["groups"]), w["id"]))
+
+    def _refresh_bot_metrics(self):
+        try:
+            self._refresh_workers_tree()
+            if self.bot and self.bot.is_alive() and self.bot.poller is not None:
+                m = self.bot.metrics()
+                text = (f"{m['ingestion']} · {m['poll_rate_hz']:.2f} סבבים/שנ׳ · מרווח {m['poll_delay_sec']:.2f} שנ׳"
+                        f" · {m['round_trips_per_tick']} פניות לדפדפן בסבב")
+                snd = m.get("sender")
+                if snd:
+                    text += (f" · תור שליחה {snd['queue_depth']} (מקס' {snd['max_depth']})"
+                             f" · שליחה p95 {snd['send_latency_ms']['p95']:.0f}ms")
+                mem = m.get("memory")
+                if mem:
+                    text += f" · Chrome {mem['rss_mb']:.0f}MB ({mem['mode']})"
+                self.bot_metrics_var.set(text)
+            else:
+                self.bot_metrics_var.set("")
+        finally:
+            self.after(1000, self._refresh_bot_metrics)
+
     def on_stop(self):
         if self.bot and self.bot.is_alive():
             self.bot.stop()
@@ -1679,7 +5636,11 @@ class App(tk.Tk):
             self.rules.delete(iid)
         for idx, r in enumerate(self.dataset.rules, start=1):
             display = (getattr(r, "source_terms", None) or _regex_to_keywords_display(r.pattern))
-            self.rules.insert("", "end", iid=str(idx-1), values=(len(r.replies), display, idx))
+            engine, note = self.dataset.rule_engine(idx-1)
+            if note:
+                engine += "*"   # נפל ל-re
+            evals, hits, ms = self.dataset.rule_stats(idx-1)
+            self.rules.insert("", "end", iid=str(idx-1), values=(f"{ms:.1f}", hits, evals, engine, len(r.replies), display, idx))
     def _set_replies_display(self, text: str):
         self.replies_txt.configure(state="normal")
         self.replies_txt.delete("1.0", "end")
@@ -1721,6 +5682,10 @@ class App(tk.Tk):
             prev = self.dataset.rules[idx].pattern
             self.pattern_var.set(prev)
             return "break" if event and getattr(event, "keysym", "") == "Return" else None
+        rule = self.dataset.rules[idx]
+        if new_pat != rule.pattern and not confirm_regex_cost(self, new_pat, self.settings.values, getattr(rule, "source_terms", None)):
+            self.pattern_var.set(self.dataset.rules[idx].pattern)
+            return "break" if event and getattr(event, "keysym", "") == "Return" else None
 
         # Update dataset and save
         replies = self.dataset.rules[idx].replies
@@ -1971,9 +5936,50 @@ class App(tk.Tk):
         self.settings.values["confirm_deletions"] = bool(self.confirm_del.get())
         self.settings.values["start_maximized"]   = bool(self.start_maximized.get())
         self.settings.values["poll_interval_sec"] = max(1, int(self.poll_interval.get()))
+        self.settings.values["poll_floor_sec"]    = max(0.05, float(self.poll_floor.get()))
+        self.settings.values["match_cache_size"]  = max(0, int(self.match_cache_size.get()))
+        self.dataset.set_cache_size(self.settings.values["match_cache_size"])
+        self.settings.values["regex_sandbox"]     = bool(self.regex_sandbox.get())
+        self.settings.values["record_corpus"]     = bool(self.record_corpus.get())
+        self.settings.values["ingestion"]         = "observer" if self.use_observer.get() else "poll"
+        self.settings.values["bot_workers"]       = max(1, int(self.bot_workers.get()))
+        self.settings.values["send_rate_per_min"] = max(0.0, float(self.send_rate.get()))
+        self.settings.values["send_burst"]        = max(1, int(self.send_burst.get()))
+        self.settings.values["fast_text_insert"]  = bool(self.fast_text_insert.get())
+        self.settings.values["lean_browser"]      = bool(self.lean_browser.get())
+        self.settings.values["lean_headless"]     = bool(self.lean_headless.get())
+        self._apply_regex_sandbox(self.dataset)
+        backend = self.regex_backend.get()
+        if backend != self.settings.values.get("regex_backend"):
+            self.settings.values["regex_backend"] = backend
+            self.dataset.set_regex_backend(backend, float(self.settings.values.get("regex_backend_timeout_ms", REGEX_BACKEND_TIMEOUT_MS)))
+            self.refresh_rules_tree()
+            fell_back = sum(1 for i in range(len(self.dataset.rules)) if self.dataset.rule_engine(i)[1])
+            self._log(f"מנוע Regex: {backend} ({fell_back} כללים נפלו ל-re)")
         self.settings.save()
         self._log("ההגדרות עודכנו ונשמרו")
 
+    def on_toggle_match_order(self):
+        if self.freq_order.get():
+            # בדיקה על הקורפוס המוקלט (או מלאכותי אם אין) שהסדר החדש לא משנה אף תוצאה
+            if RECORDED_CORPUS_PATH.exists():
+                messages, source = _load_corpus(RECORDED_CORPUS_PATH), str(RECORDED_CORPUS_PATH)
+            else:
+                messages, source = synthetic_corpus(self.dataset), "קורפוס מלאכותי"
+            conflicts = order_conflicts(self.dataset, messages)
+            if conflicts:
+                msg, first, reordered = conflicts[0]
+                if not messagebox.askyesno("סדר הערכה",
+                                           f"ב-{len(conflicts)} הודעות מתוך {source} התשובה תשתנה "
+                                           f"(למשל: {msg[:60]!r} — כלל #{reordered + 1} במקום #{first + 1}).\n"
+                                           "להפעיל בכל זאת?"):
+                    self.freq_order.set(False)
+                    return
+        self.settings.values["match_order"] = "frequency" if self.freq_order.get() else "file"
+        self.dataset.set_match_order(self.settings.values["match_order"])
+        self.settings.save()
+        self._log(f"סדר הערכה: {self.settings.values['match_order']}")
+
     def on_save_settings_clicked(self):
         self.on_update_settings()
         messagebox.showinfo("הגדרות", "ההגדרות נשמרו")
@@ -1987,7 +5993,261 @@ class App(tk.Tk):
             self.status.insert("end", msg + "\n")
             self.status.see("end")
 
-def main():
+def _load_corpus(path) -> List[str]:
+    """קורפוס הודעות: קובץ JSON (רשימת מחרוזות), JSONL (מחרוזת בכל שורה, כמו ההקלטה) או טקסט — הודעה בכל שורה."""
+    path = Path(path)
+    if path.suffix.lower() == ".json":
+        with open(path, "r", encoding="utf-8") as f:
+            return [str(m) for m in json.load(f)]
+    if path.suffix.lower() == ".jsonl":
+        with open(path, "r", encoding="utf-8") as f:
+            return [str(json.loads(ln)) for ln in f if ln.strip()]
+    with open(path, "r", encoding="utf-8") as f:
+        return [ln.rstrip("\r\n") for ln in f if ln.strip()]
+
+def record_messages(messages, path: Path = RECORDED_CORPUS_PATH):
+    """מוסיף הודעות נכנסות לקורפוס המוקלט (JSONL — הודעות מרובות שורות נשמרות שלמות)."""
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            for msg in messages:
+                f.write(json.dumps(msg, ensure_ascii=False) + "\n")
+    except Exception as e:
+        print("Cannot record messages:", e)
+
+def _cli_verify_engines(dataset_path: str, corpus_path: str) -> int:
+    ds = Dataset(Path(dataset_path))
+    ds.load()
+    corpus = _load_corpus(corpus_path) if corpus_path else []
+    check = engine_check_dataset()
+    failed = False
+    for label, d in ((dataset_path, ds), ("builder check rules", check)):
+        messages = corpus + engine_check_corpus(d) if d is check else (corpus or synthetic_corpus(d))
+        mismatches = compare_match_engines(d, messages)
+        print(f"{label}: {len(d._native)}/{len(d.compiled)} rules on TokenSetMatcher, {len(messages)} messages")
+        for msg, pos, want, got in mismatches[:50]:
+            print(f"MISMATCH rule #{pos}: regex={want} native={got} msg={msg!r}")
+        if mismatches:
+            print(f"{len(mismatches)} mismatches")
+            failed = True
+        elif not d._native:
+            print("WARNING: no rule runs on TokenSetMatcher — nothing was compared")
+            failed = failed or d is check
+    display_errors = check_keyword_display()
+    print(f"keyword display: {len(DISPLAY_CHECK_SPECS) - len(display_errors)}/{len(DISPLAY_CHECK_SPECS)} builder rules")
+    for err in display_errors:
+        print(f"DISPLAY {err}")
+    failed = failed or bool(display_errors)
+    print("OK" if not failed else "FAILED")
+    return 1 if failed else 0
+
+def _cli_replay(dataset_path: str, corpus_path: str, seed: int | None = None) -> int:
+    """מריץ את המאגר על קורפוס מוקלט (כמו הבוט, באצווה אחת) ומדפיס את התגובה לכל הודעה."""
+    if seed is not None:
+        random.seed(seed)
+    ds = Dataset(Path(dataset_path))
+    ds.load()
+    messages = _load_corpus(corpus_path)
+    t0 = time.perf_counter()
+    results = ds.scan_many(messages)
+    elapsed = time.perf_counter() - t0
+    matched = skipped = 0
+    for i, (msg, (is_bot, reply)) in enumerate(zip(messages, results), start=1):
+        if is_bot:
+            skipped += 1
+            print(f"{i}\t[bot]\t{msg!r}")
+        else:
+            matched += reply is not None
+            print(f"{i}\t{reply if reply is not None else '-'}\t{msg!r}")
+    print(f"{len(messages)} messages ({len(set(messages))} unique): {matched} replies, {skipped} bot replies skipped, "
+          f"{elapsed * 1000:.1f}ms")
+    return 0
+
+def run_load_test(dataset: Dataset, messages: int = 500, groups: int = 1, burst: int = 5, gap: float = 0.02,
+                  send_latency: float = 0.0, ingestion: str = "observer", seed: int = 0,
+                  send_rate_per_min: float = 0, timeout: float = 120.0, on_status=None,
+                  opening_burst: int = 2 * RECENT_ROWS_LIMIT) -> dict:
+    """
+    מריץ את לולאת הבוט (BotThread, או MultiChatBotThread כש-groups > 1) על FakeTransport:
+    messages הודעות מהקורפוס המלאכותי של המאגר, בפרצים של burst לקבוצה אקראית (לפי seed).
+    הפרץ הראשון (opening_burst) גדול מחלון הקריאה ומגיע לקבוצה שהייתה ריקה כשהבוט התחיל.
+    מחזיר תפוקה והשהיה מכל הודעה נכנסת ועד התגובה שלה. המאגר עצמו לא משתנה (עובדים על עותק).
+    """
+    rnd = random.Random(seed)
+    ds = Dataset.from_snapshot(dataset.snapshot())
+    corpus = synthetic_corpus(ds) or ["שלום"]
+    names = [f"group{i + 1}" for i in range(max(1, groups))]
+    transport = FakeTransport(names, send_latency=send_latency)
+    settings = Settings(SETTINGS_PATH)   # ברירות מחדל — settings.json לא נקרא ולא נכתב
+    settings.values.update(ingestion=ingestion, record_corpus=False, idle_chat="", poll_floor_sec=0.05,
+                           send_rate_per_min=send_rate_per_min)
+    log = on_status or (lambda msg: None)
+    if len(names) > 1:
+        bot = MultiChatBotThread(ds, names, log, settings, transport=transport)
+    else:
+        bot = BotThread(ds, names[0], log, settings, transport=transport)
+    bot.start()
+    deadline = time.monotonic() + timeout
+    # מחכים שהבוט יסיים לסמן את ההיסטוריה ויתחיל להאזין
+    while (bot.ingestion is None or transport.reads == 0) and bot.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # ההודעות ששולחים והתגובה הצפויה לכל אחת (מקבלת תגובה = לא תגובת בוט ויש כלל מתאים)
+    expected = {g: [] for g in names}
+    t0 = time.monotonic()
+    sent_count = 0
+    while sent_count < messages:
+        chat = rnd.choice(names)
+        for _ in range(min(burst if sent_count else max(burst, opening_burst), messages - sent_count)):
+            msg = rnd.choice(corpus)
+            msg_id = transport.push(chat, msg)
+            if not ds.is_bot_reply(msg) and ds.match(msg) is not None:
+                expected[chat].append(msg_id)
+            sent_count += 1
+        if not transport.main_swaps and sent_count >= messages // 2:
+            # באמצע הריצה הדף מחליף את #main, כשהפרץ האחרון עוד לא רוקן — הבוט צריך להשלים מהצ'אט
+            transport.swap_main()
+        if gap:
+            time.sleep(gap)
+    want = sum(len(ids) for ids in expected.values())
+    while len(transport.sent) < want and bot.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    elapsed = time.monotonic() - t0
+    bot.stop()
+    bot.join(5)
+
+    # הזוג ה-k של כל קבוצה: ההודעה ה-k שציפינו לה תגובה <-> השליחה ה-k בקבוצה
+    latencies = []
+    by_chat = {g: [t for c, _text, t in transport.sent if c == g] for g in names}
+    for g in names:
+        for msg_id, t_sent in zip(expected[g], by_chat[g]):
+            latencies.append(t_sent - transport.pushed_at[msg_id])
+    return {"messages": messages, "groups": len(names), "ingestion": bot.ingestion, "sender": bot.metrics()["sender"],
+            "replies_expected": want, "replies_sent": len(transport.sent),
+            "elapsed_sec": elapsed, "throughput_msg_per_sec": messages / elapsed if elapsed > 0 else 0.0,
+            "latency_ms": {"p50": 1000 * _percentile(latencies, 0.5), "p95": 1000 * _percentile(latencies, 0.95),
+                           "max": 1000 * max(latencies, default=0.0)},
+            "reads": transport.reads, "main_swaps": transport.main_swaps}
+
+def _cli_load_test(dataset_path: str, messages: int, groups: int, send_latency_ms: float, ingestion: str,
+                   seed: int | None, send_rate_per_min: float = 0) -> int:
+    ds = Dataset(Path(dataset_path))
+    ds.load()
+    res = run_load_test(ds, messages=messages, groups=groups, send_latency=send_latency_ms / 1000.0,
+                        ingestion=ingestion, seed=seed or 0, send_rate_per_min=send_rate_per_min)
+    lat = res["latency_ms"]
+    print(f"{res['messages']} messages in {res['groups']} group(s), ingestion={res['ingestion']}: "
+          f"{res['replies_sent']}/{res['replies_expected']} replies in {res['elapsed_sec']:.2f}s "
+          f"({res['throughput_msg_per_sec']:.0f} msg/s)")
+    print(f"latency p50={lat['p50']:.1f}ms p95={lat['p95']:.1f}ms max={lat['max']:.1f}ms, "
+          f"{res['reads']} reads, {res['main_swaps']} #main swap(s)")
+    snd = res["sender"]
+    print(f"send queue max {snd['max_depth']}, {snd['throttled']} throttled, "
+          f"queue->sent p50={snd['send_latency_ms']['p50']:.1f}ms p95={snd['send_latency_ms']['p95']:.1f}ms")
+    return 0 if res["replies_sent"] == res["replies_expected"] else 1
+
+BENCH_SEND_LENGTHS = (20, 100, 400, 1000, 4000)
+_BENCH_SAMPLE = "שלום, זו הודעת בדיקה למדידת מהירות ההקלדה בתיבת ההודעה. "
+
+def benchmark_send(transport: SeleniumTransport, lengths=BENCH_SEND_LENGTHS, reps: int = 3) -> List[dict]:
+    """
+    משווה זמן הכנסת טקסט לתיבת ההקלדה בצ'אט הפתוח: JS (insert_text) מול send_keys, לפי אורך ההודעה.
+    לא לוחץ Enter — התיבה מתרוקנת אחרי כל מדידה, כך ששום הודעה לא נשלחת.
+    """
+    drv = transport.driver
+    rows = []
+    with transport.lock:
+        box = WebDriverWait(drv, 10).until(EC.element_to_be_clickable((By.XPATH, MSG_AREA)))
+        clear_text(drv, box)
+        for n in lengths:
+            text = (_BENCH_SAMPLE * (n // len(_BENCH_SAMPLE) + 1))[:n]
+            js, keys, methods = [], [], Counter()
+            for _ in range(reps):
+                t0 = time.perf_counter()
+                methods[insert_text(drv, box, text) or "failed"] += 1
+                js.append(time.perf_counter() - t0)
+                clear_text(drv, box)
+                t0 = time.perf_counter()
+                box.send_keys(text)
+                keys.append(time.perf_counter() - t0)
+                clear_text(drv, box)
+            rows.append({"length": n, "js_ms": 1000 * _percentile(js, 0.5),
+                         "send_keys_ms": 1000 * _percentile(keys, 0.5),
+                         "js_method": methods.most_common(1)[0][0]})
+    return rows
+
+def _cli_bench_send(chat: str, reps: int) -> int:
+    transport = SeleniumTransport(start_maximized=False)
+    try:
+        transport.connect(print)
+        transport.open_chat(chat)
+        rows = benchmark_send(transport, reps=reps)
+    finally:
+        transport.close()
+    print(f"{'length':>7} {'js':>10} {'send_keys':>11}  method")
+    for r in rows:
+        print(f"{r['length']:>7} {r['js_ms']:>8.1f}ms {r['send_keys_ms']:>9.1f}ms  {r['js_method']}")
+    return 0 if all(r["js_method"] != "failed" for r in rows) else 1
+
+def _cli_memory_report(path: str) -> int:
+    try:
+        runs = summarize_memory_log(Path(path))
+    except OSError as e:
+        print(f"cannot read {path}: {e}")
+        return 1
+    if not runs:
+        print(f"no samples in {path}")
+        return 1
+    print(f"{'run':<22} {'mode':<14} {'hours':>6} {'first':>8} {'last':>8} {'peak':>8} {'avg':>8} {'MB/h':>7}  groups")
+    for r in runs:
+        print(f"{r['run']:<22} {r['mode']:<14} {r['hours']:>6.1f} {r['first_mb']:>6.0f}MB {r['last_mb']:>6.0f}MB"
+              f" {r['peak_mb']:>6.0f}MB {r['avg_mb']:>6.0f}MB {_fmt_growth(r['growth_mb_per_h']):>7}  {r['label']}")
+    by_mode = OrderedDict()
+    for r in runs:
+        by_mode.setdefault(r["mode"], []).append(r)
+    print()
+    for mode, rs in by_mode.items():
+        growth = [r["growth_mb_per_h"] for r in rs if r["growth_mb_per_h"] is not None]
+        print(f"{mode}: {len(rs)} run(s), {sum(r['hours'] for r in rs):.1f}h sampled,"
+              f" avg {sum(r['avg_mb'] for r in rs) / len(rs):.0f}MB, peak {max(r['peak_mb'] for r in rs):.0f}MB,"
+              f" growth {_fmt_growth(sum(growth) / len(growth) if growth else None)}MB/h")
+    return 0
+
+def _fmt_growth(v: float | None) -> str:
+    return f"{v:+.1f}" if v is not None else "-"
+
+def main(argv=None):
+    import argparse, multiprocessing
+    multiprocessing.freeze_support()   # תהליכי העזר (בדיקת Regex) בגרסת EXE
+    ap = argparse.ArgumentParser(prog="mordi", description=APP_TITLE)
+    ap.add_argument("--dataset", default=DEFAULT_DATASET, help="קובץ המאגר (ברירת מחדל: keywords.json)")
+    ap.add_argument("--verify-engines", metavar="CORPUS", nargs="?", const="", default=None,
+                    help="השווה TokenSetMatcher מול Regex על קורפוס (JSON/טקסט) או על קורפוס מלאכותי")
+    ap.add_argument("--replay", metavar="CORPUS", default=None,
+                    help="הרץ את המאגר על קורפוס הודעות מוקלט והדפס את התגובה לכל הודעה")
+    ap.add_argument("--seed", type=int, default=None, help="זרע לבחירת התגובה האקראית (ל-replay) / ליצירת העומס")
+    ap.add_argument("--load-test", metavar="N", type=int, default=None,
+                    help="מדידת תפוקה והשהיה של לולאת הבוט על WhatsApp מדומה (N הודעות, בלי דפדפן)")
+    ap.add_argument("--groups", type=int, default=1, help="מספר קבוצות מדומות ל-load-test")
+    ap.add_argument("--send-latency", metavar="MS", type=float, default=0.0, help="השהיית שליחה מדומה ל-load-test")
+    ap.add_argument("--ingestion", choices=("observer", "poll"), default="observer", help="אופן הקריאה ל-load-test")
+    ap.add_argument("--send-rate", metavar="PER_MIN", type=float, default=0, help="קצב שליחה לצ'אט ל-load-test (0 = ללא הגבלה)")
+    ap.add_argument("--bench-send", metavar="CHAT", default=None,
+                    help="השוואת זמן הכנסת טקסט (JS מול send_keys) לפי אורך, בצ'אט CHAT (בלי לשלוח)")
+    ap.add_argument("--bench-reps", type=int, default=3, help="חזרות לכל אורך ב-bench-send")
+    ap.add_argument("--memory-report", metavar="LOG", nargs="?", const=str(MEMORY_LOG_PATH), default=None,
+                    help="סיכום דגימות הזיכרון של Chrome לפי ריצה ומצב (ברירת מחדל: chrome_memory.jsonl)")
+    args, _unknown = ap.parse_known_args(argv)
+    if args.verify_engines is not None:
+        sys.exit(_cli_verify_engines(args.dataset, args.verify_engines))
+    if args.replay is not None:
+        sys.exit(_cli_replay(args.dataset, args.replay, args.seed))
+    if args.bench_send is not None:
+        sys.exit(_cli_bench_send(args.bench_send, max(1, args.bench_reps)))
+    if args.memory_report is not None:
+        sys.exit(_cli_memory_report(args.memory_report))
+    if args.load_test is not None:
+        sys.exit(_cli_load_test(args.dataset, args.load_test, args.groups, args.send_latency, args.ingestion, args.seed,
+                                args.send_rate))
     app = App()
     app.mainloop()
 
@@ -2077,6 +6337,116 @@ class _SchedulerThread(_thr.Thread):
     def stop(self):
         self._stop.set()
 
+    def _finish_item(self, it: dict, ok: bool):
+        # update item status + UI
+        it["last_status"] = "sent" if ok else "failed"
+        it["sent_at"] = datetime.now().isoformat(timespec="seconds")
+        try:
+            import datetime as _dt
+            rep = (it.get('repeat') or 'once')
+            # normalize label to code (supports Hebrew labels)
+            _rep_map = {
+                'חד פעמי': 'once', 'חד-פעמי': 'once',
+                'יומי': 'daily', 'שבועי': 'weekly', 'חודשי': 'monthly',
+                'once': 'once', 'daily': 'daily', 'weekly': 'weekly', 'monthly': 'monthly'
+            }
+            rep_code = _rep_map.get(str(rep).strip(), 'once')
+            if rep_code and rep_code != 'once':
+                try:
+                    _when = datetime.fromisoformat(it.get('when',''))
+                except Exception:
+                    _when = datetime.now()
+                if rep_code == 'daily':
+                    _when = _when + _dt.timedelta(days=1)
+                elif rep_code == 'weekly':
+                    _when = _when + _dt.timedelta(weeks=1)
+                elif rep_code == 'monthly':
+                    y, m = _when.year, _when.month
+                    m += 1
+                    y += (m - 1) // 12
+                    m = ((m - 1) % 12) + 1
+                    day = min(_when.day, [31, 29 if y % 4 == 0 and (y % 100 != 0 or y % 400 == 0) else 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31][m - 1])
+                    _when = _when.replace(year=y, month=m, day=day)
+                it['when'] = _when.isoformat(timespec='minutes')
+                it['status'] = 'pending'
+            else:
+                it["status"] = "sent" if ok else "failed"
+        except Exception:
+            pass
+        try:
+            self.app_ref.after(0, self.app_ref._refresh_sched_table)
+        except Exception:
+            pass
+        try:
+            self.app_ref._save_schedules()
+        except Exception:
+            pass
+
+    def _send_via_bot(self, items: list) -> dict:
+        """
+        Sends through the running bot (same Chrome, it returns to its monitored chat afterwards).
+        Returns {id(item): ok} for the items the bot handled; items it never tried are left for the pool.
+        """
+        bot = self.app_ref._command_bot()
+        if bot is None:
+            return {}
+        out, futs = {}, []
+        for it in items:
+            group = (it.get("group") or "").strip()
+            text  = (it.get("text")  or "").strip()
+            if not group or not text:
+                out[id(it)] = False
+                continue
+            futs.append((it, bot.send_to(group, text)))
+        for it, fut in futs:
+            try:
+                out[id(it)] = bool(fut.result(timeout=COMMAND_TIMEOUT_SEC))
+            except FutureTimeout:
+                out[id(it)] = False   # may still go out — not retried, to avoid a duplicate
+            except Exception:
+                pass                  # the bot stopped before trying: fall back to the separate profile
+        return out
+
+    def _send_via_pool(self, items: list) -> dict:
+        """Sends with the warm scheduler session (separate profile); returns {id(item): ok}."""
+        pool = self.app_ref._session_pool()
+        transport = pool.acquire(self.app_ref._sched_set_status)
+        tracker = AckTracker(transport)
+        sent = []   # (item, Future) — האישורים מוכרעים ברקע, השליחה ממשיכה מיד
+        try:
+            tracker.start()
+            for it in items:
+                fut = None
+                try:
+                    group = (it.get("group") or "").strip()
+                    text  = (it.get("text")  or "").strip()
+                    if not group or not text:
+                        raise RuntimeError("Group or text missing")
+
+                    # open chat (acks are read from the open chat: settle the previous one first)
+                    if group != transport.current_chat:
+                        if transport.current_chat is not None:
+                            tracker.wait_chat(transport.current_chat)
+                        transport.open_chat(group)
+
+                    # type + send, then move on; the ack table confirms it (~20s timeout)
+                    before = transport.last_outgoing_id()
+                    transport.send(text)
+                    fut = tracker.track(group, text, before)
+                except Exception:
+                    fut = None
+                sent.append((it, fut))
+            out = {}
+            for it, fut in sent:
+                try:
+                    out[id(it)] = fut is not None and bool(fut.result())
+                except Exception:
+                    out[id(it)] = False
+            return out
+        finally:
+            tracker.stop()
+            pool.release(transport)
+
     def run(self):
         # Poll every second for due tasks
         while not self._stop.is_set():
@@ -2100,110 +6470,14 @@ class _SchedulerThread(_thr.Thread):
                     buckets.setdefault(key, []).append(it)
 
                 for when_key, items in buckets.items():
-                    # Open one Chrome session (separate profile) per time bucket
-                    alt_profile = PROFILE_DIR / "schedule_profile"
-                    alt_profile.mkdir(exist_ok=True)
-                    _opts = Options()
-                    _opts.add_argument(f"--user-data-dir={alt_profile.resolve()}")
-                    _opts.add_argument("--start-maximized")
-                    _opts.add_argument("--log-level=3")
-                    _opts.add_argument("--disable-logging")
-                    _opts.add_experimental_option("detach", True)
-                    _drv = None
-                    try:
-                        _drv = webdriver.Chrome(options=_opts)
-                        _drv.get("https://web.whatsapp.com/")
-                        # ensure logged in
-                        wait_for_login(_drv, sec=120)
-
-                        for it in sorted(items, key=lambda x: (str(x.get("group","")), str(x.get("text","")), str(x.get("when","")))):
-                            ok = False
-                            try:
-                                group = (it.get("group") or "").strip()
-                                text  = (it.get("text")  or "").strip()
-                                if not group or not text:
-                                    raise RuntimeError("Group or text missing")
-
-                                # open chat
-                                open_chat(_drv, group)
-
-                                # type + send
-                                box = WebDriverWait(_drv, 10).until(EC.element_to_be_clickable((By.XPATH, MSG_AREA)))
-                                _time.sleep(0.6)
-                                box.send_keys(text, Keys.ENTER)
-
-                                # confirm that message appeared
-                                sent_ok = False
-                                try:
-                                    for _ in range(100):  # ~20s
-                                        try:
-                                            bubbles = _drv.find_elements(By.CSS_SELECTOR, BUBBLES_ANY_CSS)
-                                            if bubbles:
-                                                last_txt = bubbles[-1].text.strip()
-                                                if last_txt == (text or "").strip():
-                                                    sent_ok = True
-                                                    break
-                                        except Exception:
-                                            pass
-                                        _time.sleep(0.2)
-                                except Exception:
-                                    sent_ok = False
-
-                                ok = bool(sent_ok)
-                            except Exception:
-                                ok = False
-                            # update item status + UI
-                            it["last_status"] = "sent" if ok else "failed"
-                            it["sent_at"] = datetime.now().isoformat(timespec="seconds")
-                            try:
-                                import datetime as _dt
-                                rep = (it.get('repeat') or 'once')
-                                # normalize label to code (supports Hebrew labels)
-                                _rep_map = {
-                                    'חד פעמי': 'once', 'חד-פעמי': 'once',
-                                    'יומי': 'daily', 'שבועי': 'weekly', 'חודשי': 'monthly',
-                                    'once': 'once', 'daily': 'daily', 'weekly': 'weekly', 'monthly': 'monthly'
-                                }
-                                rep_code = _rep_map.get(str(rep).strip(), 'once')
-                                if rep_code and rep_code != 'once':
-                                    try:
-                                        _when = datetime.fromisoformat(it.get('when',''))
-                                    except Exception:
-                                        _when = datetime.now()
-                                    if rep_code == 'daily':
-                                        _when = _when + _dt.timedelta(days=1)
-                                    elif rep_code == 'weekly':
-                                        _when = _when + _dt.timedelta(weeks=1)
-                                    elif rep_code == 'monthly':
-                                        y, m = _when.year, _when.month
-                                        m += 1
-                                        y += (m - 1) // 12
-                                        m = ((m - 1) % 12) + 1
-                                        day = min(_when.day, [31, 29 if y % 4 == 0 and (y % 100 != 0 or y % 400 == 0) else 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31][m - 1])
-                                        _when = _when.replace(year=y, month=m, day=day)
-                                    it['when'] = _when.isoformat(timespec='minutes')
-                                    it['status'] = 'pending'
-                                else:
-                                    it["status"] = "sent" if ok else "failed"
-                            except Exception:
-                                pass
-                            try:
-                                self.app_ref.after(0, self.app_ref._refresh_sched_table)
-                            except Exception:
-                                pass
-                            try:
-                                self.app_ref._save_schedules()
-                            except Exception:
-                                pass
-                            _time.sleep(0.4)
-                        # end for items
-                    finally:
-                        try:
-                            if _drv is not None:
-                                _time.sleep(1.0)  # wait 1s after the last message before closing the session
-                                _drv.quit()
-                        except Exception:
-                            pass
+                    items = sorted(items, key=lambda x: (str(x.get("group","")), str(x.get("text","")), str(x.get("when",""))))
+                    # Through the running bot's session when it is alive; otherwise the separate scheduler profile
+                    results = self._send_via_bot(items)
+                    rest = [it for it in items if id(it) not in results]
+                    if rest:
+                        results.update(self._send_via_pool(rest))
+                    for it in items:
+                        self._finish_item(it, results.get(id(it), False))
 
                 # persist once after processing all buckets
                 self.app_ref._save_schedules()
@@ -2316,6 +6590,7 @@ class SchedulePageMixin:
 
     def _start_scheduler(self):
         try:
+            self._session_pool()
             self._scheduler_thread = _SchedulerThread(self)
             self._scheduler_thread.start()
         except Exception as e:
@@ -2328,6 +6603,29 @@ class SchedulePageMixin:
                 th.stop()
             except Exception:
                 pass
+        pool = getattr(self, "_sched_pool", None)
+        if pool is not None:
+            pool.close()
+
+    def _command_bot(self):
+        """הבוט הרץ אם הוא יכול לשלוח לצ'אט אחר בשבילנו (באותו Chrome), אחרת None."""
+        bot = getattr(self, "bot", None)
+        accepts = getattr(bot, "accepts_commands", None)
+        return bot if accepts is not None and accepts() else None
+
+    def _make_schedule_transport(self) -> SeleniumTransport:
+        vals = self.settings.values
+        return SeleniumTransport(profile_dir=PROFILE_DIR / "schedule_profile",
+                                 fast_insert=bool(vals.get("fast_text_insert", True)),
+                                 latency_budget_ms=vals.get("latency_budget_ms"), **lean_options(vals))
+
+    def _session_pool(self) -> SessionPool:
+        """ה-session החם של המתזמן ו"שלח עכשיו" (נוצר בשימוש הראשון)."""
+        pool = getattr(self, "_sched_pool", None)
+        if pool is None:
+            pool = self._sched_pool = SessionPool(self._make_schedule_transport)
+        pool.idle_timeout = float(self.settings.values.get("scheduler_session_idle_sec", DEFAULT_SESSION_IDLE_SEC))
+        return pool
 
     # ----- UI injection -----
     def _inject_schedule_ui(self):
@@ -2621,58 +6919,42 @@ class SchedulePageMixin:
     def _send_scheduled_message(self, group: str, text: str) -> bool:
         """
         שליחה מיידית של הודעה לצ'אט/קבוצה, בלי לפגוע בבוט הראשי.
-        משתמש בפרופיל כרום ייעודי ("schedule_profile") כדי למנוע התנגשויות.
+        כשהבוט רץ — דרכו (שולח וחוזר לצ'אט המנוטר); אחרת בפרופיל כרום ייעודי ("schedule_profile").
         """
-        try:
-            # build a separate Chrome profile so we don't collide with the main bot
-            alt_profile = PROFILE_DIR / "schedule_profile"
+        # through the running bot's own session, when it can take commands
+        bot = self._command_bot()
+        if bot is not None:
             try:
-                alt_profile.mkdir(exist_ok=True)
+                return bool(bot.send_to(group, text or "").result(timeout=COMMAND_TIMEOUT_SEC))
+            except FutureTimeout:
+                return False
             except Exception:
-                pass
-            _opts = Options()
-            _opts.add_argument(f"--user-data-dir={alt_profile.resolve()}")
-            _opts.add_argument("--start-maximized")
-            _opts.add_argument("--log-level=3")
-            _opts.add_argument("--disable-logging")
-            _opts.add_experimental_option("detach", True)
-            drv = webdriver.Chrome(options=_opts)
-            drv.get("https://web.whatsapp.com/")
-            wait_for_login(drv, sec=120)
+                pass   # the bot stopped before sending: use the separate profile
+
+        # the warm scheduler session (a separate Chrome profile so we don't collide with the main bot)
+        pool = self._session_pool()
+        try:
+            transport = pool.acquire(self._sched_set_status)
+        except Exception:
+            return False
+        tracker = AckTracker(transport)
+        try:
+            tracker.start()
 
             # open target chat
-            open_chat(drv, group)
+            transport.open_chat(group)
 
             # type and send
-            box = WebDriverWait(drv, 10).until(EC.element_to_be_clickable((By.XPATH, MSG_AREA)))
-            time.sleep(0.6)
-            box.send_keys(text or "", Keys.ENTER)
+            before = transport.last_outgoing_id()
+            transport.send(text or "")
 
-            # verify it appeared
-            sent_ok = False
-            try:
-                for _ in range(100):  # ~20s
-                    try:
-                        bubbles = drv.find_elements(By.CSS_SELECTOR, BUBBLES_ANY_CSS)
-                        if bubbles:
-                            last_txt = bubbles[-1].text.strip()
-                            if last_txt == (text or "").strip():
-                                sent_ok = True
-                                break
-                    except Exception:
-                        pass
-                    time.sleep(0.2)
-            except Exception:
-                sent_ok = False
-
-            return bool(sent_ok)
+            # wait for the ack table to see it accepted by the server (~20s)
+            return tracker.track(group, text, before).result()
         except Exception:
             return False
         finally:
-            try:
-                drv.quit()
-            except Exception:
-                pass
+            tracker.stop()
+            pool.release(transport)
 
 
     def _refresh_sched_table(self):